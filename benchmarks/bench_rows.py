@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Memory and time of syncing one large single-file stream (nytimes_us_counties) with a fake
+#   GitClient (no network calls): a generated us-counties.csv, RECORD messages counted, not kept.
+# Usage, from the repository root:
+#   python benchmarks/bench_rows.py [--rows 50000] [--trace] [--tree PATH]
+#   --trace: tracemalloc peak (slower)
+#   --tree: repository root of another checkout to benchmark, e.g. the commit before a change:
+#       git worktree add /tmp/before <commit>~1
+#       python benchmarks/bench_rows.py --trace --tree /tmp/before
+import os
+import sys
+import time
+import base64
+import logging
+import argparse
+import contextlib
+import importlib
+import tracemalloc
+
+STREAM_NAME = 'nytimes_us_counties'
+HEADER = 'date,county,state,fips,cases,deaths\n'
+COUNTIES = 3000
+
+
+def get_content(row_count):
+    rows = []
+    for row_index in range(row_count):
+        day = row_index // COUNTIES
+        county = row_index % COUNTIES
+        rows.append('2020-{:02d}-{:02d},County{},Washington,{},{},{}\n'.format(
+            day // 28 + 1, day % 28 + 1, county, 53000 + county, row_index % 500, row_index % 20))
+    return (HEADER + ''.join(rows)).encode('utf-8')
+
+
+class FakeClient(object):
+    base_url = 'https://api.github.com'
+
+    def __init__(self, file_path, content):
+        self.file_path = file_path
+        self.content = content
+        self.quota_counts = {}
+        self.rate_limits = {}
+
+    def get(self, url=None, headers=None, **kwargs):
+        if '/search/' in url:
+            return {'items': [{
+                'name': self.file_path,
+                'path': self.file_path,
+                'sha': 'bench',
+                'git_url': '{}/repos/nytimes/covid-19-data/git/blobs/bench'.format(self.base_url),
+                'html_url': None,
+                'repository': {'name': 'covid-19-data', 'owner': {'login': 'nytimes'}}
+            }]}, None, None
+        if '/commits?path=' in url:
+            return [{'sha': 'bench'}], None, '2020-05-01T00:00:00Z'
+        if '/git/blobs/' in url:
+            return {'content': base64.b64encode(self.content).decode('ascii')}, None, None
+        raise Exception('Error: unexpected URL: {}'.format(url))
+
+
+# stdout of the sync: counts the RECORD messages (singer metrics counters reset when they log)
+class RecordCounter(object):
+    def __init__(self):
+        self.records = 0
+
+    def write(self, text):
+        self.records = self.records + text.count('"type": "RECORD"')
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sync of a large csv file')
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--trace', action='store_true')
+    parser.add_argument('--tree', default=os.path.join(os.path.dirname(__file__), '..'))
+    args = parser.parse_args()
+
+    tree = os.path.abspath(args.tree)
+    sys.path.insert(0, tree)
+    import singer
+    sync = importlib.import_module('extract_covid_data.sync')
+    from extract_covid_data.streams import STREAMS
+    logging.disable(logging.CRITICAL)
+
+    catalog = singer.Catalog.load(os.path.join(tree, 'catalog.json'))
+    endpoint_config = dict(STREAMS[STREAM_NAME], append_only=False)
+    client = FakeClient('us-counties.csv', get_content(args.rows))
+    if args.trace:
+        tracemalloc.start()
+    start_time = time.time()
+    output = RecordCounter()
+    with contextlib.redirect_stdout(output):
+        sync.sync_endpoint(
+            client=client,
+            catalog=catalog,
+            state={},
+            start_date='2020-01-01T00:00:00Z',
+            stream_name=STREAM_NAME,
+            search_path=endpoint_config['search_path'],
+            endpoint_config=endpoint_config)
+    seconds = time.time() - start_time
+    peak = tracemalloc.get_traced_memory()[1] / 1e6 if args.trace else None
+    print('tree: {}, rows: {}, records: {}, seconds: {:.1f}, tracemalloc peak MB: {}'.format(
+        tree, args.rows, output.records, seconds, '{:.1f}'.format(peak) if peak is not None else '-'))
+
+
+if __name__ == '__main__':
+    main()
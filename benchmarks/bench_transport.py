@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Throughput and latency of the transports (transport.py) against a local stand-in for the GitHub
+#   API: each GET waits --delay seconds and returns a small blob JSON body.
+#   HTTP/1.1: a threaded http.server. HTTP/2 (optional): hypercorn over TLS (HTTP/2 needs ALPN),
+#   with a self-signed certificate, e.g.
+#       openssl req -x509 -newkey rsa:2048 -nodes -days 1 -subj /CN=localhost \
+#           -keyout /tmp/key.pem -out /tmp/cert.pem
+#       pip install hypercorn extract_covid_data[http2]
+# Usage, from the repository root:
+#   python benchmarks/bench_transport.py [--requests 400] [--threads 32] [--delay 0.02]
+#       [--certfile /tmp/cert.pem --keyfile /tmp/key.pem]
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from extract_covid_data.transport import RequestsTransport, Http2Transport
+
+BODY = json.dumps({'sha': 'x' * 40, 'content': 'YQ==' * 500, 'encoding': 'base64'}).encode('utf-8')
+BLOB_PATH = '/repos/owner/repo/git/blobs/x'
+
+
+def start_http1_server(delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}{}'.format(server.server_address[1], BLOB_PATH)
+
+
+def start_http2_server(delay, certfile, keyfile):
+    from hypercorn.config import Config
+    from hypercorn.asyncio import serve
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        await asyncio.sleep(delay)
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': BODY})
+
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+    config = Config()
+    config.bind = ['127.0.0.1:{}'.format(port)]
+    config.certfile = certfile
+    config.keyfile = keyfile
+    config.loglevel = 'ERROR'
+    # No signal handlers in a thread: served until the benchmark exits
+    shutdown_trigger = lambda: asyncio.Event().wait()
+    threading.Thread(
+        target=lambda: asyncio.run(serve(app, config, shutdown_trigger=shutdown_trigger)),
+        daemon=True).start()
+    time.sleep(1)
+    return 'https://localhost:{}{}'.format(port, BLOB_PATH)
+
+
+def bench(name, transport, url, request_count, threads):
+    latencies = []
+
+    def send(_):
+        start_time = time.time()
+        response = transport.request('GET', url=url)
+        if response.status_code != 200:
+            raise Exception('Error: status_code = {}'.format(response.status_code))
+        latencies.append(time.time() - start_time)
+
+    start_time = time.time()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(send, range(request_count)))
+    seconds = time.time() - start_time
+    latencies.sort()
+    print('{:<36} {:>6.0f} req/s  p50 {:>6.1f} ms  p95 {:>6.1f} ms'.format(
+        name,
+        request_count / seconds,
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.95)] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the HTTP transports')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--delay', type=float, default=0.02)
+    parser.add_argument('--certfile')
+    parser.add_argument('--keyfile')
+    args = parser.parse_args()
+    # httpx logs every request at INFO (singer logging config)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    http1_url = start_http1_server(args.delay)
+    sequential_count = max(args.requests // 2, 1)
+    bench('HTTP/1.1 sequential', RequestsTransport(), http1_url, sequential_count, 1)
+    bench('HTTP/1.1 default pool, {} threads'.format(args.threads),
+          RequestsTransport(), http1_url, args.requests, args.threads)
+    bench('HTTP/1.1 pool_size={}, {} threads'.format(args.threads, args.threads),
+          RequestsTransport(pool_size=args.threads), http1_url, args.requests, args.threads)
+
+    if not args.certfile:
+        print('HTTP/2 skipped (no --certfile and --keyfile)')
+        return
+    http2_url = start_http2_server(args.delay, args.certfile, args.keyfile)
+    transport = Http2Transport(pool_size=args.threads)
+    # Trust the self-signed certificate of the stand-in
+    transport.client = transport.httpx.Client(
+        http2=True,
+        verify=args.certfile,
+        limits=transport.httpx.Limits(max_connections=args.threads))
+    bench('HTTP/2 sequential', transport, http2_url, sequential_count, 1)
+    bench('HTTP/2 {} threads, one connection'.format(args.threads),
+          transport, http2_url, args.requests, args.threads)
+    print('HTTP/2 http_version: {}'.format(transport.client.get(http2_url).http_version))
+
+
+if __name__ == '__main__':
+    main()
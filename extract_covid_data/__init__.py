@@ -8,6 +8,13 @@ from singer import metadata, utils
 from extract_covid_data.client import GitClient
 from extract_covid_data.discover import discover
 from extract_covid_data.sync import sync
+from extract_covid_data.transport import get_transport
+from extract_covid_data.http_cache import get_caching_transport
+from extract_covid_data.request_coalescer import get_request_coalescer
+from extract_covid_data.request_policy import get_request_policy
+from extract_covid_data.planner import get_sync_plan
+from extract_covid_data.reprocess import reprocess
+from extract_covid_data import shards
 
 LOGGER = singer.get_logger()
 
@@ -25,13 +32,49 @@ def do_discover():
     LOGGER.info('Finished discover')
 
 
+# Dry run: print the sync plan (stream order, estimated calls, expected quota use), no data is fetched
+def do_plan(client, config, catalog, state):
+
+    LOGGER.info('Starting plan')
+    selected_streams = [stream.stream for stream in catalog.get_selected_streams(state)]
+    plan = get_sync_plan(client, config, state, selected_streams)
+    json.dump(plan, sys.stdout, indent=2)
+    LOGGER.info('Finished plan')
+
+
 @singer.utils.handle_top_exception(LOGGER)
 def main():
 
+    # --plan and --reprocess are not singer arguments, remove them before parse_args
+    plan_only = '--plan' in sys.argv
+    if plan_only:
+        sys.argv.remove('--plan')
+    reprocess_only = '--reprocess' in sys.argv
+    if reprocess_only:
+        sys.argv.remove('--reprocess')
     parsed_args = singer.utils.parse_args(REQUIRED_CONFIG_KEYS)
 
+    # Offline reprocess from the raw file store (reprocess.py): no GitClient, no network calls
+    if reprocess_only:
+        if not parsed_args.catalog:
+            raise Exception('Error: --reprocess requires --catalog')
+        LOGGER.info('Starting reprocess')
+        reprocess(config=parsed_args.config,
+                  catalog=parsed_args.catalog,
+                  state=parsed_args.state or {})
+        LOGGER.info('Finished reprocess')
+        return
+
+    transport = get_transport(parsed_args.config)
+    if parsed_args.config.get('http_cache'):
+        transport = get_caching_transport(transport, parsed_args.config)
+
     with GitClient(api_token=parsed_args.config['api_token'],
-                   user_agent=parsed_args.config['user_agent']) as client:
+                   user_agent=parsed_args.config['user_agent'],
+                   transport=transport,
+                   api_tokens=parsed_args.config.get('api_tokens'),
+                   coalescer=get_request_coalescer(parsed_args.config),
+                   request_policy=get_request_policy(parsed_args.config)) as client:
 
         state = {}
         if parsed_args.state:
@@ -39,11 +82,54 @@ def main():
 
         if parsed_args.discover:
             do_discover()
+        elif parsed_args.catalog and plan_only:
+            do_plan(client=client,
+                    config=parsed_args.config,
+                    catalog=parsed_args.catalog,
+                    state=state)
         elif parsed_args.catalog:
             sync(client=client,
                  config=parsed_args.config,
                  catalog=parsed_args.catalog,
                  state=state)
 
+
+# Coordinator for sharded syncs across nodes (see shards.py)
+#   extract_covid_data_coordinator --shard-dir DIR init --config config.json --catalog catalog.json [--state state.json]
+#   extract_covid_data_coordinator --shard-dir DIR status
+#   extract_covid_data_coordinator --shard-dir DIR merge > state.json
+# Nodes: extract_covid_data --config config.json --catalog catalog.json, with config shard_dir = DIR
+@singer.utils.handle_top_exception(LOGGER)
+def coordinator_main():
+
+    parser = argparse.ArgumentParser(description='Coordinate a sharded extract_covid_data sync')
+    parser.add_argument('--shard-dir', required=True)
+    subparsers = parser.add_subparsers(dest='command')
+    init_parser = subparsers.add_parser('init')
+    init_parser.add_argument('--config', required=True)
+    init_parser.add_argument('--catalog', required=True)
+    init_parser.add_argument('--state')
+    subparsers.add_parser('status')
+    subparsers.add_parser('merge')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        config = utils.load_json(args.config)
+        catalog = singer.Catalog.load(args.catalog)
+        state = utils.load_json(args.state) if args.state else {}
+        selected_streams = [stream.stream for stream in catalog.get_selected_streams(state)]
+        units = shards.get_units(selected_streams, config)
+        shards.create_plan(args.shard_dir, units, state)
+        output = units
+    elif args.command == 'merge':
+        output, incomplete_streams = shards.merge_states(args.shard_dir)
+        if incomplete_streams:
+            LOGGER.warning('Streams with units not done: {}'.format(incomplete_streams))
+    else:
+        output = shards.get_status(args.shard_dir)
+    json.dump(output, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
 if __name__ == '__main__':
     main()
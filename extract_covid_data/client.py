@@ -1,11 +1,15 @@
 import re
 from datetime import datetime
 import time
+import threading
 import backoff
 import requests
-from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectionError, Timeout
 import singer
-from singer import metrics, utils
+from singer import metrics
+from extract_covid_data.transport import RequestsTransport
+from extract_covid_data.token_pool import TokenPool, RESOURCES
+from extract_covid_data.request_coalescer import get_request_key
 
 LOGGER = singer.get_logger()
 
@@ -106,22 +110,65 @@ def raise_for_error(response):
             raise GitError(error)
 
 
+# Streamed response not returned to the caller (error or retry): release its connection
+def close_stream(response, stream):
+    if stream:
+        response.close()
+
+
 class GitClient(object):
     def __init__(self,
                  api_token,
-                 user_agent=None):
+                 user_agent=None,
+                 transport=None,
+                 api_tokens=None,
+                 coalescer=None,
+                 request_policy=None):
         self.__api_token = api_token
+        # Token pool: api_token plus api_tokens, see token_pool.py
+        tokens = [api_token]
+        for token in api_tokens or []:
+            if token not in tokens:
+                tokens.append(token)
+        self.__token_pool = TokenPool(tokens) if api_token is not None else None
         self.base_url = "https://api.github.com"
         self.__user_agent = user_agent
-        self.__session = requests.Session()
+        # Transport: RequestsTransport (HTTP/1.1 pool) or Http2Transport, see transport.py
+        if transport is None:
+            transport = RequestsTransport()
+        self.__transport = transport
         self.__verified = False
+        # In-run coalescing of identical GET requests (RequestCoalescer), see request_coalescer.py
+        self.__coalescer = coalescer
+        # Timeouts by endpoint type and hedged GETs (RequestPolicy), see request_policy.py
+        self.__request_policy = request_policy
+        # Rate limit quota: requests counted against each resource (core, search) by this run,
+        #   and the last X-RateLimit-* headers received for each resource
+        self.quota_counts = {'core': 0, 'search': 0}
+        self.rate_limits = {}
+        self.__rate_limit_lock = threading.Lock()
 
     def __enter__(self):
         self.__verified = self.check_access()
         return self
 
     def __exit__(self, exception_type, exception_value, traceback):
-        self.__session.close()
+        if self.__token_pool:
+            self.__token_pool.log_usage()
+        if self.__coalescer:
+            self.__coalescer.log_stats()
+        if self.__request_policy:
+            self.__request_policy.log_stats()
+            self.__request_policy.close()
+        self.__transport.close()
+
+    @property
+    def token_usage(self):
+        return self.__token_pool.get_usage()
+
+    @property
+    def requests_saved(self):
+        return self.__coalescer.requests_saved if self.__coalescer else 0
 
     @backoff.on_exception(backoff.expo,
                           Server5xxError,
@@ -130,31 +177,42 @@ class GitClient(object):
     def check_access(self):
         if self.__api_token is None:
             raise Exception('Error: Missing api_token in config.json.')
-        headers = {}
         # Endpoint: simple API call to return a single record (current User) to test access
+        #   for each token; tokens rejected with 401 are rotated out of the pool
         url = 'https://api.github.com/user'
-        if self.__user_agent:
-            headers['User-Agent'] = self.__user_agent
-        headers['Accept'] = 'application/vnd.github.v3+json'
-        # Authentication: https://developer.github.com/v3/#authentication
-        headers['Authorization'] = 'Token {}'.format(self.__api_token)
-        response = self.__session.get(
-            url=url,
-            headers=headers)
-        if response.status_code != 200:
+        response = None
+        for token in self.__token_pool.get_active_tokens():
+            headers = {}
+            if self.__user_agent:
+                headers['User-Agent'] = self.__user_agent
+            headers['Accept'] = 'application/vnd.github.v3+json'
+            # Authentication: https://developer.github.com/v3/#authentication
+            headers['Authorization'] = 'Token {}'.format(token)
+            response = self.__transport.request(
+                'GET',
+                url=url,
+                headers=headers,
+                timeout=self.__request_policy.get_timeout('other') if self.__request_policy else None)
+            if response.status_code == 401 and len(self.__token_pool.tokens) > 1:
+                self.__token_pool.disable(token, 'unauthorized')
+            elif response.status_code != 200:
+                LOGGER.error('Error status_code = {}'.format(response.status_code))
+                raise_for_error(response)
+        if not self.__token_pool.get_active_tokens():
             LOGGER.error('Error status_code = {}'.format(response.status_code))
             raise_for_error(response)
-        else:
-            return True
+            raise Exception('Error: No valid api_token, all tokens were rejected (401 Unauthorized).')
+        return True
 
 
     @backoff.on_exception(backoff.expo,
-                          (Server5xxError, ConnectionError, Server429Error, AbuseDetection403Error),
+                          (Server5xxError, ConnectionError, Timeout, Server429Error, AbuseDetection403Error),
                           max_tries=7,
                           factor=3)
     # Rate Limiting: https://developer.github.com/v3/#rate-limiting
-    @utils.ratelimit(5000, 3600)
-    def request(self, method, url=None, path=None, headers=None, json=None, version=None, **kwargs):
+    #   Client-side limit per token (5000 per hour), see TokenPool.wait
+    def request(self, method, url=None, path=None, headers=None, json=None, version=None, token=None,
+                stream=False, **kwargs):
         if not self.__verified:
             self.__verified = self.check_access()
 
@@ -175,25 +233,34 @@ class GitClient(object):
             version = 'v3'
         headers['Accept'] = 'application/vnd.github.{}+json'.format(version)
 
-        # Authentication: https://developer.github.com/v3/#authentication
-        headers['Authorization'] = 'Token {}'.format(self.__api_token)
-
         if self.__user_agent:
             headers['User-Agent'] = self.__user_agent
 
         if method == 'POST':
             headers['Content-Type'] = 'application/json'
 
-        with metrics.http_request_timer(endpoint) as timer:
-            response = self.__session.request(
-                method=method,
-                url=url,
-                headers=headers,
-                json=json,
-                **kwargs)
-            timer.tags[metrics.Tag.http_status_code] = response.status_code
+        # Token with the most remaining quota for the resource; retried with another token
+        #   on 401 or exhausted quota (TokenPool.update)
+        resource = 'search' if '/search/' in url else 'core'
+        retry_token = True
+        while retry_token:
+            request_token = token or self.__token_pool.get_token(resource)
+            self.__token_pool.wait(request_token)
+            # Authentication: https://developer.github.com/v3/#authentication
+            headers['Authorization'] = 'Token {}'.format(request_token)
+
+            with metrics.http_request_timer(endpoint) as timer:
+                if stream:
+                    kwargs['stream'] = True
+                response = self.send_request(method, url, headers, json, request_token, resource, **kwargs)
+                timer.tags[metrics.Tag.http_status_code] = response.status_code
+
+            retry_token = self.update_rate_limits(request_token, resource, url, response) and token is None
+            if retry_token:
+                close_stream(response, stream)
 
         if response.status_code >= 500:
+            close_stream(response, stream)
             raise Server5xxError()
 
         # Pagination: https://developer.github.com/v3/guides/traversing-with-pagination/
@@ -220,28 +287,125 @@ class GitClient(object):
         # 304: File Not Modified status_code
         if response.status_code == 304:
             LOGGER.warning('304: FILE NOT UPDATED, Stream: {}, URL: {}'.format(endpoint, url))
+            close_stream(response, stream)
             return None, next_url, last_modified_str
         # Catch 403 error with message:
         #  "You have triggered an abuse detection mechanism. Please wait a few minutes before you try again."
         # Reference: https://developer.github.com/v3/#abuse-rate-limits
         if response.status_code == 403:
-            response_json = response.json()
+            try:
+                response_json = response.json()
+            except ValueError:
+                close_stream(response, stream)
+                raise
             response_message = response_json.get('message', '')
             if 'abuse detection mechanism.' in response_message:
+                close_stream(response, stream)
                 # Wait 3 minutes
                 LOGGER.warning('Abuse Detection 403 Error: API triggered an abuse detection mechanism. Waiting 3 mins and trying again.')
                 time.sleep(180) # Wait for 3 minutes
                 raise AbuseDetection403Error(response)
 
-        if response.status_code != 200:
-            raise_for_error(response)
+        # 206: Partial Content (Range request)
+        if response.status_code not in (200, 206):
+            try:
+                raise_for_error(response)
+            except Exception:
+                close_stream(response, stream)
+                raise
+
+        # Streamed download (e.g. tarball): the response, read with iter_content, not its json
+        if stream:
+            return response, next_url, last_modified_str
 
         response_json = response.json()
 
         return response_json, next_url, last_modified_str
 
+    # Request with the timeout of the endpoint type; GET requests (not streamed) may be hedged,
+    #   the hedge counts against the rate limit of the token: the response not used (the primary
+    #   or the hedge) goes through the same rate limit bookkeeping as the response used
+    def send_request(self, method, url, headers, json, request_token, resource, **kwargs):
+        def transport_request(timeout):
+            return self.__transport.request(
+                method=method,
+                url=url,
+                headers=headers,
+                json=json,
+                timeout=timeout,
+                **kwargs)
+
+        def on_hedge():
+            self.__token_pool.wait(request_token)
+
+        def on_discarded(response):
+            self.update_rate_limits(request_token, resource, url, response)
+
+        if self.__request_policy is None:
+            return transport_request(None)
+        return self.__request_policy.send(
+            transport_request,
+            url,
+            hedgeable=(method == 'GET' and not kwargs.get('stream')),
+            on_hedge=on_hedge,
+            on_discarded=on_discarded)
+
+    # Token quota (X-RateLimit-* headers) and run quota counts from a response; returns True if
+    #   the request should be retried with another token (TokenPool.update). Hedged responses
+    #   complete in the RequestPolicy threads.
+    def update_rate_limits(self, request_token, resource, url, response):
+        with self.__rate_limit_lock:
+            retry_token = self.__token_pool.update(request_token, resource, response)
+            self.update_quota(url, response)
+        return retry_token
+
+    # Cached responses and 304 Not Modified do not count against the rate limit,
+    #   nor does the /rate_limit endpoint
+    def update_quota(self, url, response):
+        resource = response.headers.get('X-RateLimit-Resource')
+        if not resource:
+            resource = 'search' if '/search/' in url else 'core'
+        # Remaining quota of the token pool
+        rate_limit = self.__token_pool.get_rate_limit(resource)
+        if rate_limit:
+            self.rate_limits[resource] = rate_limit
+        if getattr(response, 'from_cache', False) or response.status_code == 304:
+            return
+        if url.rstrip('/').endswith('/rate_limit'):
+            return
+        self.quota_counts[resource] = self.quota_counts.get(resource, 0) + 1
+
+    # Remaining quota per resource, summed over the token pool:
+    #   https://developer.github.com/v3/rate_limit/
+    def get_rate_limit(self):
+        for token in self.__token_pool.get_active_tokens():
+            response_json, _, _ = self.get(path='rate_limit', endpoint='rate_limit', token=token)
+            resources = (response_json or {}).get('resources', {})
+            for resource in RESOURCES:
+                if resource in resources:
+                    self.__token_pool.set_rate_limit(
+                        token,
+                        resource,
+                        limit=resources[resource].get('limit'),
+                        remaining=resources[resource].get('remaining'),
+                        reset=resources[resource].get('reset'))
+        for resource in RESOURCES:
+            rate_limit = self.__token_pool.get_rate_limit(resource)
+            if rate_limit:
+                self.rate_limits[resource] = rate_limit
+        return self.rate_limits
+
     def get(self, url=None, path=None, headers=None, **kwargs):
-        return self.request('GET', url=url, path=path, headers=headers, **kwargs)
+        # Requests with a given token (e.g. /rate_limit per token) and streamed downloads
+        #   are not coalesced
+        if self.__coalescer is None or kwargs.get('token') or kwargs.get('stream'):
+            return self.request('GET', url=url, path=path, headers=headers, **kwargs)
+        if not url and path:
+            url = '{}/{}'.format(self.base_url, path)
+        request_key = get_request_key(url, headers) + (kwargs.get('version'),)
+        return self.__coalescer.get(
+            request_key,
+            lambda: self.request('GET', url=url, headers=headers, **kwargs))
 
     def post(self, url=None, path=None, headers=None, **kwargs):
         return self.request('POST', url=url, path=path, headers=headers, **kwargs)
@@ -0,0 +1,131 @@
+import posixpath
+from urllib.parse import parse_qs, quote
+import singer
+from singer.utils import strptime_to_utc
+
+LOGGER = singer.get_logger()
+
+# Commit-log change detection (config commit_change_detection = true)
+#   Instead of walking the code search results (ordered by indexed date, not commit date),
+#   list the commits since the bookmark: /repos/{owner}/{repo}/commits?since=<bookmark>
+#   (commits at the bookmark itself, returned by since=, are already synced and dropped)
+#   and the files changed by each commit: /repos/{owner}/{repo}/commits/{sha}
+#   The changed paths matching the stream's search_path qualifiers
+#   (repo, path, filename, extension, -filename) are returned as search items,
+#   with last_modified set from the commit date (no per-file commits call is needed).
+
+
+# Parse search_path qualifiers, e.g.
+#   search/code?q=-filename:ecdc+path:dataset/daily+extension:csv+repo:covid19-eu-zh/covid19-eu-data&sort=...
+def get_search_filters(search_path):
+    query = search_path.split('?', 1)[1] if '?' in search_path else ''
+    search_query = parse_qs(query).get('q', [''])[0]
+    filters = {
+        'repo': None,
+        'path': None,
+        'filename': None,
+        'extension': None,
+        'exclude_filenames': []
+    }
+    for term in search_query.split():
+        if ':' not in term:
+            continue
+        qualifier, value = term.split(':', 1)
+        if qualifier == '-filename':
+            filters['exclude_filenames'].append(value.lower())
+        elif qualifier in ('repo', 'path', 'filename', 'extension'):
+            filters[qualifier] = value
+    return filters
+
+
+def match_search_filters(filters, file_path):
+    file_name = posixpath.basename(file_path).lower()
+    file_dir = posixpath.dirname(file_path)
+    path = filters.get('path')
+    if path and not (file_dir == path or file_dir.startswith(path + '/')):
+        return False
+    filename = filters.get('filename')
+    if filename and filename.lower() not in file_name:
+        return False
+    extension = filters.get('extension')
+    if extension and not file_name.endswith('.{}'.format(extension.lower())):
+        return False
+    for exclude_filename in filters.get('exclude_filenames', []):
+        if exclude_filename in file_name:
+            return False
+    return True
+
+
+# Files changed by one commit (the commit files list is paginated)
+def get_commit_files(client, stream_name, commit_url):
+    files = []
+    next_url = commit_url
+    while next_url is not None:
+        commit_detail, next_url, _ = client.get(
+            url=next_url,
+            endpoint='{}_commit_files'.format(stream_name))
+        if not commit_detail:
+            break
+        files.extend(commit_detail.get('files', []))
+    return files
+
+
+# Returns search-like items for the files changed since the bookmark (newest first)
+def get_changed_files(client, stream_name, search_path, since, exclude_files=None):
+    filters = get_search_filters(search_path)
+    if not filters.get('repo'):
+        raise Exception('Error: commit_change_detection requires repo: in search_path, stream: {}'.format(
+            stream_name))
+    owner, repository = filters['repo'].split('/', 1)
+    exclude_files = exclude_files or []
+
+    next_url = '{}/repos/{}/{}/commits?since={}&per_page=100'.format(
+        client.base_url, owner, repository, since)
+    if filters.get('path'):
+        next_url = '{}&path={}'.format(next_url, quote(filters['path']))
+
+    since_dttm = strptime_to_utc(since)
+    seen_paths = set()
+    items = []
+    commit_count = 0
+    while next_url is not None:
+        LOGGER.info('Commit log URL for Stream {}: {}'.format(stream_name, next_url))
+        commits, next_url, _ = client.get(
+            url=next_url,
+            endpoint='{}_commit_log'.format(stream_name))
+        if not commits:
+            break
+        for commit in commits:
+            commit_count = commit_count + 1
+            commit_date = commit.get('commit', {}).get('committer', {}).get('date')
+            # since= includes the commit at the bookmark (already synced): only later commits
+            if commit_date and strptime_to_utc(commit_date) <= since_dttm:
+                continue
+            commit_url = '{}/repos/{}/{}/commits/{}'.format(
+                client.base_url, owner, repository, commit.get('sha'))
+            for commit_file in get_commit_files(client, stream_name, commit_url):
+                file_path = commit_file.get('filename')
+                # Commits are newest first: the first commit for a path has its last change
+                if file_path in seen_paths:
+                    continue
+                seen_paths.add(file_path)
+                file_name = posixpath.basename(file_path)
+                if commit_file.get('status') == 'removed' or file_name in exclude_files:
+                    continue
+                if not match_search_filters(filters, file_path):
+                    continue
+                items.append({
+                    'name': file_name,
+                    'path': file_path,
+                    'sha': commit_file.get('sha'),
+                    'git_url': '{}/repos/{}/{}/git/blobs/{}'.format(
+                        client.base_url, owner, repository, commit_file.get('sha')),
+                    'html_url': commit_file.get('blob_url'),
+                    'repository': {'name': repository, 'owner': {'login': owner}},
+                    'last_modified': commit_date
+                })
+
+    items.sort(key=lambda item: item.get('last_modified') or '', reverse=True)
+    LOGGER.info('Stream: {}, commits since {}: {}, changed files: {}'.format(
+        stream_name, since, commit_count, len(items)))
+    return items
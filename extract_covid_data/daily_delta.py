@@ -0,0 +1,108 @@
+import json
+from datetime import datetime, timedelta
+import singer
+
+LOGGER = singer.get_logger()
+
+# Daily deltas of cumulative series (config daily_deltas = true), for streams with daily_delta
+#   (streams.py): the records get <field>_delta = value - value of the previous day, for each
+#   cumulative field, per location key. Per location, the values of the last history days (up to
+#   the location's last date) are kept, in memory and in the STATE (with the bookmark, so a run
+#   that restarts from an older state also restarts the deltas from it):
+#   state['daily_deltas'][stream_name] = {location key: {date: values}}
+#   The delta is computed against the previous date of the row, whatever the order of the rows
+#   (e.g. a corrected older daily report, or a row re-emitted for the same date). It is null when
+#   the previous day is not known (the first row of a location, or a gap), and left out of the
+#   record (not emitted) for a row before the location's last date whose previous day is no
+#   longer kept. A corrected day does not change the delta already emitted for the next day.
+#   Multi-file streams are synced oldest first from the commit log (sync.py) and are not split
+#   into shard file partitions (shards.py). A single file synced in full (not append-only new
+#   rows) restarts from an empty state.
+# config.json:
+#   daily_deltas: Add the daily delta fields, default = false
+#   daily_delta_history_days: Days of values kept per location, default = 7
+DEFAULT_HISTORY_DAYS = 7
+STATE_KEY = 'daily_deltas'
+
+
+def is_enabled(config, endpoint_config):
+    return bool((config or {}).get('daily_deltas', False)) and bool(endpoint_config.get('daily_delta'))
+
+
+def get_delta_field(field):
+    return '{}_delta'.format(field)
+
+
+def get_previous_date(date):
+    try:
+        return (datetime.strptime(date[:10], '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+# Cumulative values before the Transformer (e.g. nytimes csv strings): int, float or None
+def to_number(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+
+class DailyDeltas(object):
+    # state: the sync STATE, or None (reprocess: from an empty state, not kept)
+    def __init__(self, state, stream_name, endpoint_config, config=None):
+        self.state = state
+        self.stream_name = stream_name
+        self.key_fields = endpoint_config['daily_delta']['key']
+        self.value_fields = endpoint_config['daily_delta']['values']
+        self.history_days = (config or {}).get('daily_delta_history_days', DEFAULT_HISTORY_DAYS)
+        self.locations = dict(((state or {}).get(STATE_KEY) or {}).get(stream_name) or {})
+
+    # Single file synced in full: deltas from the first row of the file
+    def reset(self):
+        self.locations = {}
+
+    def enrich(self, record):
+        date = record.get('date')
+        date = date[:10] if isinstance(date, str) else None
+        previous_date = get_previous_date(date)
+        if not previous_date:
+            for field in self.value_fields:
+                record[get_delta_field(field)] = None
+            return record
+        location_key = json.dumps([record.get(field) for field in self.key_fields], default=str)
+        values = [to_number(record.get(field)) for field in self.value_fields]
+        history = self.locations.setdefault(location_key, {})
+        previous_values = history.get(previous_date)
+        # Older row, previous day no longer kept: the delta emitted before is not overwritten
+        if previous_values is None and history and date <= max(history) and previous_date < min(history):
+            history[date] = values
+            self.prune(history)
+            return record
+        for index, field in enumerate(self.value_fields):
+            delta = None
+            if previous_values and values[index] is not None and previous_values[index] is not None:
+                delta = values[index] - previous_values[index]
+            record[get_delta_field(field)] = delta
+        history[date] = values
+        self.prune(history)
+        return record
+
+    # Keep the last history_days dates of the location
+    def prune(self, history):
+        if len(history) <= self.history_days:
+            return
+        for date in sorted(history)[:len(history) - self.history_days]:
+            del history[date]
+
+    # Before the STATE message (checkpoint or bookmark)
+    def write(self):
+        if self.state is None:
+            return
+        self.state.setdefault(STATE_KEY, {})[self.stream_name] = self.locations
+        LOGGER.info('DAILY DELTAS, Stream: {}, locations: {}'.format(self.stream_name, len(self.locations)))
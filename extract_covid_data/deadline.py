@@ -0,0 +1,128 @@
+import time
+import singer
+
+LOGGER = singer.get_logger()
+
+# Deadline-aware sync: the run time (config max_runtime) and the per-stream time budgets
+#   (config stream_max_runtime) are checked between streams (sync) and between files
+#   (sync_endpoint). No new file is started when the time left is less than the expected time of
+#   the next file (the longest file of the stream so far, at least max_runtime_reserve): the
+#   stream writes its checkpoint (resumable STATE, see write_checkpoint) instead of its bookmark.
+#   With resume_index_rows, a file still in progress at the deadline is abandoned at its next
+#   row checkpoint (the checkpoint resumes at that row).
+#   A stream out of budget is stopped and the sync continues with the next stream; at the run
+#   deadline the sync stops, reports the remaining work and exits 0.
+# config.json:
+#   max_runtime: Seconds for the run, default = None (no deadline)
+#   stream_max_runtime: Seconds per stream, e.g. {"jh_csse_daily": 600}, default = None
+#   max_runtime_reserve: Seconds kept in reserve to finish a file and write the state, default = 30
+DEFAULT_RESERVE = 30
+
+
+# Raised at a row checkpoint when the deadline has passed (mid-file abandon)
+class DeadlineExceeded(Exception):
+    pass
+
+
+class SyncDeadline(object):
+    def __init__(self, config):
+        self.start_time = time.time()
+        self.max_runtime = config.get('max_runtime')
+        self.stream_max_runtime = config.get('stream_max_runtime') or {}
+        self.reserve = config.get('max_runtime_reserve', DEFAULT_RESERVE)
+        self.stream_start_times = {}
+        self.longest_files = {}
+        self.file_start_time = None
+        # Stopped streams: stream_name -> {reason, resume point}
+        self.stopped_streams = {}
+        self.run_stopped = False
+
+    def start_stream(self, stream_name):
+        self.stream_start_times[stream_name] = time.time()
+        self.stopped_streams.pop(stream_name, None)
+
+    def start_file(self):
+        self.file_start_time = time.time()
+
+    def end_file(self, stream_name):
+        if self.file_start_time is None:
+            return
+        seconds = time.time() - self.file_start_time
+        self.longest_files[stream_name] = max(self.longest_files.get(stream_name, 0), seconds)
+        self.file_start_time = None
+
+    # Seconds left for the run and for the stream budget (None if unlimited)
+    def get_budgets_left(self, stream_name=None):
+        now = time.time()
+        run_left = None
+        if self.max_runtime:
+            run_left = self.max_runtime - (now - self.start_time)
+        stream_left = None
+        stream_runtime = self.stream_max_runtime.get(stream_name)
+        if stream_runtime and stream_name in self.stream_start_times:
+            stream_left = stream_runtime - (now - self.stream_start_times[stream_name])
+        return run_left, stream_left
+
+    # Seconds left for the stream (the smallest budget), None if unlimited
+    def get_time_left(self, stream_name=None):
+        budgets_left = [left for left in self.get_budgets_left(stream_name) if left is not None]
+        return min(budgets_left) if budgets_left else None
+
+    def is_run_over(self):
+        if self.run_stopped:
+            return True
+        if self.max_runtime and self.max_runtime - (time.time() - self.start_time) < self.reserve:
+            self.run_stopped = True
+        return self.run_stopped
+
+    # Between files: is there time for the next file of the stream?
+    def should_stop(self, stream_name):
+        time_left = self.get_time_left(stream_name)
+        if time_left is None:
+            return False
+        return time_left < max(self.reserve, self.longest_files.get(stream_name, 0))
+
+    # Within a file (row checkpoints): has the deadline passed?
+    def is_expired(self, stream_name):
+        time_left = self.get_time_left(stream_name)
+        return time_left is not None and time_left <= 0
+
+    def stop_stream(self, stream_name, resume_point):
+        run_left, stream_left = self.get_budgets_left(stream_name)
+        if stream_left is None or (run_left is not None and run_left <= stream_left):
+            reason = 'max_runtime'
+            time_left = run_left
+            self.run_stopped = True
+        else:
+            reason = 'stream_max_runtime'
+            time_left = stream_left
+        self.stopped_streams[stream_name] = dict(resume_point, reason=reason)
+        LOGGER.warning('DEADLINE, Stream: {} stopped ({}), seconds left: {}, resume at page: {}, processed files: {}'.format(
+            stream_name, reason, round(time_left, 1), resume_point.get('page'),
+            resume_point.get('processed_files')))
+
+    def is_stopped(self, stream_name):
+        return stream_name in self.stopped_streams
+
+    # Remaining work: stopped streams (with their resume point) and streams not started
+    def get_remaining(self, stream_names):
+        remaining = []
+        for stream_name in stream_names:
+            if stream_name in self.stopped_streams:
+                remaining.append(dict(self.stopped_streams[stream_name], stream=stream_name))
+            elif stream_name not in self.stream_start_times:
+                remaining.append({'stream': stream_name, 'reason': 'not_started'})
+        return remaining
+
+    def log_remaining(self, stream_names):
+        remaining = self.get_remaining(stream_names)
+        if not remaining:
+            return
+        LOGGER.warning('DEADLINE, run time: {} seconds, remaining work for the next run: {}'.format(
+            round(time.time() - self.start_time, 1), remaining))
+
+
+def get_deadline(config):
+    if not config.get('max_runtime') and not config.get('stream_max_runtime'):
+        return None
+    return SyncDeadline(config)
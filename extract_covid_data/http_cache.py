@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import sqlite3
+import argparse
+import threading
+from requests.structures import CaseInsensitiveDict
+import singer
+from extract_covid_data import local_store
+from extract_covid_data.transport import TransportResponse
+
+LOGGER = singer.get_logger()
+
+# Persistent HTTP response cache (SQLite) for GET requests, wrapping the GitClient transport
+#   Fresh entries (younger than the endpoint TTL) are returned without a request.
+#   Older entries are revalidated with their ETag / Last-Modified validators:
+#   a 304 Not Modified returns the cached response (and does not count against the rate limit).
+# config.json:
+#   http_cache: Enable the cache, default = false
+#   http_cache_ttl: Seconds an entry is fresh, per endpoint type; endpoint types not listed are
+#       not cached, default = {"search": 0, "commits": 0} (always revalidate)
+#   http_cache_max_bytes: Maximum size of cached content, least recently used entries are
+#       evicted first, default = 100 MB
+#   cache_dir: Directory of the cache database (http_cache.sqlite), see local_store.py
+DEFAULT_TTL = {
+    'search': 0,
+    'commits': 0
+}
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+CACHE_FILE_NAME = 'http_cache.sqlite'
+
+# Request headers that change the response, part of the cache key
+KEY_HEADERS = ('Accept', 'If-Modified-Since', 'Range')
+# Response headers stored with the content
+STORED_HEADERS = ('Link', 'Last-Modified', 'ETag', 'Content-Type')
+
+
+def get_endpoint_type(url):
+    if '/search/' in url:
+        return 'search'
+    if '/git/blobs/' in url:
+        return 'blobs'
+    if '/commits' in url:
+        return 'commits'
+    return 'other'
+
+
+def get_cache_key(url, headers):
+    headers = CaseInsensitiveDict(headers or {})
+    key_parts = [url]
+    for header in KEY_HEADERS:
+        key_parts.append('{}: {}'.format(header, headers.get(header, '')))
+    return hashlib.sha256('\n'.join(key_parts).encode('utf-8')).hexdigest()
+
+
+class ResponseCache(object):
+    def __init__(self, cache_path, max_bytes=DEFAULT_MAX_BYTES):
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.cache_path = cache_path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                cache_key TEXT PRIMARY KEY,
+                url TEXT,
+                endpoint_type TEXT,
+                status_code INTEGER,
+                headers TEXT,
+                content BLOB,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER,
+                stored_at REAL,
+                accessed_at REAL,
+                hits INTEGER DEFAULT 0)""")
+        self.connection.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)')
+        self.connection.commit()
+
+    def get(self, cache_key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT url, status_code, headers, content, etag, last_modified, stored_at '
+                'FROM responses WHERE cache_key = ?', (cache_key,)).fetchone()
+        if row is None:
+            return None
+        url, status_code, headers, content, etag, last_modified, stored_at = row
+        return {
+            'url': url,
+            'status_code': status_code,
+            'headers': json.loads(headers),
+            'content': content,
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': stored_at
+        }
+
+    def touch(self, cache_key, revalidated=False):
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.connection.execute(
+                    'UPDATE responses SET accessed_at = ?, stored_at = ?, hits = hits + 1 '
+                    'WHERE cache_key = ?', (now, now, cache_key))
+            else:
+                self.connection.execute(
+                    'UPDATE responses SET accessed_at = ?, hits = hits + 1 WHERE cache_key = ?',
+                    (now, cache_key))
+            self.connection.commit()
+
+    def put(self, cache_key, url, endpoint_type, response):
+        headers = {}
+        for header in STORED_HEADERS:
+            if response.headers.get(header):
+                headers[header] = response.headers.get(header)
+        content = response.content or b''
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (cache_key, url, endpoint_type, status_code, '
+                'headers, content, etag, last_modified, size, stored_at, accessed_at, hits) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)', (
+                    cache_key,
+                    url,
+                    endpoint_type,
+                    response.status_code,
+                    json.dumps(headers),
+                    content,
+                    headers.get('ETag'),
+                    headers.get('Last-Modified'),
+                    len(content),
+                    now,
+                    now))
+            self.connection.commit()
+        self.evict()
+
+    # Size-based eviction: delete least recently used entries until under max_bytes
+    def evict(self):
+        with self.lock:
+            total_size = self.connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total_size <= self.max_bytes:
+                return 0
+            evicted = 0
+            rows = self.connection.execute(
+                'SELECT cache_key, size FROM responses ORDER BY accessed_at').fetchall()
+            for cache_key, size in rows:
+                if total_size <= self.max_bytes:
+                    break
+                self.connection.execute('DELETE FROM responses WHERE cache_key = ?', (cache_key,))
+                total_size = total_size - size
+                evicted = evicted + 1
+            self.connection.commit()
+        LOGGER.info('HTTP cache evicted {} entries'.format(evicted))
+        return evicted
+
+    def purge(self, endpoint_type=None, older_than=None):
+        query = 'DELETE FROM responses WHERE 1 = 1'
+        params = []
+        if endpoint_type:
+            query = query + ' AND endpoint_type = ?'
+            params.append(endpoint_type)
+        if older_than is not None:
+            query = query + ' AND stored_at < ?'
+            params.append(time.time() - older_than)
+        with self.lock:
+            deleted = self.connection.execute(query, params).rowcount
+            self.connection.commit()
+            self.connection.execute('VACUUM')
+        return deleted
+
+    def stats(self):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT endpoint_type, COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(hits), 0), '
+                'MIN(stored_at), MAX(stored_at) FROM responses GROUP BY endpoint_type').fetchall()
+        return [{
+            'endpoint_type': endpoint_type,
+            'entries': entries,
+            'bytes': size,
+            'hits': hits,
+            'oldest': oldest,
+            'newest': newest
+        } for endpoint_type, entries, size, hits, oldest, newest in rows]
+
+    def list_entries(self, endpoint_type=None):
+        query = 'SELECT url, endpoint_type, status_code, size, hits, stored_at, accessed_at FROM responses'
+        params = []
+        if endpoint_type:
+            query = query + ' WHERE endpoint_type = ?'
+            params.append(endpoint_type)
+        with self.lock:
+            rows = self.connection.execute(query + ' ORDER BY accessed_at DESC', params).fetchall()
+        return [{
+            'url': url,
+            'endpoint_type': row_endpoint_type,
+            'status_code': status_code,
+            'bytes': size,
+            'hits': hits,
+            'stored_at': stored_at,
+            'accessed_at': accessed_at
+        } for url, row_endpoint_type, status_code, size, hits, stored_at, accessed_at in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+class CachingTransport(object):
+    # Wraps a transport (transport.py); only GET requests for endpoint types with a TTL are cached
+    def __init__(self, transport, cache, ttl=None):
+        self.transport = transport
+        self.cache = cache
+        self.ttl = DEFAULT_TTL if ttl is None else ttl
+        self.counts = {'hit': 0, 'revalidated': 0, 'miss': 0}
+
+    def cached_response(self, entry):
+        return TransportResponse(
+            status_code=entry['status_code'],
+            headers=CaseInsensitiveDict(entry['headers']),
+            content=entry['content'],
+            reason='OK (cached)' if entry['status_code'] == 200 else 'Not Modified (cached)',
+            url=entry['url'],
+            from_cache=True)
+
+    def request(self, method, url, headers=None, json=None, timeout=None, **kwargs):
+        endpoint_type = get_endpoint_type(url)
+        ttl = self.ttl.get(endpoint_type)
+        if method != 'GET' or ttl is None:
+            return self.transport.request(method, url, headers=headers, json=json, timeout=timeout, **kwargs)
+
+        cache_key = get_cache_key(url, headers)
+        entry = self.cache.get(cache_key)
+        if entry and time.time() - entry['stored_at'] < ttl:
+            self.cache.touch(cache_key)
+            self.counts['hit'] = self.counts['hit'] + 1
+            return self.cached_response(entry)
+
+        # Revalidate with the stored validators
+        request_headers = dict(headers or {})
+        validated = False
+        if entry and entry['etag']:
+            request_headers['If-None-Match'] = entry['etag']
+            validated = True
+        elif entry and entry['last_modified'] and 'If-Modified-Since' not in request_headers:
+            request_headers['If-Modified-Since'] = entry['last_modified']
+            validated = True
+
+        response = self.transport.request(
+            method, url, headers=request_headers, json=json, timeout=timeout, **kwargs)
+        if validated and response.status_code == 304:
+            self.cache.touch(cache_key, revalidated=True)
+            self.counts['revalidated'] = self.counts['revalidated'] + 1
+            return self.cached_response(entry)
+
+        self.counts['miss'] = self.counts['miss'] + 1
+        if response.status_code in (200, 304):
+            self.cache.put(cache_key, url, endpoint_type, response)
+        return response
+
+    def close(self):
+        LOGGER.info('HTTP cache hits: {}, revalidated (304): {}, misses: {}'.format(
+            self.counts['hit'], self.counts['revalidated'], self.counts['miss']))
+        self.cache.close()
+        self.transport.close()
+
+
+def get_cache_path(config):
+    return os.path.join(local_store.get_cache_dir(config), CACHE_FILE_NAME)
+
+
+def get_caching_transport(transport, config):
+    cache = ResponseCache(
+        get_cache_path(config),
+        max_bytes=config.get('http_cache_max_bytes', DEFAULT_MAX_BYTES))
+    return CachingTransport(transport, cache, ttl=config.get('http_cache_ttl'))
+
+
+# CLI: inspect and purge the cache
+#   extract_covid_data_cache [--cache-dir DIR] stats
+#   extract_covid_data_cache [--cache-dir DIR] list [--endpoint-type TYPE]
+#   extract_covid_data_cache [--cache-dir DIR] purge [--endpoint-type TYPE] [--older-than SECONDS]
+def main():
+    parser = argparse.ArgumentParser(description='Inspect and purge the extract_covid_data HTTP cache')
+    parser.add_argument('--cache-dir', default=local_store.DEFAULT_CACHE_DIR)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('stats')
+    list_parser = subparsers.add_parser('list')
+    list_parser.add_argument('--endpoint-type')
+    purge_parser = subparsers.add_parser('purge')
+    purge_parser.add_argument('--endpoint-type')
+    purge_parser.add_argument('--older-than', type=float)
+    args = parser.parse_args()
+
+    cache_path = get_cache_path({'cache_dir': args.cache_dir})
+    if not os.path.exists(cache_path):
+        sys.stderr.write('No cache at: {}\n'.format(cache_path))
+        return
+    cache = ResponseCache(cache_path)
+    if args.command == 'list':
+        output = cache.list_entries(endpoint_type=args.endpoint_type)
+    elif args.command == 'purge':
+        output = {'deleted': cache.purge(endpoint_type=args.endpoint_type, older_than=args.older_than)}
+    else:
+        output = cache.stats()
+    cache.close()
+    json.dump(output, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
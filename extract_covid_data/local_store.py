@@ -0,0 +1,49 @@
+import os
+import json
+import singer
+
+LOGGER = singer.get_logger()
+
+# Local store: small JSON files kept between syncs on the machine running the tap
+#   (e.g. per-key row hashes for change detection)
+# config.json:
+#   cache_dir: Directory for the local store, default = .extract_covid_data in the working directory
+DEFAULT_CACHE_DIR = '.extract_covid_data'
+
+
+def get_cache_dir(config):
+    if not config:
+        return DEFAULT_CACHE_DIR
+    return config.get('cache_dir', DEFAULT_CACHE_DIR)
+
+
+def get_store_path(cache_dir, name):
+    return os.path.join(cache_dir, name)
+
+
+def read_json(cache_dir, name, default=None):
+    store_path = get_store_path(cache_dir, name)
+    if not os.path.exists(store_path):
+        return default
+    try:
+        with open(store_path) as file:
+            return json.load(file)
+    except ValueError as err:
+        LOGGER.warning('Local store file unreadable, ignoring: {}, {}'.format(store_path, err))
+        return default
+
+
+# Write to a temp file and rename, so that an interrupted run never leaves a partial file
+def write_json(cache_dir, name, value):
+    store_path = get_store_path(cache_dir, name)
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    tmp_path = '{}.tmp'.format(store_path)
+    with open(tmp_path, 'w') as file:
+        json.dump(value, file, separators=(',', ':'))
+    os.replace(tmp_path, store_path)
+
+
+def delete_json(cache_dir, name):
+    store_path = get_store_path(cache_dir, name)
+    if os.path.exists(store_path):
+        os.remove(store_path)
@@ -0,0 +1,204 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+import singer
+from singer import metrics, utils
+from extract_covid_data import local_store
+
+LOGGER = singer.get_logger()
+
+# Memory instrumentation (opt-in): tracemalloc traced memory and sampled RSS per stage of each
+#   file in sync_endpoint: fetch (blob API response), decode (base64), parse (decode text and
+#   csv rows), transform_emit (transform, Transformer and RECORD messages, interleaved per row),
+#   with per-file and per-stream peak and retained memory and the top allocation sites.
+#   Results are logged as Singer metrics (memory_peak_bytes, memory_retained_bytes,
+#   memory_rss_peak_bytes) and written to a JSON report at the end of the sync.
+# config.json:
+#   memory_profile: Enable the instrumentation, default = false (tracemalloc slows the sync)
+#   memory_profile_report: Report path, default = <cache_dir>/memory_report.json
+#   memory_profile_top: Number of top allocation sites per stream, default = 10
+#   memory_profile_frames: Traceback frames per allocation, default = 1
+#   memory_profile_interval: RSS sampling interval in seconds, default = 0.05
+DEFAULT_TOP = 10
+DEFAULT_FRAMES = 1
+DEFAULT_SAMPLE_INTERVAL = 0.05
+REPORT_FILE_NAME = 'memory_report.json'
+
+PROFILER = None
+
+
+def get_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def log_memory_metric(metric, value, tags):
+    if value is not None:
+        metrics.log(LOGGER, metrics.Point('gauge', metric, value, tags))
+
+
+class MemoryProfiler(object):
+    def __init__(self, config):
+        self.config = config
+        config = config or {}
+        self.enabled = bool(config.get('memory_profile', False))
+        self.top_count = config.get('memory_profile_top', DEFAULT_TOP)
+        self.report_path = config.get('memory_profile_report') or local_store.get_store_path(
+            local_store.get_cache_dir(config), REPORT_FILE_NAME)
+        self.sample_interval = config.get('memory_profile_interval', DEFAULT_SAMPLE_INTERVAL)
+        self.files = []
+        self.streams = {}
+        self.current_file = None
+        self.current_stage = None
+        self.rss_peak = 0
+        self.sampler = None
+        if self.enabled:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(config.get('memory_profile_frames', DEFAULT_FRAMES))
+            self.sampler = threading.Thread(target=self.sample_rss, daemon=True)
+            self.sampler.start()
+            LOGGER.info('Memory profile enabled, report: {}'.format(self.report_path))
+
+    # RSS sampler thread: the max RSS seen since the current stage started
+    def sample_rss(self):
+        while self.enabled:
+            rss = get_rss()
+            if rss and rss > self.rss_peak:
+                self.rss_peak = rss
+            time.sleep(self.sample_interval)
+
+    def get_stream(self, stream_name):
+        if stream_name not in self.streams:
+            self.streams[stream_name] = {
+                'start_bytes': tracemalloc.get_traced_memory()[0],
+                'files': 0,
+                'peak_bytes': 0,
+                'rss_peak_bytes': 0,
+                'top_stage': None,
+                'top_sites': []
+            }
+        return self.streams[stream_name]
+
+    def start_file(self, stream_name, file_path):
+        if not self.enabled:
+            return
+        self.get_stream(stream_name)
+        self.current_file = {
+            'stream': stream_name,
+            'file': file_path,
+            'start_bytes': tracemalloc.get_traced_memory()[0],
+            'stages': {}
+        }
+
+    def start_stage(self, stage):
+        if not self.enabled or self.current_file is None:
+            return
+        # Peak per stage (Python 3.9+; otherwise the peak since tracing started)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self.rss_peak = get_rss() or 0
+        self.current_stage = {
+            'stage': stage,
+            'start_bytes': tracemalloc.get_traced_memory()[0],
+            'start_time': time.time()
+        }
+
+    def end_stage(self):
+        if not self.enabled or self.current_stage is None:
+            return
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        stage = self.current_stage['stage']
+        stream_name = self.current_file['stream']
+        result = {
+            'peak_bytes': peak_bytes,
+            'peak_increase_bytes': peak_bytes - self.current_stage['start_bytes'],
+            'retained_bytes': current_bytes - self.current_stage['start_bytes'],
+            'rss_peak_bytes': self.rss_peak or None,
+            'seconds': round(time.time() - self.current_stage['start_time'], 3)
+        }
+        self.current_file['stages'][stage] = result
+        self.current_stage = None
+        tags = {'stream': stream_name, 'file': self.current_file['file'], 'stage': stage}
+        log_memory_metric('memory_peak_bytes', result['peak_bytes'], tags)
+        log_memory_metric('memory_retained_bytes', result['retained_bytes'], tags)
+        log_memory_metric('memory_rss_peak_bytes', result['rss_peak_bytes'], tags)
+
+        # Top allocation sites: snapshot at the end of the stage with the stream's highest peak
+        stream_result = self.get_stream(stream_name)
+        if peak_bytes > stream_result['peak_bytes']:
+            stream_result['peak_bytes'] = peak_bytes
+            stream_result['top_stage'] = {'file': self.current_file['file'], 'stage': stage}
+            stream_result['top_sites'] = self.get_top_sites()
+        stream_result['rss_peak_bytes'] = max(stream_result['rss_peak_bytes'], self.rss_peak or 0)
+
+    def get_top_sites(self):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__)))
+        return [{
+            'site': '{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+            'size_bytes': stat.size,
+            'count': stat.count
+        } for stat in snapshot.statistics('lineno')[:self.top_count]]
+
+    def end_file(self, record_count=None):
+        if not self.enabled or self.current_file is None:
+            return
+        self.end_stage()
+        current_file = self.current_file
+        current_file['records'] = record_count
+        current_file['retained_bytes'] = tracemalloc.get_traced_memory()[0] - current_file['start_bytes']
+        current_file['peak_bytes'] = max(
+            [stage['peak_bytes'] for stage in current_file['stages'].values()] or [0])
+        del current_file['start_bytes']
+        self.files.append(current_file)
+        self.get_stream(current_file['stream'])['files'] += 1
+        self.current_file = None
+        LOGGER.info('MEMORY, Stream: {}, file: {}, peak: {} bytes, retained: {} bytes'.format(
+            current_file['stream'], current_file['file'], current_file['peak_bytes'],
+            current_file['retained_bytes']))
+
+    def end_stream(self, stream_name):
+        if not self.enabled:
+            return
+        stream_result = self.get_stream(stream_name)
+        stream_result['retained_bytes'] = tracemalloc.get_traced_memory()[0] - stream_result['start_bytes']
+        tags = {'stream': stream_name}
+        log_memory_metric('memory_peak_bytes', stream_result['peak_bytes'], tags)
+        log_memory_metric('memory_retained_bytes', stream_result['retained_bytes'], tags)
+        log_memory_metric('memory_rss_peak_bytes', stream_result['rss_peak_bytes'] or None, tags)
+
+    def write_report(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        streams = {}
+        for stream_name, stream_result in self.streams.items():
+            streams[stream_name] = {key: value for key, value in stream_result.items()
+                                    if key != 'start_bytes'}
+        report = {
+            'generated_at': utils.strftime(utils.now()),
+            'traced_peak_bytes': max([stream['peak_bytes'] for stream in streams.values()] or [0]),
+            'streams': streams,
+            'files': self.files
+        }
+        report_dir = os.path.dirname(self.report_path)
+        if report_dir:
+            os.makedirs(report_dir, exist_ok=True)
+        with open(self.report_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        tracemalloc.stop()
+        LOGGER.info('Memory profile report: {}'.format(self.report_path))
+
+
+# One profiler per sync (config)
+def get_profiler(config):
+    global PROFILER
+    if PROFILER is None or PROFILER.config is not config:
+        PROFILER = MemoryProfiler(config)
+    return PROFILER
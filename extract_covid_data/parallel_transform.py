@@ -0,0 +1,154 @@
+import os
+import sys
+import itertools
+import multiprocessing
+import singer
+from singer import metrics, metadata, Transformer
+from singer.messages import RecordMessage, format_message
+from extract_covid_data.transform import transform_record, in_row_date_window
+
+LOGGER = singer.get_logger()
+
+# Intra-file sharded transform: the csv rows of a large file are split into chunks;
+#   transform_record, Transformer and JSON serialization run in a process pool
+#   and the serialized RECORD messages are written to stdout in file order.
+# config.json:
+#   parallel_transform_min_bytes: Minimum file size (decoded bytes) for the parallel mode,
+#       default = None (parallel mode disabled)
+#   parallel_transform_workers: Number of worker processes, default = os.cpu_count()
+#   parallel_transform_chunk_rows: Number of csv rows per chunk, default = 10000
+DEFAULT_CHUNK_ROWS = 10000
+
+# Worker process globals, set once per pool by init_worker
+WORKER_CONTEXT = {}
+
+
+#   daily_deltas (DailyDeltas, daily_delta.py): rows transformed in file order in this process
+#   (reprocess), not in the pool
+def init_worker(stream_name, schema, stream_metadata, version, time_extracted, row_date_filter=None,
+                daily_deltas=None):
+    WORKER_CONTEXT['stream_name'] = stream_name
+    WORKER_CONTEXT['schema'] = schema
+    WORKER_CONTEXT['stream_metadata'] = stream_metadata
+    WORKER_CONTEXT['version'] = version
+    WORKER_CONTEXT['time_extracted'] = time_extracted
+    WORKER_CONTEXT['row_date_filter'] = row_date_filter
+    WORKER_CONTEXT['daily_deltas'] = daily_deltas
+
+
+def get_parallel_min_bytes(config):
+    return (config or {}).get('parallel_transform_min_bytes')
+
+
+# Convert each compact csv row to a record (with git file fields and row number),
+#   transform and coerce it, and serialize to a RECORD message line.
+# Returns the lines, the number of rows skipped by transform_record (None records)
+#   and the number of rows outside the row date window (numbered, not emitted)
+def transform_rows(row_number, rows):
+    stream_name = WORKER_CONTEXT['stream_name']
+    schema = WORKER_CONTEXT['schema']
+    stream_metadata = WORKER_CONTEXT['stream_metadata']
+    version = WORKER_CONTEXT['version']
+    time_extracted = WORKER_CONTEXT['time_extracted']
+    row_date_filter = WORKER_CONTEXT.get('row_date_filter')
+    daily_deltas = WORKER_CONTEXT.get('daily_deltas')
+    lines = []
+    skipped = 0
+    filtered = 0
+    with Transformer() as transformer:
+        for row in rows:
+            record = row.to_dict(row_number)
+            try:
+                transformed_csv_record = transform_record(stream_name, record)
+            except Exception as err:
+                LOGGER.error('Transform Record error: {}, Stream: {}'.format(err, stream_name))
+                LOGGER.error('record: {}'.format(record))
+                raise err
+            # Bad records and totals
+            if transformed_csv_record is None:
+                skipped = skipped + 1
+                continue
+            if daily_deltas:
+                daily_deltas.enrich(transformed_csv_record)
+            if row_date_filter and not in_row_date_window(transformed_csv_record, row_date_filter):
+                filtered = filtered + 1
+                row_number = row_number + 1
+                continue
+            try:
+                transformed_record = transformer.transform(
+                    transformed_csv_record, schema, stream_metadata)
+            except Exception as err:
+                LOGGER.error('Transformer error: {}, Strean: {}'.format(err, stream_name))
+                LOGGER.error('record: {}'.format(transformed_csv_record))
+                raise err
+            if version:
+                message = RecordMessage(
+                    stream=stream_name,
+                    record=transformed_record,
+                    version=version,
+                    time_extracted=time_extracted)
+            else:
+                message = RecordMessage(
+                    stream=stream_name,
+                    record=transformed_record,
+                    time_extracted=time_extracted)
+            lines.append(format_message(message))
+            row_number = row_number + 1
+    return lines, skipped, filtered
+
+
+# Rows of a chunk share one FileMeta, pickled once per chunk
+def transform_chunk(chunk):
+    row_number, rows = chunk
+    return transform_rows(row_number, rows)
+
+
+def get_chunks(row_number, rows, chunk_rows):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_rows))
+        if not chunk:
+            return
+        yield row_number, chunk
+        row_number = row_number + len(chunk)
+
+
+# Process the csv rows of one file in a process pool.
+# Row numbers in each chunk assume no rows were skipped before the chunk; if transform_record
+#   skipped rows in an earlier chunk, the chunk is re-processed in this process with the
+#   correct starting row number, so __sdc_row_number always matches the serial sync.
+# Returns the record count and the next row number
+def process_file_parallel(catalog,
+                          stream_name,
+                          config,
+                          rows,
+                          row_number,
+                          time_extracted,
+                          version=None,
+                          row_date_filter=None):
+    stream = catalog.get_stream(stream_name)
+    schema = stream.schema.to_dict()
+    stream_metadata = metadata.to_map(stream.metadata)
+    workers = config.get('parallel_transform_workers') or os.cpu_count()
+    chunk_rows = config.get('parallel_transform_chunk_rows', DEFAULT_CHUNK_ROWS)
+    LOGGER.info('PARALLEL TRANSFORM, Stream: {}, workers: {}, chunk rows: {}'.format(
+        stream_name, workers, chunk_rows))
+
+    init_args = (stream_name, schema, stream_metadata, version, time_extracted, row_date_filter)
+    # Chunks reference the same rows, kept for re-processing (see above)
+    chunks = list(get_chunks(row_number, rows, chunk_rows))
+    skipped_total = 0
+    with metrics.record_counter(stream_name) as counter:
+        with multiprocessing.Pool(workers, initializer=init_worker, initargs=init_args) as pool:
+            results = pool.imap(transform_chunk, chunks)
+            for (_, chunk), (lines, skipped, filtered) in zip(chunks, results):
+                if skipped_total > 0 and (lines or filtered):
+                    init_worker(*init_args)
+                    lines, skipped, filtered = transform_rows(row_number, chunk)
+                for line in lines:
+                    sys.stdout.write(line + '\n')
+                sys.stdout.flush()
+                counter.increment(len(lines))
+                row_number = row_number + len(lines) + filtered
+                skipped_total = skipped_total + skipped
+        return counter.value, row_number
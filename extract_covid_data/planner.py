@@ -0,0 +1,153 @@
+import math
+from datetime import datetime, timezone
+import singer
+from singer import utils
+from extract_covid_data import local_store
+from extract_covid_data.streams import STREAMS
+
+LOGGER = singer.get_logger()
+
+# Rate-budget-aware stream scheduler
+#   Each selected stream's API calls (search pages, commits and blobs) are estimated from the
+#   quota it used on its last run of the same kind (initial or incremental). Quota used already
+#   excludes cached responses and 304 Not Modified (http_cache.py), so cache hits are netted out.
+#   Streams not synced before use DEFAULT_ESTIMATES.
+#   Streams are ordered by priority, then by estimated core calls (smallest first), and streams
+#   that do not fit in the remaining core budget (less the reserve) are deferred to the next run.
+#   The search budget refills every minute, so search calls are reported (with the minutes of
+#   search quota they need) but do not defer streams.
+# config.json:
+#   rate_budget_scheduling: Order and defer streams by the plan when syncing, default = false
+#       (streams are synced in STREAMS order)
+#   stream_priorities: Priority by stream name, lowest first, e.g. {"jh_csse_daily": 1};
+#       default = 1 for single-file (activate_version) streams, 2 for multi-file streams
+#   rate_limit_reserve: Core requests kept in reserve, default = 100
+# Dry run: extract_covid_data --config config.json --catalog catalog.json --plan
+#   prints the plan as JSON without fetching any data.
+DEFAULT_RESERVE = 100
+DEFAULT_ESTIMATES = {
+    # One search page, one commits call and one blob
+    'single_file': {'search': 1, 'core': 2},
+    # Multi-file streams: a commits call and a blob per new file
+    'incremental': {'search': 1, 'core': 20},
+    'initial': {'search': 10, 'core': 1000}
+}
+STATS_FILE_NAME = 'stats/streams.json'
+
+
+def get_stream_priority(stream_name, endpoint_config, config):
+    priorities = config.get('stream_priorities') or {}
+    if stream_name in priorities:
+        return priorities[stream_name]
+    return 1 if endpoint_config.get('activate_version', False) else 2
+
+
+def get_sync_kind(stream_name, state, start_date):
+    bookmark = (state or {}).get('bookmarks', {}).get(stream_name, start_date)
+    if bookmark == start_date and not (state or {}).get('checkpoints', {}).get(stream_name):
+        return 'initial'
+    return 'incremental'
+
+
+# Returns the estimated calls {'search': n, 'core': n} and the estimate source
+def estimate_stream_calls(stream_name, endpoint_config, sync_kind, stream_stats):
+    last_run = stream_stats.get(stream_name, {}).get(sync_kind)
+    if last_run:
+        return {'search': last_run.get('search', 0), 'core': last_run.get('core', 0)}, 'last_run'
+    if endpoint_config.get('activate_version', False):
+        return dict(DEFAULT_ESTIMATES['single_file']), 'default'
+    return dict(DEFAULT_ESTIMATES[sync_kind]), 'default'
+
+
+# Remaining quota per resource from /rate_limit (not counted against the rate limit)
+def get_budget(client):
+    try:
+        return client.get_rate_limit()
+    except Exception as err:
+        # e.g. GitHub Enterprise with rate limiting disabled
+        LOGGER.warning('Rate limit unavailable, streams are not deferred: {}'.format(err))
+        return {}
+
+
+def format_reset(reset):
+    if not reset:
+        return None
+    return utils.strftime(datetime.fromtimestamp(reset, tz=timezone.utc))
+
+
+def get_sync_plan(client, config, state, selected_streams):
+    start_date = config.get('start_date')
+    reserve = config.get('rate_limit_reserve', DEFAULT_RESERVE)
+    stream_stats = local_store.read_json(
+        local_store.get_cache_dir(config), STATS_FILE_NAME, default={})
+    budget = get_budget(client)
+
+    stream_plans = []
+    stream_order = list(STREAMS.keys())
+    for stream_name in selected_streams:
+        endpoint_config = STREAMS[stream_name]
+        sync_kind = get_sync_kind(stream_name, state, start_date)
+        estimated_calls, estimate_source = estimate_stream_calls(
+            stream_name, endpoint_config, sync_kind, stream_stats)
+        stream_plans.append({
+            'stream': stream_name,
+            'priority': get_stream_priority(stream_name, endpoint_config, config),
+            'sync_kind': sync_kind,
+            'estimated_calls': estimated_calls,
+            'estimate_source': estimate_source
+        })
+    stream_plans.sort(key=lambda stream_plan: (
+        stream_plan['priority'],
+        stream_plan['estimated_calls']['core'],
+        stream_order.index(stream_plan['stream'])))
+
+    core_budget = None
+    if 'core' in budget:
+        core_budget = max(budget['core']['remaining'] - reserve, 0)
+    expected_use = {'search': 0, 'core': 0}
+    deferred = []
+    for stream_plan in stream_plans:
+        estimated_calls = stream_plan['estimated_calls']
+        if core_budget is not None and expected_use['core'] + estimated_calls['core'] > core_budget:
+            stream_plan['scheduled'] = False
+            deferred.append(stream_plan['stream'])
+            continue
+        stream_plan['scheduled'] = True
+        expected_use['search'] = expected_use['search'] + estimated_calls['search']
+        expected_use['core'] = expected_use['core'] + estimated_calls['core']
+
+    search_minutes = None
+    if budget.get('search', {}).get('limit'):
+        search_minutes = math.ceil(expected_use['search'] / budget['search']['limit'])
+    return {
+        'budget': {resource: {
+            'limit': values.get('limit'),
+            'remaining': values.get('remaining'),
+            'reset': format_reset(values.get('reset'))
+        } for resource, values in budget.items() if resource in ('core', 'search')},
+        'reserve': reserve,
+        'expected_use': expected_use,
+        'search_minutes': search_minutes,
+        'streams': stream_plans,
+        'deferred': deferred
+    }
+
+
+# Throttle between streams: check the remaining core quota (last X-RateLimit headers)
+def has_core_budget(client, config, stream_plan):
+    core_limits = client.rate_limits.get('core')
+    if not core_limits:
+        return True
+    reserve = config.get('rate_limit_reserve', DEFAULT_RESERVE)
+    return core_limits['remaining'] - reserve >= stream_plan['estimated_calls']['core']
+
+
+def record_stream_stats(config, stream_name, sync_kind, quota_used):
+    cache_dir = local_store.get_cache_dir(config)
+    stream_stats = local_store.read_json(cache_dir, STATS_FILE_NAME, default={})
+    stream_stats.setdefault(stream_name, {})[sync_kind] = {
+        'search': quota_used.get('search', 0),
+        'core': quota_used.get('core', 0),
+        'synced_at': utils.strftime(utils.now())
+    }
+    local_store.write_json(cache_dir, STATS_FILE_NAME, stream_stats)
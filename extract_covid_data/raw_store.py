@@ -0,0 +1,60 @@
+import os
+import singer
+from singer import utils
+from extract_covid_data import local_store
+
+LOGGER = singer.get_logger()
+
+# Raw file store (config raw_file_store = true): the latest synced version of each file
+#   (decoded blob bytes) and its git_* fields, kept in the local store for the offline
+#   reprocess (reprocess.py)
+#   <cache_dir>/raw/<stream>/<blob sha>: file bytes
+#   <cache_dir>/raw/<stream>/index.json: {file path: {git_* fields, stored_at}}
+# config.json:
+#   raw_file_store: Keep the raw files of synced files, default = false
+RAW_DIR = 'raw'
+
+
+def is_enabled(config):
+    return bool((config or {}).get('raw_file_store', False))
+
+
+def get_index_name(stream_name):
+    return '{}/{}/index.json'.format(RAW_DIR, stream_name)
+
+
+def get_file_path(cache_dir, stream_name, git_sha):
+    return local_store.get_store_path(cache_dir, '{}/{}/{}'.format(RAW_DIR, stream_name, git_sha))
+
+
+def read_index(cache_dir, stream_name):
+    return local_store.read_json(cache_dir, get_index_name(stream_name), {})
+
+
+def write_index(cache_dir, stream_name, index):
+    local_store.write_json(cache_dir, get_index_name(stream_name), index)
+
+
+# Store the file bytes (temp file and rename, as local_store.write_json) and replace the
+#   previous version of the path in the index
+def store_file(cache_dir, stream_name, index, file_meta, content):
+    file_path = get_file_path(cache_dir, stream_name, file_meta.git_sha)
+    if not os.path.exists(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = '{}.tmp'.format(file_path)
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, file_path)
+    previous = index.get(file_meta.git_path)
+    if previous and previous.get('git_sha') != file_meta.git_sha:
+        previous_path = get_file_path(cache_dir, stream_name, previous.get('git_sha'))
+        if os.path.exists(previous_path):
+            os.remove(previous_path)
+    entry = file_meta.get_git_fields()
+    entry['stored_at'] = utils.strftime(utils.now())
+    index[file_meta.git_path] = entry
+
+
+def read_file(cache_dir, stream_name, git_sha):
+    with open(get_file_path(cache_dir, stream_name, git_sha), 'rb') as file:
+        return file.read()
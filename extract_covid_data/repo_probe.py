@@ -0,0 +1,131 @@
+from datetime import datetime
+import singer
+from singer import utils
+from extract_covid_data.commit_log import get_search_filters
+
+LOGGER = singer.get_logger()
+
+# Repository change probe (config repo_change_probe = true)
+#   Streams share a few repositories (repo: in search_path). Once per run and repository, one
+#   conditional request for the repository's pushed_at: /repos/{owner}/{repo} with
+#   If-Modified-Since the Last-Modified of the previous probe (a 304 Not Modified keeps the
+#   pushed_at of the previous probe and does not count against the rate limit).
+#   When a stream finishes, the pushed_at probed before its sync is kept for the stream. A stream
+#   whose repository's pushed_at is the same as the one kept for the stream (no push since its
+#   last sync) is skipped, with no search, commits or blob calls (not on the initial sync, or
+#   when resuming from a checkpoint). The bookmark (committer date of the last synced file) is
+#   not compared to pushed_at: commits are pushed after they are made.
+#   Probes are kept in the state for the conditional request of the next run:
+#   state['repo_probes'][owner/repo] = {pushed_at, last_modified, probed_at, streams: {stream: pushed_at}}
+#   Sharded sync (shards.py): each unit keeps the probe of its stream's repository (get_unit_probe)
+#   and merge_unit_probes keeps the stream's pushed_at when all of the stream's units are done.
+# config.json:
+#   repo_change_probe: Probe repositories and skip unchanged streams, default = false
+
+
+def get_stream_repo(search_path):
+    return get_search_filters(search_path).get('repo')
+
+
+# Last-Modified from GitClient (2020-05-01T00:00:00Z) to an HTTP date for If-Modified-Since
+def to_http_date(last_modified):
+    last_modified_dttm = datetime.strptime(last_modified, '%Y-%m-%dT%H:%M:%SZ')
+    return last_modified_dttm.strftime('%a, %d %b %Y %H:%M:%S GMT')
+
+
+# Returns the repository's pushed_at (None if the probe failed), probed once per run (run_probes)
+def probe_repo(client, state, repo, run_probes):
+    if repo in run_probes:
+        return run_probes[repo]
+    repo_probes = state.setdefault('repo_probes', {})
+    last_probe = repo_probes.get(repo) or {}
+    headers = {}
+    if last_probe.get('last_modified') and last_probe.get('pushed_at'):
+        headers['If-Modified-Since'] = to_http_date(last_probe['last_modified'])
+    try:
+        repo_data, _, last_modified = client.get(
+            url='{}/repos/{}'.format(client.base_url, repo),
+            headers=headers,
+            endpoint='repo_probe')
+    except Exception as err:
+        LOGGER.warning('REPO PROBE, repo: {}, probe failed, streams are not skipped: {}'.format(repo, err))
+        run_probes[repo] = None
+        return None
+    if repo_data is None:
+        # 304 Not Modified
+        pushed_at = last_probe['pushed_at']
+    else:
+        pushed_at = repo_data.get('pushed_at')
+        repo_probes[repo] = dict(
+            last_probe,
+            pushed_at=pushed_at,
+            last_modified=last_modified,
+            probed_at=utils.strftime(utils.now()))
+    LOGGER.info('REPO PROBE, repo: {}, pushed_at: {}, not modified: {}'.format(
+        repo, pushed_at, repo_data is None))
+    run_probes[repo] = pushed_at
+    return pushed_at
+
+
+# Returns the pushed_at of the stream's repository (None if not probed), before the stream's sync
+def probe_stream(client, state, endpoint_config, run_probes):
+    repo = get_stream_repo(endpoint_config.get('search_path'))
+    if not repo:
+        return None
+    return probe_repo(client, state, repo, run_probes)
+
+
+# Is the stream's repository unchanged since the stream's last sync?
+def is_stream_unchanged(state, stream_name, endpoint_config, start_date, pushed_at):
+    if not pushed_at:
+        return False
+    bookmark = state.get('bookmarks', {}).get(stream_name, start_date)
+    if not bookmark or bookmark == start_date:
+        return False
+    if state.get('checkpoints', {}).get(stream_name):
+        return False
+    repo = get_stream_repo(endpoint_config.get('search_path'))
+    stream_probes = ((state.get('repo_probes') or {}).get(repo) or {}).get('streams') or {}
+    return stream_probes.get(stream_name) == pushed_at
+
+
+# Stream finished: keep the pushed_at probed before its sync
+def record_stream(state, stream_name, endpoint_config, pushed_at):
+    if not pushed_at:
+        return
+    repo = get_stream_repo(endpoint_config.get('search_path'))
+    repo_probe = state.setdefault('repo_probes', {}).setdefault(repo, {})
+    repo_probe.setdefault('streams', {})[stream_name] = pushed_at
+
+
+# Sharded sync: the probe of the stream's repository for a unit (None if not probed)
+#   pushed_at: probed before the unit's sync, probe: repository probe (without streams)
+def get_unit_probe(state, endpoint_config, run_probes):
+    repo = get_stream_repo(endpoint_config.get('search_path'))
+    if not repo or run_probes is None or repo not in run_probes:
+        return None
+    last_probe = (state.get('repo_probes') or {}).get(repo) or {}
+    return {
+        'repo': repo,
+        'pushed_at': run_probes[repo],
+        'probe': {key: value for key, value in last_probe.items() if key != 'streams'}
+    }
+
+
+# Sharded sync: merge the unit probes of a stream into the state
+#   The repository probe: the last probed. The stream's pushed_at: the oldest pushed_at probed by
+#   its units, only when all units are done and probed (a push during the sharded sync is synced
+#   on the next run).
+def merge_unit_probes(state, stream_name, endpoint_config, unit_probes, stream_done):
+    for unit_probe in unit_probes:
+        if not unit_probe or not unit_probe.get('probe'):
+            continue
+        repo_probe = state.setdefault('repo_probes', {}).setdefault(unit_probe['repo'], {})
+        if (repo_probe.get('probed_at') or '') <= (unit_probe['probe'].get('probed_at') or ''):
+            repo_probe.update(unit_probe['probe'])
+    if not stream_done or not unit_probes:
+        return
+    if not all(unit_probe and unit_probe.get('pushed_at') for unit_probe in unit_probes):
+        return
+    record_stream(state, stream_name, endpoint_config,
+                  min(unit_probe['pushed_at'] for unit_probe in unit_probes))
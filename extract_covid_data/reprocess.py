@@ -0,0 +1,147 @@
+import os
+import sys
+import multiprocessing
+from datetime import datetime
+import pytz
+import singer
+from singer import metrics, metadata, utils
+from singer.utils import strptime_to_utc
+from extract_covid_data import daily_delta
+from extract_covid_data import local_store
+from extract_covid_data import parallel_transform
+from extract_covid_data import raw_store
+from extract_covid_data.rows import FileMeta, read_csv_content
+from extract_covid_data.streams import STREAMS
+from extract_covid_data.sync import write_schema, get_dropped_fields, get_row_date_filter, get_file_charsets
+from extract_covid_data.transform import get_column_projection
+
+LOGGER = singer.get_logger()
+
+# Offline reprocess: extract_covid_data --config config.json --catalog catalog.json --reprocess
+#   Re-runs parse, transform and emit for the selected streams from the raw file store
+#   (raw_store.py, files kept by syncs with config raw_file_store): no GitClient, zero network
+#   calls, e.g. after a fix in transform.py. Files are parsed and transformed in a process pool
+#   (one file per task) and the RECORD messages are written in file order (newest first, as the
+#   sync). Single-file (activate_version) streams are emitted as a new version, followed by
+#   ACTIVATE_VERSION; append-only files keep the version of their append_only state (the next
+#   sync's new rows continue that version). The state (bookmarks) is not changed.
+#   Streams with row change detection (config row_change_detection, keyed on
+#   change_key_properties, not versioned) are not reprocessed.
+#   With config daily_deltas, the daily delta fields (daily_delta.py) are computed from an empty
+#   state, with the files in this process, oldest first (git_last_modified).
+# config.json:
+#   parallel_transform_workers: Number of worker processes, default = os.cpu_count()
+#   row_date_filters, column projection (catalog selection): as the sync
+
+
+# Worker: read, parse and transform one file; returns the serialized RECORD lines
+#   (WORKER_CONTEXT set by parallel_transform.init_worker)
+def reprocess_file(task):
+    cache_dir, stream_name, entry, charsets, dropped_fields = task
+    endpoint_config = STREAMS[stream_name]
+    content = raw_store.read_file(cache_dir, stream_name, entry['git_sha'])
+    file_meta = FileMeta(**{key: value for key, value in entry.items() if key.startswith('git_')})
+    rows, _ = read_csv_content(
+        content,
+        file_meta,
+        charsets,
+        skip_header_rows=endpoint_config.get('skip_header_rows', 0),
+        delimiter=endpoint_config.get('csv_delimiter', ','),
+        keep_column=get_column_projection(stream_name, dropped_fields))
+    lines, _, _ = parallel_transform.transform_rows(1, rows)
+    return lines
+
+
+def get_version(state, stream_name, entries):
+    # Append-only: the version of the last full load, continued by the append-only syncs
+    append_only_files = (state.get('append_only') or {}).get(stream_name) or {}
+    for entry in entries:
+        file_state = append_only_files.get(entry['git_path'])
+        if file_state and file_state.get('version') is not None:
+            return file_state['version']
+    last_modified = max(entry['git_last_modified'] for entry in entries)
+    epoch = datetime(1970, 1, 1, tzinfo=pytz.utc)
+    return int((strptime_to_utc(last_modified) - epoch).total_seconds())
+
+
+def write_lines(results, counter):
+    for lines in results:
+        for line in lines:
+            sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+        counter.increment(len(lines))
+
+
+def reprocess_stream(config, catalog, state, stream_name):
+    endpoint_config = STREAMS[stream_name]
+    if endpoint_config.get('change_key_properties') and config.get('row_change_detection', False):
+        LOGGER.warning('REPROCESS, Stream: {}, row change detection stream, not reprocessed'.format(stream_name))
+        return 0
+    cache_dir = local_store.get_cache_dir(config)
+    index = raw_store.read_index(cache_dir, stream_name)
+    if not index:
+        LOGGER.warning('REPROCESS, Stream: {}, no raw files in the raw file store'.format(stream_name))
+        return 0
+    # Newest first, as the sync (search and commits sorted by last-modified desc);
+    #   daily deltas: oldest first
+    daily_deltas = None
+    if daily_delta.is_enabled(config, endpoint_config):
+        daily_deltas = daily_delta.DailyDeltas(None, stream_name, endpoint_config, config)
+    entries = sorted(
+        index.values(),
+        key=lambda entry: entry.get('git_last_modified') or '',
+        reverse=daily_deltas is None)
+    stream_charsets = local_store.read_json(cache_dir, 'charsets/{}.json'.format(stream_name), {})
+    alt_character_set = endpoint_config.get('alt_character_set', 'utf-8')
+    dropped_fields = get_dropped_fields(catalog, stream_name).difference(
+        endpoint_config.get('change_key_properties', []))
+    if daily_deltas:
+        dropped_fields = dropped_fields.difference(daily_deltas.key_fields, daily_deltas.value_fields)
+    row_date_filter = get_row_date_filter(stream_name, endpoint_config, config)
+    if row_date_filter:
+        dropped_fields = dropped_fields.difference([row_date_filter[0]])
+    version = None
+    activate_version_message = None
+    if endpoint_config.get('activate_version', False):
+        version = get_version(state, stream_name, entries)
+        activate_version_message = singer.ActivateVersionMessage(stream=stream_name, version=version)
+
+    tasks = []
+    for entry in entries:
+        charsets = get_file_charsets(stream_charsets, entry['git_path'], entry['git_sha'], alt_character_set)
+        tasks.append((cache_dir, stream_name, entry, charsets, dropped_fields))
+
+    write_schema(catalog, stream_name)
+    stream = catalog.get_stream(stream_name)
+    init_args = (
+        stream_name,
+        stream.schema.to_dict(),
+        metadata.to_map(stream.metadata),
+        version,
+        utils.now(),
+        row_date_filter)
+    workers = config.get('parallel_transform_workers') or os.cpu_count()
+    if daily_deltas:
+        workers = 1
+    LOGGER.info('REPROCESS, Stream: {}, files: {}, workers: {}'.format(stream_name, len(tasks), workers))
+    with metrics.record_counter(stream_name) as counter:
+        if daily_deltas:
+            parallel_transform.init_worker(*init_args, daily_deltas=daily_deltas)
+            results = (reprocess_file(task) for task in tasks)
+            write_lines(results, counter)
+        else:
+            with multiprocessing.Pool(workers, initializer=parallel_transform.init_worker, initargs=init_args) as pool:
+                write_lines(pool.imap(reprocess_file, tasks), counter)
+        record_count = counter.value
+    if activate_version_message:
+        singer.write_message(activate_version_message)
+    LOGGER.info('REPROCESSED Stream: {}, files: {}, total records: {}'.format(
+        stream_name, len(tasks), record_count))
+    return record_count
+
+
+def reprocess(config, catalog, state):
+    selected_streams = [stream.stream for stream in catalog.get_selected_streams(state)]
+    for stream_name in STREAMS:
+        if stream_name in selected_streams:
+            reprocess_stream(config, catalog, state, stream_name)
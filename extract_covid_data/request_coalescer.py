@@ -0,0 +1,118 @@
+import threading
+import collections
+import singer
+from requests.structures import CaseInsensitiveDict
+
+LOGGER = singer.get_logger()
+
+# In-run request coalescing (single flight) for GitClient GET requests
+#   Identical GET requests (same URL and response-changing headers) are sent once per run:
+#   a request already in flight is joined (the caller waits for the leader's response), and a
+#   completed response is returned from memory. Overlapping search_path queries fetch the same
+#   commits URL or blob more than once in a run (e.g. excluded files, files matched by 2 streams).
+#   Completed responses are shared by the callers (not copied), they must not be modified.
+#   Only 200 responses are kept, least recently used first out; errors are not kept (the
+#   followers of a failed request get its exception).
+# config.json:
+#   request_coalescing: Enable the coalescing, default = false
+#   request_coalescing_max_entries: Maximum completed responses kept, default = 256
+#   request_coalescing_max_bytes: Maximum size of completed responses kept (blob content),
+#       default = 64 MB
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Request headers that change the response, part of the key (as http_cache.KEY_HEADERS)
+KEY_HEADERS = ('Accept', 'If-Modified-Since', 'Range')
+
+
+def get_request_key(url, headers):
+    headers = CaseInsensitiveDict(headers or {})
+    return (url,) + tuple(headers.get(header) for header in KEY_HEADERS)
+
+
+# Blob content (base64) dominates the size of a response
+def get_result_size(result):
+    response_json = result[0]
+    if isinstance(response_json, dict) and isinstance(response_json.get('content'), str):
+        return len(response_json['content'])
+    return 0
+
+
+class InFlightRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer(object):
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.completed = collections.OrderedDict()
+        self.size = 0
+        self.saved = {'in_flight': 0, 'completed': 0}
+
+    # result: (response_json, next_url, last_modified) of request_function()
+    def get(self, key, request_function):
+        with self.lock:
+            if key in self.completed:
+                self.completed.move_to_end(key)
+                self.saved['completed'] = self.saved['completed'] + 1
+                return self.completed[key][0]
+            in_flight = self.in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = InFlightRequest()
+                self.in_flight[key] = in_flight
+            else:
+                self.saved['in_flight'] = self.saved['in_flight'] + 1
+
+        if not leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            in_flight.result = request_function()
+        except Exception as err:
+            in_flight.error = err
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+                if in_flight.result is not None and in_flight.result[0] is not None:
+                    self.store(key, in_flight.result)
+            in_flight.done.set()
+        return in_flight.result
+
+    # Called with the lock held
+    def store(self, key, result):
+        result_size = get_result_size(result)
+        if result_size > self.max_bytes or self.max_entries <= 0:
+            return
+        self.completed[key] = (result, result_size)
+        self.size = self.size + result_size
+        while len(self.completed) > self.max_entries or self.size > self.max_bytes:
+            _, (_, evicted_size) = self.completed.popitem(last=False)
+            self.size = self.size - evicted_size
+
+    @property
+    def requests_saved(self):
+        return self.saved['in_flight'] + self.saved['completed']
+
+    def log_stats(self):
+        LOGGER.info('REQUEST COALESCING, requests saved: {} (in flight: {}, completed: {}), responses kept: {}, {} bytes'.format(
+            self.requests_saved, self.saved['in_flight'], self.saved['completed'],
+            len(self.completed), self.size))
+
+
+def get_request_coalescer(config):
+    if not config.get('request_coalescing', False):
+        return None
+    return RequestCoalescer(
+        max_entries=config.get('request_coalescing_max_entries', DEFAULT_MAX_ENTRIES),
+        max_bytes=config.get('request_coalescing_max_bytes', DEFAULT_MAX_BYTES))
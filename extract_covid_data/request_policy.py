@@ -0,0 +1,148 @@
+import time
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import singer
+from extract_covid_data.http_cache import get_endpoint_type
+
+LOGGER = singer.get_logger()
+
+# Request timeouts and hedged requests for GitClient
+#   Timeouts (connect, read) by endpoint type (search, commits, blobs, other; see
+#   http_cache.get_endpoint_type), so that a stalled response fails (and is retried with backoff)
+#   instead of hanging the run.
+#   Hedging (optional): an idempotent GET still running after the p95 latency observed for its
+#   endpoint type is sent again, and the first response is used (the other is discarded).
+#   Hedges are capped at hedge_max_rate of the requests and count against the rate limit.
+# config.json:
+#   request_timeouts: [connect, read] seconds by endpoint type, e.g. {"blobs": [10, 300]},
+#       default = connect_timeout / read_timeout (transport.py) if set, else DEFAULT_TIMEOUTS
+#       (the read timeout is the wait between bytes received, not the whole download)
+#   hedge_requests: Enable hedging, default = false
+#   hedge_max_rate: Maximum hedged requests / requests, default = 0.05
+#   hedge_min_samples: Latency samples of an endpoint type before it is hedged, default = 20
+DEFAULT_TIMEOUTS = {
+    'search': (10, 60),
+    'commits': (10, 60),
+    'blobs': (10, 120),
+    'other': (10, 60)
+}
+DEFAULT_HEDGE_MAX_RATE = 0.05
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = 200
+HEDGE_WORKERS = 8
+
+
+def get_percentile(samples, percentile):
+    ordered = sorted(samples)
+    index = min(int(len(ordered) * percentile), len(ordered) - 1)
+    return ordered[index]
+
+
+class RequestPolicy(object):
+    def __init__(self, config):
+        config = config or {}
+        self.timeouts = {}
+        request_timeouts = config.get('request_timeouts') or {}
+        for endpoint_type, default_timeout in DEFAULT_TIMEOUTS.items():
+            timeout = request_timeouts.get(endpoint_type)
+            if timeout is None:
+                timeout = (
+                    config.get('connect_timeout') or default_timeout[0],
+                    config.get('read_timeout') or default_timeout[1])
+            self.timeouts[endpoint_type] = tuple(timeout)
+        self.hedge_max_rate = config.get('hedge_max_rate', DEFAULT_HEDGE_MAX_RATE)
+        self.hedge_min_samples = config.get('hedge_min_samples', DEFAULT_HEDGE_MIN_SAMPLES)
+        self.executor = None
+        if config.get('hedge_requests', False):
+            self.executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=LATENCY_SAMPLES))
+        self.counts = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+
+    def get_timeout(self, endpoint_type):
+        return self.timeouts.get(endpoint_type, self.timeouts['other'])
+
+    def record_latency(self, endpoint_type, seconds):
+        with self.lock:
+            self.latencies[endpoint_type].append(seconds)
+
+    # p95 latency of the endpoint type, None until hedge_min_samples are observed
+    def get_hedge_delay(self, endpoint_type):
+        with self.lock:
+            samples = list(self.latencies[endpoint_type])
+        if len(samples) < self.hedge_min_samples:
+            return None
+        return get_percentile(samples, 0.95)
+
+    def can_hedge(self):
+        with self.lock:
+            return self.counts['hedged'] + 1 <= self.hedge_max_rate * self.counts['requests']
+
+    # send_request(timeout) sends the request with the transport; on_hedge() is called before
+    #   a hedge is sent, and on_discarded(response) with the response not used (the primary or
+    #   the hedge, when it completes), for the rate limit accounting of both requests
+    def send(self, send_request, url, hedgeable=False, on_hedge=None, on_discarded=None):
+        endpoint_type = get_endpoint_type(url)
+        timeout = self.get_timeout(endpoint_type)
+        with self.lock:
+            self.counts['requests'] = self.counts['requests'] + 1
+        hedge_delay = self.get_hedge_delay(endpoint_type) if hedgeable and self.executor else None
+        start_time = time.time()
+        if hedge_delay is None:
+            response = send_request(timeout)
+            self.record_latency(endpoint_type, time.time() - start_time)
+            return response
+
+        primary = self.executor.submit(send_request, timeout)
+        done, _ = wait([primary], timeout=hedge_delay)
+        if done or not self.can_hedge():
+            response = primary.result()
+            self.record_latency(endpoint_type, time.time() - start_time)
+            return response
+
+        if on_hedge:
+            on_hedge()
+        with self.lock:
+            self.counts['hedged'] = self.counts['hedged'] + 1
+        hedge = self.executor.submit(send_request, timeout)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                if future is hedge:
+                    with self.lock:
+                        self.counts['hedge_wins'] = self.counts['hedge_wins'] + 1
+                self.record_latency(endpoint_type, time.time() - start_time)
+                for other_future in {primary, hedge} - {future}:
+                    other_future.add_done_callback(
+                        lambda discarded: self.discard(discarded, on_discarded))
+                return future.result()
+        raise error
+
+    # Response of a hedged request not used (failed requests are not passed)
+    @staticmethod
+    def discard(future, on_discarded):
+        if on_discarded is None or future.cancelled() or future.exception() is not None:
+            return
+        try:
+            on_discarded(future.result())
+        except Exception as err:
+            LOGGER.warning('HEDGED REQUESTS, discarded response not accounted: {}'.format(err))
+
+    def log_stats(self):
+        if self.executor:
+            LOGGER.info('HEDGED REQUESTS, requests: {}, hedged: {}, hedge wins: {}'.format(
+                self.counts['requests'], self.counts['hedged'], self.counts['hedge_wins']))
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False)
+
+
+def get_request_policy(config):
+    return RequestPolicy(config)
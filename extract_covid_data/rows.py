@@ -0,0 +1,198 @@
+import io
+import csv
+import itertools
+import singer
+
+LOGGER = singer.get_logger()
+
+# Compact csv rows: every row of a file holds a reference to one FileMeta object
+#   (git file fields and csv header) and a tuple of interned cell values.
+#   Rows are only turned into dicts (csv.DictReader layout plus the git file fields and
+#   __sdc_row_number) when they are transformed and serialized.
+
+
+class FileMeta(object):
+    __slots__ = (
+        'git_owner',
+        'git_repository',
+        'git_url',
+        'git_html_url',
+        'git_path',
+        'git_sha',
+        'git_file_name',
+        'git_last_modified',
+        'fieldnames')
+
+    def __init__(self,
+                 git_owner=None,
+                 git_repository=None,
+                 git_url=None,
+                 git_html_url=None,
+                 git_path=None,
+                 git_sha=None,
+                 git_file_name=None,
+                 git_last_modified=None,
+                 fieldnames=None):
+        self.git_owner = git_owner
+        self.git_repository = git_repository
+        self.git_url = git_url
+        self.git_html_url = git_html_url
+        self.git_path = git_path
+        self.git_sha = git_sha
+        self.git_file_name = git_file_name
+        self.git_last_modified = git_last_modified
+        self.fieldnames = fieldnames
+
+    def get_git_fields(self):
+        return {
+            'git_owner': self.git_owner,
+            'git_repository': self.git_repository,
+            'git_url': self.git_url,
+            'git_html_url': self.git_html_url,
+            'git_path': self.git_path,
+            'git_sha': self.git_sha,
+            'git_file_name': self.git_file_name,
+            'git_last_modified': self.git_last_modified
+        }
+
+
+class CsvRow(object):
+    __slots__ = ('meta', 'cells')
+
+    def __init__(self, meta, cells):
+        self.meta = meta
+        self.cells = cells
+
+    # Same keys as csv.DictReader: missing cells are None, extra cells are a list under key None
+    def to_dict(self, row_number):
+        fieldnames = self.meta.fieldnames
+        cells = self.cells
+        record = dict(zip(fieldnames, cells))
+        field_count = len(fieldnames)
+        cell_count = len(cells)
+        if field_count < cell_count:
+            record[None] = list(cells[field_count:])
+        elif field_count > cell_count:
+            for key in fieldnames[cell_count:]:
+                record[key] = None
+        meta = self.meta
+        record['git_owner'] = meta.git_owner
+        record['git_repository'] = meta.git_repository
+        record['git_url'] = meta.git_url
+        record['git_html_url'] = meta.git_html_url
+        record['git_path'] = meta.git_path
+        record['git_sha'] = meta.git_sha
+        record['git_file_name'] = meta.git_file_name
+        record['git_last_modified'] = meta.git_last_modified
+        record['__sdc_row_number'] = row_number
+        return record
+
+
+# Counts the encoded bytes of the lines read (csv.reader reads one line at a time, no read ahead),
+#   so that the position after each row is its byte offset in the file content
+class LineByteCounter(object):
+    def __init__(self, lines, charset, position=0):
+        self.lines = lines
+        self.charset = charset
+        self.position = position
+
+    def __iter__(self):
+        charset = self.charset
+        for line in self.lines:
+            self.position = self.position + len(line.encode(charset))
+            yield line
+
+
+# Parse csv lines to CsvRows (first row is the header, blank rows are skipped, as in DictReader)
+#   Repeated cell values (dates, states, counties, small counts) share one string object per file
+#   keep_column: column projection (column name -> keep), only the kept cells are stored;
+#   kept column indexes are ascending, so a short row keeps a prefix of the kept fieldnames
+#   fieldnames: header of a file read from a row offset (the lines have no header row)
+#   row_index: {'every': N, 'offsets': []}, the byte offset of every Nth row is appended
+#       (byte_counter: the LineByteCounter the lines are read from)
+def read_csv_rows(lines,
+                  meta,
+                  delimiter=',',
+                  keep_column=None,
+                  fieldnames=None,
+                  row_index=None,
+                  byte_counter=None):
+    reader = csv.reader(lines, delimiter=delimiter)
+    if fieldnames is None:
+        fieldnames = tuple(next(reader, []))
+    fieldnames = tuple(fieldnames)
+    meta.fieldnames = fieldnames
+    if row_index is not None:
+        # Full header (before column projection), for reading from a row offset
+        row_index['fieldnames'] = list(fieldnames)
+    column_indexes = None
+    if keep_column is not None:
+        column_indexes = [index for index, column in enumerate(fieldnames) if keep_column(column)]
+        if len(column_indexes) == len(fieldnames):
+            column_indexes = None
+        else:
+            meta.fieldnames = tuple([fieldnames[index] for index in column_indexes])
+    intern_table = {}
+    intern = intern_table.setdefault
+    rows = []
+    row_start = byte_counter.position if row_index is not None else None
+    for cells in reader:
+        if not cells:
+            if row_index is not None:
+                row_start = byte_counter.position
+            continue
+        if row_index is not None:
+            if len(rows) % row_index['every'] == 0:
+                row_index['offsets'].append(row_start)
+            row_start = byte_counter.position
+        if column_indexes is None:
+            rows.append(CsvRow(meta, tuple([intern(cell, cell) for cell in cells])))
+        else:
+            cell_count = len(cells)
+            rows.append(CsvRow(meta, tuple([
+                intern(cells[index], cells[index]) for index in column_indexes if index < cell_count])))
+    return rows
+
+
+# Decode and parse file content (bytes) in one pass: an incremental decoder feeds lines to the
+#   csv reader (no full-text copy or line list), header rows are skipped lazily.
+#   Character sets are tried in order; returns the rows and the character set that worked
+def read_csv_content(content,
+                     meta,
+                     charsets,
+                     skip_header_rows=0,
+                     delimiter=',',
+                     keep_column=None,
+                     fieldnames=None,
+                     row_index=None):
+    for charset in charsets[:-1]:
+        try:
+            return read_csv_text(
+                content, meta, charset, skip_header_rows, delimiter, keep_column, fieldnames, row_index), charset
+        except UnicodeDecodeError as err:
+            LOGGER.warning('{} UNICODE DECODE ERROR: {}, file: {}'.format(
+                charset.upper(), err, meta.git_path))
+            if row_index is not None:
+                row_index['offsets'] = []
+    charset = charsets[-1]
+    return read_csv_text(
+        content, meta, charset, skip_header_rows, delimiter, keep_column, fieldnames, row_index), charset
+
+
+def read_csv_text(content,
+                  meta,
+                  charset,
+                  skip_header_rows=0,
+                  delimiter=',',
+                  keep_column=None,
+                  fieldnames=None,
+                  row_index=None):
+    text_stream = io.TextIOWrapper(io.BytesIO(content), encoding=charset, newline='')
+    if row_index is not None:
+        # Header rows are counted too: offsets are from the start of the content
+        byte_counter = LineByteCounter(text_stream, charset)
+        lines = itertools.islice(iter(byte_counter), skip_header_rows, None)
+        return read_csv_rows(lines, meta, delimiter=delimiter, keep_column=keep_column,
+                             fieldnames=fieldnames, row_index=row_index, byte_counter=byte_counter)
+    lines = itertools.islice(text_stream, skip_header_rows, None)
+    return read_csv_rows(lines, meta, delimiter=delimiter, keep_column=keep_column, fieldnames=fieldnames)
@@ -0,0 +1,274 @@
+import os
+import copy
+import time
+import socket
+import hashlib
+import singer
+from singer import utils
+from singer.utils import strptime_to_utc
+from extract_covid_data import daily_delta
+from extract_covid_data import local_store
+from extract_covid_data import repo_probe
+from extract_covid_data.streams import STREAMS
+
+LOGGER = singer.get_logger()
+
+# Sharded sync across worker nodes sharing a directory (e.g. an NFS mount)
+#   extract_covid_data_coordinator init writes the shard plan: the units (one per stream, or one
+#   per file partition of a multi-file stream) and the STATE the nodes start from.
+#   Each node (tap run with config shard_dir) claims units with an atomic mkdir of the unit lock
+#   directory, syncs them, and writes its partial state (states/<node_id>.json) after each unit.
+#   extract_covid_data_coordinator merge combines the partial states:
+#   bookmarks: the max bookmark per stream (write_bookmark), only when all of the stream's units
+#       are done (otherwise the starting bookmark is kept, so missing partitions are re-synced)
+#   other per-stream state (e.g. append_only, per-file sha and row hashes): merged by file path
+#   repository probes (state['repo_probes'], keyed by repository, not stream): kept per unit and
+#       merged by repo_probe.merge_unit_probes
+# shard_dir layout:
+#   plan.json, locks/<unit_id>/owner.json, states/<node_id>.json, done/<unit_id>.json
+# config.json:
+#   shard_dir: Shared shard directory, enables the sharded sync for the node, default = None
+#   shard_node_id: Node name, default = <hostname>-<pid>
+#   shard_file_partitions: Number of file partitions per multi-file stream,
+#       e.g. {"jh_csse_daily": 4}, default = 1 (one unit per stream); not for streams with
+#       daily deltas (daily_delta.py)
+#   shard_lock_timeout: Seconds after which the lock of an unfinished unit may be reclaimed
+#       by another node (must exceed the longest unit), default = None (never)
+PLAN_FILE_NAME = 'plan.json'
+
+
+def get_node_id(config):
+    return config.get('shard_node_id') or '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+# Stable across processes and machines (unlike hash())
+def in_file_partition(file_path, file_partition):
+    partition, partition_count = file_partition
+    path_hash = int(hashlib.sha1((file_path or '').encode('utf-8')).hexdigest(), 16)
+    return path_hash % partition_count == partition
+
+
+def get_units(selected_streams, config):
+    file_partitions = config.get('shard_file_partitions') or {}
+    units = []
+    for stream_name, endpoint_config in STREAMS.items():
+        if stream_name not in selected_streams:
+            continue
+        partition_count = file_partitions.get(stream_name, 1)
+        if partition_count > 1 and endpoint_config.get('activate_version', False):
+            LOGGER.warning('Stream: {} is a single-file stream, file partitions ignored'.format(
+                stream_name))
+            partition_count = 1
+        if partition_count > 1 and daily_delta.is_enabled(config, endpoint_config):
+            LOGGER.warning('Stream: {} has daily deltas (config daily_deltas), file partitions ignored'.format(
+                stream_name))
+            partition_count = 1
+        if partition_count <= 1:
+            units.append({'unit_id': stream_name, 'stream': stream_name, 'partition': None})
+            continue
+        for partition in range(partition_count):
+            units.append({
+                'unit_id': '{}.{}-of-{}'.format(stream_name, partition + 1, partition_count),
+                'stream': stream_name,
+                'partition': [partition, partition_count]
+            })
+    return units
+
+
+def create_plan(shard_dir, units, state):
+    if local_store.read_json(shard_dir, PLAN_FILE_NAME) is not None:
+        raise Exception('Error: Shard plan already exists in shard_dir: {}'.format(shard_dir))
+    plan = {
+        'units': units,
+        'state': state,
+        'created_at': utils.strftime(utils.now())
+    }
+    local_store.write_json(shard_dir, PLAN_FILE_NAME, plan)
+    return plan
+
+
+def get_plan(shard_dir):
+    plan = local_store.read_json(shard_dir, PLAN_FILE_NAME)
+    if plan is None:
+        raise Exception('Error: No shard plan in shard_dir: {}, run extract_covid_data_coordinator init'.format(
+            shard_dir))
+    return plan
+
+
+def is_unit_done(shard_dir, unit_id):
+    return os.path.exists(local_store.get_store_path(shard_dir, 'done/{}.json'.format(unit_id)))
+
+
+# Claim a unit: mkdir is atomic, only one node creates the lock directory
+def claim_unit(shard_dir, unit_id, node_id, lock_timeout=None):
+    if is_unit_done(shard_dir, unit_id):
+        return False
+    lock_path = local_store.get_store_path(shard_dir, 'locks/{}'.format(unit_id))
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    try:
+        os.mkdir(lock_path)
+    except FileExistsError:
+        if not lock_timeout or time.time() - os.path.getmtime(lock_path) < lock_timeout:
+            return False
+        # Stale lock: rename it (only one node succeeds) and claim again
+        try:
+            os.rename(lock_path, '{}.stale-{}'.format(lock_path, int(time.time())))
+            os.mkdir(lock_path)
+        except OSError:
+            return False
+        LOGGER.warning('SHARD, unit: {}, stale lock reclaimed by node: {}'.format(unit_id, node_id))
+    local_store.write_json(shard_dir, 'locks/{}/owner.json'.format(unit_id), {
+        'node_id': node_id,
+        'claimed_at': utils.strftime(utils.now())
+    })
+    return True
+
+
+def release_unit(shard_dir, unit_id):
+    lock_path = local_store.get_store_path(shard_dir, 'locks/{}'.format(unit_id))
+    local_store.delete_json(shard_dir, 'locks/{}/owner.json'.format(unit_id))
+    try:
+        os.rmdir(lock_path)
+    except OSError as err:
+        LOGGER.warning('SHARD, unit: {}, lock not released: {}'.format(unit_id, err))
+
+
+# Per-stream values of the state (state[key][stream_name]), e.g. bookmarks, append_only
+def get_unit_state(state, stream_name):
+    unit_state = {}
+    for state_key, value in state.items():
+        if isinstance(value, dict) and stream_name in value:
+            unit_state[state_key] = value[stream_name]
+    return unit_state
+
+
+# Node: claim and sync units until none are left (or the run deadline, deadline.py)
+#   A unit stopped at the deadline is released (not done): it is synced again from the plan state
+def sync_shards(client, config, catalog, selected_streams, sync_stream, deadline=None, repo_probes=None):
+    shard_dir = config['shard_dir']
+    node_id = get_node_id(config)
+    lock_timeout = config.get('shard_lock_timeout')
+    plan = get_plan(shard_dir)
+    node_state_name = 'states/{}.json'.format(node_id)
+    node_state = local_store.read_json(shard_dir, node_state_name, {'node_id': node_id, 'units': {}})
+    LOGGER.info('SHARD, node: {}, shard_dir: {}, units: {}'.format(
+        node_id, shard_dir, len(plan['units'])))
+
+    for unit in plan['units']:
+        unit_id = unit['unit_id']
+        if unit['stream'] not in selected_streams:
+            continue
+        if deadline and deadline.is_run_over():
+            LOGGER.warning('SHARD, node: {}, run deadline, no more units claimed'.format(node_id))
+            break
+        if not claim_unit(shard_dir, unit_id, node_id, lock_timeout):
+            continue
+        LOGGER.info('SHARD, node: {}, claimed unit: {}'.format(node_id, unit_id))
+        # Each unit starts from the plan state; STATE messages carry the unit's partial state
+        state = copy.deepcopy(plan['state'])
+        total_records = sync_stream(
+            client=client,
+            config=config,
+            catalog=catalog,
+            state=state,
+            stream_name=unit['stream'],
+            selected_streams=selected_streams,
+            file_partition=unit['partition'],
+            deadline=deadline,
+            repo_probes=repo_probes)
+        if deadline and deadline.is_stopped(unit['stream']):
+            release_unit(shard_dir, unit_id)
+            LOGGER.warning('SHARD, node: {}, unit: {} stopped at the deadline, released'.format(
+                node_id, unit_id))
+            if deadline.is_run_over():
+                break
+            continue
+        node_state['units'][unit_id] = {
+            'stream': unit['stream'],
+            'partition': unit['partition'],
+            'total_records': total_records,
+            'state': get_unit_state(state, unit['stream']),
+            'repo_probe': repo_probe.get_unit_probe(state, STREAMS[unit['stream']], repo_probes),
+            'finished_at': utils.strftime(utils.now())
+        }
+        local_store.write_json(shard_dir, node_state_name, node_state)
+        local_store.write_json(shard_dir, 'done/{}.json'.format(unit_id), {
+            'node_id': node_id,
+            'finished_at': node_state['units'][unit_id]['finished_at']
+        })
+    LOGGER.info('SHARD, node: {}, finished units: {}'.format(node_id, len(node_state['units'])))
+
+
+def get_node_states(shard_dir):
+    states_dir = local_store.get_store_path(shard_dir, 'states')
+    if not os.path.isdir(states_dir):
+        return []
+    node_states = []
+    for file_name in sorted(os.listdir(states_dir)):
+        if file_name.endswith('.json'):
+            node_states.append(local_store.read_json(states_dir, file_name, {'units': {}}))
+    return node_states
+
+
+def get_status(shard_dir):
+    plan = get_plan(shard_dir)
+    status = []
+    for unit in plan['units']:
+        unit_id = unit['unit_id']
+        owner = local_store.read_json(shard_dir, 'locks/{}/owner.json'.format(unit_id))
+        status.append({
+            'unit_id': unit_id,
+            'node_id': owner.get('node_id') if owner else None,
+            'done': is_unit_done(shard_dir, unit_id)
+        })
+    return status
+
+
+# Merge the partial states of the nodes into the plan state
+#   Returns the merged state and the streams with units not done
+def merge_states(shard_dir):
+    plan = get_plan(shard_dir)
+    state = copy.deepcopy(plan['state'])
+    unit_results = {}
+    for node_state in get_node_states(shard_dir):
+        for unit_id, unit_result in node_state.get('units', {}).items():
+            # A reclaimed unit may be finished twice, keep the last
+            if unit_id not in unit_results or \
+                unit_result['finished_at'] > unit_results[unit_id]['finished_at']:
+                unit_results[unit_id] = unit_result
+
+    stream_units = {}
+    for unit in plan['units']:
+        stream_units.setdefault(unit['stream'], []).append(unit['unit_id'])
+
+    incomplete_streams = []
+    for stream_name, unit_ids in stream_units.items():
+        results = [unit_results[unit_id] for unit_id in unit_ids if unit_id in unit_results]
+        max_bookmark = None
+        for result in results:
+            for state_key, value in result['state'].items():
+                if state_key == 'bookmarks':
+                    if max_bookmark is None or strptime_to_utc(value) > strptime_to_utc(max_bookmark):
+                        max_bookmark = value
+                elif state_key == 'checkpoints':
+                    continue
+                elif isinstance(value, dict):
+                    state.setdefault(state_key, {}).setdefault(stream_name, {}).update(value)
+                else:
+                    state.setdefault(state_key, {})[stream_name] = value
+        repo_probe.merge_unit_probes(
+            state=state,
+            stream_name=stream_name,
+            endpoint_config=STREAMS[stream_name],
+            unit_probes=[result.get('repo_probe') for result in results],
+            stream_done=len(results) == len(unit_ids))
+        if len(results) < len(unit_ids):
+            LOGGER.warning('SHARD MERGE, Stream: {}, {} of {} units done, bookmark not advanced'.format(
+                stream_name, len(results), len(unit_ids)))
+            incomplete_streams.append(stream_name)
+            continue
+        if max_bookmark:
+            state.setdefault('bookmarks', {})[stream_name] = max_bookmark
+        if stream_name in state.get('checkpoints', {}):
+            del state['checkpoints'][stream_name]
+    return state, incomplete_streams
@@ -11,6 +11,14 @@
 #   data_key: JSON element containing the results list for the endpoint; default = 'results'
 #   bookmark_query_field: From date-time field used for filtering the query
 #   alt_character_set: Alternate character set to try if UTF-8 decoding does not work
+#   append_only: Single file that only grows by appending rows (activate_version streams only).
+#       If the previously synced rows are unchanged, only the appended rows are emitted.
+#       With config range_tail_fetch = true, only the appended bytes are downloaded (tail_fetch.py).
+#   change_key_properties: Natural key for snapshot files rewritten in place. With config
+#       row_change_detection = true, only inserted/changed rows and deleted key tombstones are emitted.
+#   row_date_field: Record date field (after transform) for the config row_date_filters window
+#   daily_delta: Cumulative series, key: location key fields, values: cumulative fields. With config
+#       daily_deltas = true, the records get <value>_delta, the change since the previous day (daily_delta.py).
 
 STREAMS = {
     # Reference: https://github.com/COVID19Tracking/covid-tracking-data/blob/master/data/us_daily.csv
@@ -22,6 +30,7 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': True,
+        'append_only': True,
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since'
     },
@@ -31,6 +40,7 @@ STREAMS = {
         'search_path': 'search/code?q=path:data+filename:states_current+extension:csv+repo:COVID19Tracking/covid-tracking-data&sort=indexed&order=desc',
         'data_key': 'items',
         'key_properties': ['__sdc_row_number'],
+        'change_key_properties': ['state'],
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': True,
@@ -46,6 +56,7 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': True,
+        'row_date_field': 'date',
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since'
     },
@@ -55,6 +66,7 @@ STREAMS = {
         'search_path': 'search/code?q=path:data+filename:states_info+extension:csv+repo:COVID19Tracking/covid-tracking-data&sort=indexed&order=desc',
         'data_key': 'items',
         'key_properties': ['__sdc_row_number'],
+        'change_key_properties': ['state'],
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': True,
@@ -158,6 +170,10 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': False,
+        'daily_delta': {
+            'key': ['country'],
+            'values': ['total_cases', 'deaths', 'discharged_recovered', 'tested']
+        },
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since',
         'alt_character_set': 'latin_1'
@@ -173,6 +189,10 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': False,
+        'daily_delta': {
+            'key': ['region_code', 'region'],
+            'values': ['total_cases', 'deaths', 'discharged_recovered', 'tested']
+        },
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since',
         'alt_character_set': 'latin_1'
@@ -188,6 +208,10 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': False,
+        'daily_delta': {
+            'key': ['region_code', 'province_code'],
+            'values': ['total_cases']
+        },
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since',
         'alt_character_set': 'latin_1'
@@ -201,6 +225,10 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': False,
+        'daily_delta': {
+            'key': ['country_region_cleansed', 'province_state_cleansed', 'admin_area'],
+            'values': ['confirmed', 'deaths', 'recovered']
+        },
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since'
     },
@@ -213,6 +241,11 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': True,
+        'append_only': True,
+        'daily_delta': {
+            'key': ['state'],
+            'values': ['cases', 'deaths']
+        },
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since'
     },
@@ -225,6 +258,12 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': True,
+        'append_only': True,
+        'row_date_field': 'date',
+        'daily_delta': {
+            'key': ['state', 'county'],
+            'values': ['cases', 'deaths']
+        },
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since'
     },
@@ -237,6 +276,7 @@ STREAMS = {
         'replication_method': 'FULL_TABLE',
 		'selected': True,
         'activate_version': False,
+        'row_date_field': 'date',
         'replication_keys': ['git_last_modified'],
         'bookmark_query_field': 'If-Modified-Since',
         'skip_header_rows': 3,
@@ -1,25 +1,50 @@
 
 import base64
 import io
-import csv
+import hashlib
+import itertools
+import json
+import re
 import time
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 import pytz
 import singer
 from singer import metrics, metadata, Transformer, utils
 from singer.utils import strptime_to_utc
 from singer.messages import RecordMessage
+from extract_covid_data import blob_batch
+from extract_covid_data import commit_log
+from extract_covid_data import daily_delta
+from extract_covid_data import local_store
+from extract_covid_data import memory_profile
+from extract_covid_data import parallel_transform
+from extract_covid_data import planner
+from extract_covid_data import raw_store
+from extract_covid_data import repo_probe
+from extract_covid_data import shards
+from extract_covid_data import tail_fetch
+from extract_covid_data import tarball
+from extract_covid_data.deadline import get_deadline, DeadlineExceeded
+from extract_covid_data.rows import FileMeta, read_csv_content
 from extract_covid_data.streams import STREAMS
-from extract_covid_data.transform import transform_record
+from extract_covid_data.transform import transform_record, get_column_projection, in_row_date_window
 
 LOGGER = singer.get_logger()
 
+DEFAULT_CHECKPOINT_INTERVAL = 60
+# Content checked for a new version of a file with a kept character set, see get_file_charsets
+CHARSET_SAMPLE_BYTES = 64 * 1024
+NON_ASCII_BYTE = re.compile(rb'[\x80-\xff]')
 
-def write_schema(catalog, stream_name):
+
+def write_schema(catalog, stream_name, key_properties=None):
     stream = catalog.get_stream(stream_name)
     schema = stream.schema.to_dict()
+    if key_properties is None:
+        key_properties = stream.key_properties
     try:
-        singer.write_schema(stream_name, schema, stream.key_properties)
+        singer.write_schema(stream_name, schema, key_properties)
     except OSError as err:
         LOGGER.error('OS Error writing schema for: {}'.format(stream_name))
         raise err
@@ -63,6 +88,45 @@ def write_bookmark(state, stream, value):
     singer.write_state(state)
 
 
+# Stream state, other than the bookmark, is kept under a separate top-level state key
+#   e.g. state['append_only'][stream_name] = {file_path: {...}}
+def get_stream_state(state, state_key, stream, default=None):
+    if (state is None) or (state_key not in state):
+        return default
+    return (
+        state
+        .get(state_key, {})
+        .get(stream, default)
+    )
+
+
+def set_stream_state(state, state_key, stream, value):
+    if state_key not in state:
+        state[state_key] = {}
+    state[state_key][stream] = value
+
+
+def delete_stream_state(state, state_key, stream):
+    if stream in state.get(state_key, {}):
+        del state[state_key][stream]
+
+
+# File-level checkpoint, written after each file (throttled, see checkpoint_interval):
+#   resume point for a stream interrupted before its bookmark is written
+#   state['checkpoints'][stream_name] = {search_url, page, item_index, processed_paths,
+#       max_bookmark_value, activate_version}
+#   With config resume_index_rows, also written within a file every resume_index_rows rows,
+#   with file = {path, sha, row_index, row_number}: the next csv row and __sdc_row_number
+def write_checkpoint(state, stream, checkpoint):
+    set_stream_state(state, 'checkpoints', stream, checkpoint)
+    LOGGER.info('Write checkpoint for stream: {}, page: {}, item: {}, processed files: {}'.format(
+        stream,
+        checkpoint.get('page'),
+        checkpoint.get('item_index'),
+        len(checkpoint.get('processed_paths', []))))
+    singer.write_state(state)
+
+
 def transform_datetime(this_dttm):
     with Transformer() as transformer:
         new_dttm = transformer._transform_datetime(this_dttm)
@@ -102,6 +166,205 @@ def process_records(catalog, #pylint: disable=too-many-branches
         return counter.value
 
 
+# Append-only files: hash the csv header and each row in order, so that the hash after
+#   row_count rows identifies the prefix of the file that was previously synced
+def hash_csv_row(hasher, values):
+    hasher.update('\x1f'.join('' if val is None else str(val) for val in values).encode('utf-8'))
+    hasher.update(b'\x1e')
+
+
+# Returns the number of csv rows already synced (0 if the file prefix changed)
+#   and the hash of the whole file, saved in the state for the next sync
+def check_append_only_prefix(file_state, fieldnames, content_rows):
+    row_count = 0
+    if file_state:
+        row_count = file_state.get('row_count', 0)
+    hasher = hashlib.sha256()
+    hash_csv_row(hasher, fieldnames or [])
+    prefix_hash = None
+    for row_index, row in enumerate(content_rows, 1):
+        hash_csv_row(hasher, row.cells)
+        if row_index == row_count:
+            prefix_hash = hasher.hexdigest()
+    skip_rows = 0
+    if row_count > 0 and prefix_hash == file_state.get('prefix_hash'):
+        skip_rows = row_count
+    return skip_rows, hasher.hexdigest()
+
+
+# Character sets to try for a file. The character set that decoded a file (other than utf-8) is
+#   kept by path with the blob sha it decoded (local store charsets/<stream>.json: {file path:
+#   {sha, charset}}) and tried first, also for the next versions of the file. latin_1 decodes
+#   any bytes (it never falls back to utf-8), so for a new version (other blob sha) a sample of
+#   the content is checked: if its first non-ASCII bytes are valid utf-8 (e.g. the file was
+#   re-encoded), utf-8 is tried first.
+#   content: file bytes for the check (None: no check, e.g. reprocess)
+def get_file_charsets(stream_charsets, file_path, file_sha, alt_character_set, content=None):
+    file_charset = stream_charsets.get(file_path)
+    remembered = None
+    if isinstance(file_charset, dict):
+        remembered = file_charset.get('charset')
+        if remembered and file_charset.get('sha') != file_sha and content is not None \
+            and is_utf8_sample(content):
+            remembered = None
+    charsets = []
+    for charset in (remembered, 'utf-8', alt_character_set):
+        if charset and charset not in charsets:
+            charsets.append(charset)
+    return charsets
+
+
+# Are the first non-ASCII bytes of the content (CHARSET_SAMPLE_BYTES from the first one) utf-8?
+#   False for ASCII-only content (decoded the same by any of the character sets)
+def is_utf8_sample(content):
+    match = NON_ASCII_BYTE.search(content)
+    if match is None:
+        return False
+    sample = content[match.start():match.start() + CHARSET_SAMPLE_BYTES]
+    try:
+        sample.decode('utf-8')
+    except UnicodeDecodeError as err:
+        # A character cut at the end of the sample
+        return err.reason == 'unexpected end of data' and len(sample) == CHARSET_SAMPLE_BYTES \
+            and match.start() + CHARSET_SAMPLE_BYTES < len(content)
+    return True
+
+
+# Returns True if the kept character sets changed
+def set_file_charset(stream_charsets, file_path, file_sha, charset):
+    if charset == 'utf-8':
+        return stream_charsets.pop(file_path, None) is not None
+    file_charset = {'sha': file_sha, 'charset': charset}
+    if stream_charsets.get(file_path) == file_charset:
+        return False
+    stream_charsets[file_path] = file_charset
+    return True
+
+
+# Row change detection: compact hash of the csv values of a row (before transform)
+def get_row_hash(values):
+    hasher = hashlib.sha1()
+    hash_csv_row(hasher, values)
+    return hasher.hexdigest()[:16]
+
+
+# Row change detection: the row hashes in the local store (row_hashes/<stream>.json) are used only
+#   with the STATE written with them: each write gets a new id, kept in the store and in
+#   state['row_hashes'][stream_name]. If the target did not commit that STATE (the next run starts
+#   from an older bookmark or checkpoint), the ids differ and all rows are emitted.
+def read_row_hashes(cache_dir, row_hashes_name, state, stream_name):
+    stored = local_store.read_json(cache_dir, row_hashes_name, {})
+    if not stored:
+        return {}
+    if stored.get('id') is None or stored.get('id') != get_stream_state(state, 'row_hashes', stream_name):
+        LOGGER.warning('ROW CHANGES, Stream: {}, row hashes do not match the state, all rows are emitted'.format(
+            stream_name))
+        return {}
+    return stored.get('files', {})
+
+
+# Row change detection: write the row hashes, before the STATE message that records their id
+def write_row_hashes(cache_dir, row_hashes_name, state, stream_name, stream_row_hashes):
+    row_hashes_id = uuid.uuid4().hex
+    local_store.write_json(cache_dir, row_hashes_name, {'id': row_hashes_id, 'files': stream_row_hashes})
+    set_stream_state(state, 'row_hashes', stream_name, row_hashes_id)
+
+
+# Row change detection: natural key of a transformed record, as a JSON list string
+def get_row_key(record, key_properties):
+    return json.dumps([record.get(key) for key in key_properties], default=str)
+
+
+# Transform the compact csv rows of a file, yielding one transformed record at a time
+#   file_progress['row_number']: next __sdc_row_number (rows dropped by transform_record are not numbered)
+#   With row change detection, unchanged rows are skipped and the new row hashes
+#   are collected in file_progress['row_hashes']
+#   With a row date window, rows outside the window are numbered but not emitted
+#   row_checkpoint(row_index, row_number): called every row_checkpoint_every csv rows, when the
+#   records of the previous rows have been written (first_row_index: csv row index of the first row)
+#   daily_deltas (DailyDeltas): adds the daily delta fields, before the row date window
+def transform_file_rows(stream_name,
+                        rows,
+                        file_progress,
+                        change_key_properties=None,
+                        row_hashes=None,
+                        row_date_filter=None,
+                        first_row_index=0,
+                        row_checkpoint=None,
+                        row_checkpoint_every=None,
+                        daily_deltas=None):
+    row_index = first_row_index
+    for row in rows:
+        if row_checkpoint and row_index > first_row_index and row_index % row_checkpoint_every == 0:
+            row_checkpoint(row_index, file_progress['row_number'])
+        row_index = row_index + 1
+        record = row.to_dict(file_progress['row_number'])
+
+        # Transform record
+        try:
+            transformed_csv_record = transform_record(stream_name, record)
+        except Exception as err:
+            LOGGER.error('Transform Record error: {}, Stream: {}'.format(err, stream_name))
+            LOGGER.error('record: {}'.format(record))
+            raise err
+
+        # Bad records and totals
+        if transformed_csv_record is None:
+            continue
+        file_progress['row_number'] = file_progress['row_number'] + 1
+
+        if daily_deltas:
+            daily_deltas.enrich(transformed_csv_record)
+
+        if row_date_filter and not in_row_date_window(transformed_csv_record, row_date_filter):
+            continue
+
+        if change_key_properties:
+            row_key = get_row_key(transformed_csv_record, change_key_properties)
+            row_hash = get_row_hash(row.cells)
+            file_progress['row_hashes'][row_key] = row_hash
+            if row_hashes.get(row_key) == row_hash:
+                # Unchanged row, skip
+                continue
+
+        yield transformed_csv_record
+
+
+# Row change detection: tombstones for keys deleted from the file since the last sync
+#   (runs after transform_file_rows has collected the new row hashes)
+def get_deleted_records(file_meta, change_key_properties, row_hashes, file_progress, time_extracted):
+    new_row_hashes = file_progress['row_hashes']
+    deleted_keys = [key for key in row_hashes if key not in new_row_hashes]
+    LOGGER.info('ROW CHANGES, file: {}, deleted keys: {}'.format(file_meta.git_path, len(deleted_keys)))
+    deleted_at = utils.strftime(time_extracted)
+    for row_key in deleted_keys:
+        deleted_record = dict(zip(change_key_properties, json.loads(row_key)))
+        deleted_record.update(file_meta.get_git_fields())
+        deleted_record['_sdc_deleted_at'] = deleted_at
+        yield deleted_record
+
+
+# Row date window from config row_date_filters, for streams with a row_date_field, e.g.
+#   {"nytimes_us_counties": {"min_date": "2020-06-01", "max_date": "2020-12-31"},
+#    "neherlab_case_counts": {"days": 30}}
+#   days: minimum date = today - days (UTC). Returns (date_field, min_date, max_date) or None
+def get_row_date_filter(stream_name, endpoint_config, config):
+    stream_filter = ((config or {}).get('row_date_filters') or {}).get(stream_name)
+    if not stream_filter:
+        return None
+    date_field = endpoint_config.get('row_date_field')
+    if not date_field:
+        LOGGER.warning('Stream: {} has no row_date_field, row_date_filters ignored'.format(stream_name))
+        return None
+    min_date = stream_filter.get('min_date')
+    if stream_filter.get('days') is not None:
+        min_date = (utils.now() - timedelta(days=stream_filter['days'])).strftime('%Y-%m-%d')
+    max_date = stream_filter.get('max_date')
+    LOGGER.info('ROW DATE FILTER, Stream: {}, field: {}, min_date: {}, max_date: {}'.format(
+        stream_name, date_field, min_date, max_date))
+    return (date_field, min_date[:10] if min_date else None, max_date[:10] if max_date else None)
+
+
 # Sync a specific endpoint.
 def sync_endpoint(client, #pylint: disable=too-many-branches
                   catalog,
@@ -111,7 +374,10 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
                   search_path,
                   endpoint_config,
                   bookmark_field=None,
-                  selected_streams=None):
+                  selected_streams=None,
+                  config=None,
+                  file_partition=None,
+                  deadline=None):
 
     # Endpoint parameters
     bookmark_query_field = endpoint_config.get('bookmark_query_field', None)
@@ -121,6 +387,60 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
     skip_header_rows = endpoint_config.get('skip_header_rows', 0)
     activate_version_ind = endpoint_config.get('activate_version', False)
     alt_character_set = endpoint_config.get('alt_character_set', 'utf-8')
+    append_only_ind = endpoint_config.get('append_only', False)
+    # Range-request tail fetch of append-only files (config range_tail_fetch, see tail_fetch.py)
+    tail_fetch_ind = tail_fetch.is_enabled(config, endpoint_config)
+    # Row change detection (config row_change_detection): emit only inserted/changed rows
+    #   and tombstones for deleted keys, keyed on change_key_properties (NOT activate_version)
+    change_key_properties = endpoint_config.get('change_key_properties')
+    change_detection_ind = bool(change_key_properties) and \
+        bool((config or {}).get('row_change_detection', False))
+    if change_detection_ind:
+        activate_version_ind = False
+        cache_dir = local_store.get_cache_dir(config)
+        row_hashes_name = 'row_hashes/{}.json'.format(stream_name)
+        stream_row_hashes = read_row_hashes(cache_dir, row_hashes_name, state, stream_name)
+    # Daily deltas of cumulative series (config daily_deltas, see daily_delta.py): rows in file order
+    #   (not transformed in the process pool), not for shard file partitions (the previous day may
+    #   be in another partition)
+    daily_deltas = None
+    if daily_delta.is_enabled(config, endpoint_config):
+        if file_partition:
+            LOGGER.warning('Stream: {}, daily deltas are not computed for shard file partitions'.format(
+                stream_name))
+        else:
+            daily_deltas = daily_delta.DailyDeltas(state, stream_name, endpoint_config, config)
+    # Daily deltas of a multi-file stream: files oldest first (the previous day before the day),
+    #   from the commit log (the search results are newest first, page by page); files of the
+    #   same commit by path (daily report file names have the date)
+    oldest_first_ind = daily_deltas is not None and not activate_version_ind
+    parallel_min_bytes = parallel_transform.get_parallel_min_bytes(config)
+    if daily_deltas:
+        parallel_min_bytes = None
+    # Memory instrumentation per file and stage (config memory_profile, see memory_profile.py)
+    profiler = memory_profile.get_profiler(config)
+    row_date_filter = get_row_date_filter(stream_name, endpoint_config, config)
+    # Batched GraphQL blob fetch (config graphql_batch_sizes, see blob_batch.py):
+    #   blob data by sha, for the next files of the search page; shas already tried
+    graphql_batch_size = blob_batch.get_batch_size(stream_name, config)
+    batch_blobs = {}
+    batch_tried_shas = set()
+    # Character set that decoded each file version, see get_file_charsets (local store)
+    charsets_name = 'charsets/{}.json'.format(stream_name)
+    stream_charsets = local_store.read_json(local_store.get_cache_dir(config), charsets_name, {})
+    stream_charsets_changed = False
+    # Raw file store for the offline reprocess (config raw_file_store, see raw_store.py)
+    raw_index = None
+    if raw_store.is_enabled(config):
+        raw_index = raw_store.read_index(local_store.get_cache_dir(config), stream_name)
+    # Minimum seconds between checkpoint STATE messages (config checkpoint_interval)
+    checkpoint_interval = (config or {}).get('checkpoint_interval', DEFAULT_CHECKPOINT_INTERVAL)
+    # Mid-file resume (config resume_index_rows = N): byte offset of every Nth csv row of the file
+    #   in progress (local store row_index/<blob sha>.json) and a checkpoint every N rows
+    #   (not with row change detection or daily deltas, or for files transformed in the process pool)
+    resume_index_rows = (config or {}).get('resume_index_rows')
+    if change_detection_ind or daily_deltas:
+        resume_index_rows = None
     # LOGGER.info('data_key = {}'.format(data_key))
 
     # Get the latest bookmark for the stream and set the last_datetime
@@ -129,15 +449,32 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
     timezone = pytz.timezone('UTC')
     bookmark_dttm = utils.now() # Initialize bookmark_dttn
     max_bookmark_value = None
+    activate_version = None
 
     # Convert to GitHub date format, example: Sun, 13 Oct 2019 22:40:01 GMT
     last_modified = last_dttm.strftime("%a, %d %b %Y %H:%M:%S %Z'")
     LOGGER.info('HEADER If-Modified-Since: {}'.format(last_modified))
 
     # Write schema and log selected fields for stream
-    write_schema(catalog, stream_name)
+    if change_detection_ind:
+        write_schema(catalog, stream_name, key_properties=change_key_properties)
+    else:
+        write_schema(catalog, stream_name)
     selected_fields = get_selected_fields(catalog, stream_name)
     LOGGER.info('Stream: {}, selected_fields: {}'.format(stream_name, selected_fields))
+    # Column projection pushdown: source columns of fields dropped by the Transformer
+    #   are not stored, transformed, coerced or serialized
+    dropped_fields = get_dropped_fields(catalog, stream_name).difference(
+        endpoint_config.get('change_key_properties', []))
+    if daily_deltas:
+        dropped_fields = dropped_fields.difference(daily_deltas.key_fields, daily_deltas.value_fields)
+    # Row date window: the row_date_field is kept (even if not selected) for the window check
+    if row_date_filter:
+        dropped_fields = dropped_fields.difference([row_date_filter[0]])
+    keep_column = get_column_projection(stream_name, dropped_fields)
+    if keep_column:
+        LOGGER.info('Stream: {}, column projection, dropped fields: {}'.format(
+            stream_name, sorted(dropped_fields)))
     
     # pagination: loop thru all pages of data using next_url (if not None)
     page = 1
@@ -145,18 +482,111 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
     file_count = 0
     total_records = 0
     next_url = '{}/{}'.format(client.base_url, search_path)
+    first_record = True
+
+    # Resume from the checkpoint of an interrupted sync: restart at the checkpoint search page,
+    #   skip processed files, keep the provisional max bookmark and activate version
+    checkpoint = get_stream_state(state, 'checkpoints', stream_name)
+    processed_paths = set()
+    resume_file = None
+    if checkpoint:
+        resume_file = checkpoint.get('file')
+        next_url = checkpoint.get('search_url', next_url)
+        page = checkpoint.get('page', page)
+        processed_paths = set(checkpoint.get('processed_paths', []))
+        max_bookmark_value = checkpoint.get('max_bookmark_value')
+        if max_bookmark_value:
+            first_record = False
+        if activate_version_ind and max_bookmark_value:
+            activate_version = checkpoint.get('activate_version')
+            activate_version_message = singer.ActivateVersionMessage(
+                stream=stream_name,
+                version=activate_version)
+        LOGGER.info('RESUME Stream: {}, page: {}, processed files: {}, max bookmark: {}'.format(
+            stream_name, page, len(processed_paths), max_bookmark_value))
+    last_checkpoint_time = time.time()
+
+    # Mid-file checkpoint (the file's records before row_index have been written)
+    #   Past the deadline, the file is abandoned at this row (DeadlineExceeded)
+    def write_file_checkpoint(row_index, row_number):
+        nonlocal last_checkpoint_time
+        expired = deadline is not None and deadline.is_expired(stream_name)
+        if not expired and time.time() - last_checkpoint_time < checkpoint_interval:
+            return
+        write_checkpoint(state, stream_name, {
+            'search_url': search_url,
+            'page': page,
+            'item_index': i,
+            'processed_paths': sorted(processed_paths),
+            'max_bookmark_value': max_bookmark_value,
+            'activate_version': activate_version,
+            'file': {
+                'path': file_path,
+                'sha': file_sha,
+                'row_index': row_index,
+                'row_number': row_number
+            }
+        })
+        last_checkpoint_time = time.time()
+        if expired:
+            raise DeadlineExceeded('Stream: {}, file: {}, row: {}'.format(stream_name, file_path, row_index))
+
+    # Commit-log change detection (config commit_change_detection, not for the initial sync):
+    #   the files changed since the bookmark replace the search results
+    commit_items = None
+    if (config or {}).get('commit_change_detection', False) and last_datetime != start_date:
+        commit_items = commit_log.get_changed_files(
+            client=client,
+            stream_name=stream_name,
+            search_path=search_path,
+            since=last_datetime,
+            exclude_files=exclude_files)
+    # Tarball backfill (config tarball_backfill, initial sync, see tarball.py): the commit-log
+    #   files since the start_date, with their contents extracted from the repository archive
+    tarball_files = {}
+    backfill_ind = tarball.is_backfill(config, endpoint_config, last_datetime, start_date)
+    if backfill_ind:
+        commit_items = commit_log.get_changed_files(
+            client=client,
+            stream_name=stream_name,
+            search_path=search_path,
+            since=start_date,
+            exclude_files=exclude_files)
+        tarball_files = tarball.extract_files(
+            client, config, stream_name, search_path,
+            [item for item in commit_items if item.get('path') not in processed_paths and (
+                not file_partition or shards.in_file_partition(item.get('path'), file_partition))])
+
+    if oldest_first_ind:
+        if commit_items is None:
+            commit_items = commit_log.get_changed_files(
+                client=client,
+                stream_name=stream_name,
+                search_path=search_path,
+                since=last_datetime,
+                exclude_files=exclude_files)
+        commit_items = sorted(
+            commit_items, key=lambda item: (item.get('last_modified') or '', item.get('path') or ''))
+
+    # Deadline (deadline.py): stopped before the next file, or within the file (file_abandoned)
+    deadline_stopped = False
+    file_abandoned = False
 
     # Loop through all search items pages (while there are more pages, next_url)
     #   and until bookmark_dttm < last_dttm
-    first_record = True
     while next_url is not None and bookmark_dttm >= last_dttm:
         LOGGER.info('Search URL for Stream {}: {}'.format(stream_name, next_url))
 
         # API request search_data
         search_data = {}
-        search_data, next_url, search_last_modified = client.get(
-            url=next_url,
-            endpoint=stream_name)
+        search_url = next_url
+        if commit_items is not None:
+            search_data = {data_key: commit_items}
+            next_url = None
+        else:
+            search_data, next_url, search_last_modified = client.get(
+                url=next_url,
+                endpoint=stream_name)
         LOGGER.info('next_url = {}'.format(next_url))
         # LOGGER.info('search_data = {}'.format(search_data)) # COMMENT OUT
 
@@ -176,11 +606,21 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
             # Skip excluded files
             if file_name in exclude_files:
                 i = i + 1
-                if i > (item_total - 1):
-                    break
-                else:
-                    item = search_items[i]
-            csv_records = []
+                continue
+            # Skip files processed before the sync was interrupted
+            if item.get('path') in processed_paths:
+                LOGGER.info('Stream: {}, skipping file processed before restart: {}'.format(
+                    stream_name, item.get('path')))
+                i = i + 1
+                continue
+            # Sharded sync: skip files of the other partitions of the stream (shards.py)
+            if file_partition and not shards.in_file_partition(item.get('path'), file_partition):
+                i = i + 1
+                continue
+            # No time left for the next file: stop the stream, resume at this search page
+            if deadline and deadline.should_stop(stream_name):
+                deadline_stopped = True
+                break
             file_count = file_count + 1
             # url (content url) is preferable to git_url (blob url) b/c it provides
             #   last-modified header for bookmark
@@ -195,17 +635,25 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
             file_name = item.get('name')
             file_html_url = item.get('html_url')
             
-            headers = {}
-            if bookmark_query_field:
-                headers[bookmark_query_field] = last_modified
-            # API request commits_data for single-file, to get file last_modified
-            commit_url = '{}/repos/{}/{}/commits?path={}'.format(
-                client.base_url, git_owner, git_repository, file_path)
-            LOGGER.info('Commit URL for Stream {}: {}'.format(stream_name, commit_url))
-            commit_data, commits_next_url, commit_last_modified = client.get(
-                url=commit_url,
-                headers=headers,
-                endpoint='{}_commits'.format(stream_name))
+            commit_ref = 'HEAD'
+            if item.get('last_modified'):
+                # Commit-log change detection: last modified from the commit log
+                commit_data = [item]
+                commit_last_modified = item.get('last_modified')
+            else:
+                headers = {}
+                if bookmark_query_field:
+                    headers[bookmark_query_field] = last_modified
+                # API request commits_data for single-file, to get file last_modified
+                commit_url = '{}/repos/{}/{}/commits?path={}'.format(
+                    client.base_url, git_owner, git_repository, file_path)
+                LOGGER.info('Commit URL for Stream {}: {}'.format(stream_name, commit_url))
+                commit_data, commits_next_url, commit_last_modified = client.get(
+                    url=commit_url,
+                    headers=headers,
+                    endpoint='{}_commits'.format(stream_name))
+                if commit_data:
+                    commit_ref = commit_data[0].get('sha') or commit_ref
             
             # Bookmarking: search data (and commit data) sorted by last-modified desc
             # 1st item on 1st page sets max_bookmark_value = last-modified
@@ -235,85 +683,274 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
                 else:
                     activate_version = None
                 # End: if first_record and bookmark_dttm > last_dttm
+            elif oldest_first_ind and bookmark_dttm > last_dttm and (
+                    not max_bookmark_value or bookmark_dttm > strptime_to_utc(max_bookmark_value)):
+                # Oldest first: the last file sets max_bookmark_value
+                max_bookmark_value = commit_last_modified
 
             if commit_data and bookmark_dttm >= last_dttm:
                 # API request file_data for item, single-file (ignore file_next_url)
                 file_data = {}
                 headers = {}
                 LOGGER.info('File URL for Stream {}: {}'.format(stream_name, file_url))
-                file_data, file_next_url, file_last_modified = client.get(
-                    url=file_url,
-                    headers=headers,
-                    endpoint=stream_name)
+                if deadline:
+                    deadline.start_file()
+                profiler.start_file(stream_name, file_path)
+                profiler.start_stage('fetch')
+                file_data = None
+                if file_path in tarball_files:
+                    file_data = tarball.pop_file(tarball_files, file_path)
+                elif graphql_batch_size and file_sha not in batch_tried_shas:
+                    # This file and the next files of the page, in one query
+                    batch_shas = [file_sha]
+                    for next_item in search_items[i + 1:]:
+                        if len(batch_shas) >= graphql_batch_size:
+                            break
+                        next_path = next_item.get('path')
+                        if next_item.get('sha') in batch_tried_shas or next_path in processed_paths \
+                            or next_item.get('name') in exclude_files:
+                            continue
+                        if file_partition and not shards.in_file_partition(next_path, file_partition):
+                            continue
+                        batch_shas.append(next_item.get('sha'))
+                    batch_tried_shas.update(batch_shas)
+                    batch_blobs.update(blob_batch.fetch_blob_texts(
+                        client, config, stream_name, git_owner, git_repository, batch_shas))
+                if file_data is None and tail_fetch_ind:
+                    file_data = tail_fetch.fetch_file(
+                        client, config, stream_name, git_owner, git_repository, commit_ref, file_path, file_sha,
+                        get_stream_state(state, 'append_only', stream_name, {}).get(file_path))
+                if file_data is None:
+                    file_data = batch_blobs.pop(file_sha, None)
+                if file_data is None:
+                    file_data, file_next_url, file_last_modified = client.get(
+                        url=file_url,
+                        headers=headers,
+                        endpoint=stream_name)
+                profiler.end_stage()
                 # LOGGER.info('file_data: {}'.format(file_data)) # TESTING ONLY - COMMENT OUT
 
+                parallel_record_count = None
+                records = []
+                file_hash = None
+                file_progress = {'row_number': 1, 'row_hashes': {}}
+                first_row_index = 0
+                row_index_name = 'row_index/{}.json'.format(file_sha)
+                # Interrupted in this file (same blob): continue from the checkpoint row
+                file_resume = None
+                if resume_file and resume_file.get('path') == file_path \
+                    and resume_file.get('sha') == file_sha:
+                    file_resume = resume_file
+                resume_file = None
                 if file_data:
-                    # Read, decode, and parse content blob to json
+                    # Read, decode, and parse content blob to compact csv rows
                     content = file_data.get('content')
-                    content_list = []
+                    content_rows = []
+                    skip_rows = 0
+                    content_size = 0
+                    file_meta = FileMeta(
+                        git_owner=git_owner,
+                        git_repository=git_repository,
+                        git_url=file_url,
+                        git_html_url=file_html_url,
+                        git_path=file_path,
+                        git_sha=file_sha,
+                        git_file_name=file_name,
+                        git_last_modified=commit_last_modified)
                     if content:
-                        content_b64 = base64.b64decode(content)
+                        profiler.start_stage('decode')
+                        if file_data.get('encoding') == 'utf-8':
+                            # GraphQL batch: text, not base64
+                            content_b64 = content.encode('utf-8')
+                        elif file_data.get('encoding') == 'raw':
+                            # Tarball backfill: file bytes
+                            content_b64 = content
+                        else:
+                            content_b64 = base64.b64decode(content)
+                        content_size = len(content_b64)
+                        profiler.end_stage()
+                        if raw_index is not None:
+                            raw_store.store_file(
+                                local_store.get_cache_dir(config), stream_name, raw_index, file_meta, content_b64)
                         # Italian files typically use character_set: utf-8
                         #  However, some newer files use character_set: latin_1
                         # All other files use character_set: utf-8 (default)
-                        try:
-                            content_str = content_b64.decode('utf-8')
-                        except UnicodeDecodeError as err:
-                            LOGGER.warning('UTF-8 UNICODE DECODE ERROR: {}'.format(err))
-                            # Try decoding with Alternate Character Set (from streams.py)
-                            content_str = content_b64.decode(alt_character_set)
-                        content_array = content_str.splitlines()
-                        content_array_sliced = content_array[skip_header_rows:]
-                        reader = csv.DictReader(content_array_sliced, delimiter=csv_delimiter)
-                        content_list = [r for r in reader]
+                        # Try the character set that decoded this file before first,
+                        #   then utf-8, then the Alternate Character Set (from streams.py)
+                        charsets = get_file_charsets(
+                            stream_charsets, file_path, file_sha, alt_character_set, content_b64)
+                        if file_data.get('encoding') == 'utf-8':
+                            charsets = ['utf-8']
+                        profiler.start_stage('parse')
+                        row_index = None
+                        if file_resume and not append_only_ind:
+                            row_index = local_store.read_json(
+                                local_store.get_cache_dir(config), row_index_name)
+                        if row_index and file_resume['row_index'] // row_index['every'] < len(row_index['offsets']):
+                            # Mid-file resume: parse from the byte offset of the checkpoint row
+                            first_row_index = file_resume['row_index']
+                            offset = row_index['offsets'][first_row_index // row_index['every']]
+                            content_rows, charset = read_csv_content(
+                                content_b64[offset:],
+                                file_meta,
+                                [row_index['charset']],
+                                delimiter=csv_delimiter,
+                                keep_column=keep_column,
+                                fieldnames=row_index['fieldnames'])
+                            LOGGER.info('RESUME FILE, Stream: {}, file: {}, row: {}, byte offset: {}'.format(
+                                stream_name, file_path, first_row_index, offset))
+                        else:
+                            row_index = None
+                            if resume_index_rows and (
+                                    parallel_min_bytes is None or content_size < parallel_min_bytes):
+                                row_index = {'every': resume_index_rows, 'offsets': []}
+                            content_rows, charset = read_csv_content(
+                                content_b64,
+                                file_meta,
+                                charsets,
+                                skip_header_rows=skip_header_rows,
+                                delimiter=csv_delimiter,
+                                keep_column=keep_column,
+                                row_index=row_index)
+                            if row_index and len(content_rows) > resume_index_rows:
+                                row_index['charset'] = charset
+                                local_store.write_json(
+                                    local_store.get_cache_dir(config), row_index_name, row_index)
+                        profiler.end_stage()
+                        if file_data.get('encoding') != 'utf-8' and \
+                            set_file_charset(stream_charsets, file_path, file_sha, charset):
+                            stream_charsets_changed = True
+                        if append_only_ind and first_row_index == 0:
+                            file_state = get_stream_state(
+                                state, 'append_only', stream_name, {}).get(file_path)
+                            skip_rows, file_hash = check_append_only_prefix(
+                                file_state, file_meta.fieldnames, content_rows)
 
                     LOGGER.info('Retrieved file_name: {}'.format(file_name))
 
                     # LOGGER.info('file_data: {}'.format(file_data)) # TESTING ONLY - COMMENT OUT
 
-                    # Loop thru and append csv records
-                    row_number = 1
-                    for record in content_list:
-                        record['git_owner'] = git_owner
-                        record['git_repository'] = git_repository
-                        record['git_url'] = file_url
-                        record['git_html_url'] = file_html_url
-                        record['git_path'] = file_path
-                        record['git_sha'] = file_sha
-                        record['git_file_name'] = file_name
-                        record['git_last_modified'] = commit_last_modified
-                        record['__sdc_row_number'] = row_number
-
-                        # Transform record and append
-                        transformed_csv_record = {}
-                        try:
-                            transformed_csv_record = transform_record(stream_name, record)
-                        except Exception as err:
-                            LOGGER.error('Transform Record error: {}, Stream: {}'.format(err, stream_name))
-                            LOGGER.error('record: {}'.format(record))
-                            raise err
-
-                        # Bad records and totals
-                        if transformed_csv_record is None:
-                            continue
-
-                        csv_records.append(transformed_csv_record)
-                        row_number = row_number + 1
+                    # Loop thru and transform csv records
+                    if skip_rows > 0:
+                        # Append-only: previously synced rows are unchanged, emit the new rows only,
+                        #   continuing the row numbers and the version of the previous full load
+                        LOGGER.info('APPEND ONLY, Stream: {}, file: {}, skipping {} synced rows'.format(
+                            stream_name, file_path, skip_rows))
+                        file_progress['row_number'] = file_state.get('last_row_number', 0) + 1
+                        activate_version = file_state.get('version')
+                        activate_version_message = singer.ActivateVersionMessage(
+                            stream=stream_name,
+                            version=activate_version)
+                    if first_row_index > 0:
+                        rows = iter(content_rows)
+                    elif file_resume:
+                        # No row index (e.g. append-only, for the prefix hash): skip the written rows
+                        first_row_index = max(skip_rows, file_resume['row_index'])
+                        rows = itertools.islice(content_rows, first_row_index, None)
+                    else:
+                        first_row_index = skip_rows
+                        rows = itertools.islice(content_rows, skip_rows, None)
+                    if file_resume:
+                        file_progress['row_number'] = file_resume['row_number']
+                    if daily_deltas and activate_version_ind and first_row_index == 0:
+                        daily_deltas.reset()
+                    profiler.start_stage('transform_emit')
+                    if parallel_min_bytes is not None and not change_detection_ind \
+                        and content_size >= parallel_min_bytes:
+                        # Large file: transform, coerce and serialize rows in a process pool
+                        parallel_record_count, file_progress['row_number'] = \
+                            parallel_transform.process_file_parallel(
+                                catalog=catalog,
+                                stream_name=stream_name,
+                                config=config,
+                                rows=rows,
+                                row_number=file_progress['row_number'],
+                                time_extracted=time_extracted,
+                                version=activate_version,
+                                row_date_filter=row_date_filter)
+                    elif change_detection_ind:
+                        row_hashes = stream_row_hashes.get(file_path, {})
+                        records = itertools.chain(
+                            transform_file_rows(
+                                stream_name, rows, file_progress, change_key_properties, row_hashes,
+                                row_date_filter=row_date_filter),
+                            get_deleted_records(
+                                file_meta, change_key_properties, row_hashes, file_progress, time_extracted))
+                    else:
+                        # Records are transformed lazily, as they are processed (one dict per row at a time)
+                        records = transform_file_rows(
+                            stream_name,
+                            rows,
+                            file_progress,
+                            row_date_filter=row_date_filter,
+                            first_row_index=first_row_index,
+                            row_checkpoint=write_file_checkpoint if resume_index_rows else None,
+                            row_checkpoint_every=resume_index_rows,
+                            daily_deltas=daily_deltas)
                     # End If file_data
 
-                record_count = process_records(
-                    catalog=catalog,
-                    stream_name=stream_name,
-                    records=csv_records,
-                    time_extracted=time_extracted,
-                    version=activate_version)
+                if parallel_record_count is None:
+                    try:
+                        record_count = process_records(
+                            catalog=catalog,
+                            stream_name=stream_name,
+                            records=records,
+                            time_extracted=time_extracted,
+                            version=activate_version)
+                    except DeadlineExceeded as err:
+                        # The file's row checkpoint (and row index) is the resume point
+                        LOGGER.warning('DEADLINE, file abandoned: {}'.format(err))
+                        profiler.end_file()
+                        deadline_stopped = True
+                        file_abandoned = True
+                        break
+                else:
+                    record_count = parallel_record_count
+                profiler.end_file(record_count)
+                if deadline:
+                    deadline.end_file(stream_name)
                 LOGGER.info('Stream {}, batch processed {} records'.format(
                     stream_name, record_count))
                 total_records = total_records + record_count
+
+                if file_data and change_detection_ind:
+                    stream_row_hashes[file_path] = file_progress['row_hashes']
+                if resume_index_rows:
+                    local_store.delete_json(local_store.get_cache_dir(config), row_index_name)
+                if file_hash:
+                    stream_files = get_stream_state(state, 'append_only', stream_name, {})
+                    previous_file_state = stream_files.get(file_path)
+                    stream_files[file_path] = {
+                        'row_count': len(content_rows),
+                        'prefix_hash': file_hash,
+                        'last_row_number': file_progress['row_number'] - 1,
+                        'version': activate_version
+                    }
+                    if tail_fetch_ind:
+                        stream_files[file_path].update(tail_fetch.save_file(
+                            config, stream_name, previous_file_state, file_sha, content_b64))
+                    set_stream_state(state, 'append_only', stream_name, stream_files)
                 # End if commit_data
             first_record = False
+            processed_paths.add(file_path)
+            if time.time() - last_checkpoint_time >= checkpoint_interval:
+                if change_detection_ind:
+                    write_row_hashes(cache_dir, row_hashes_name, state, stream_name, stream_row_hashes)
+                if daily_deltas:
+                    daily_deltas.write()
+                write_checkpoint(state, stream_name, {
+                    'search_url': search_url,
+                    'page': page,
+                    'item_index': i,
+                    'processed_paths': sorted(processed_paths),
+                    'max_bookmark_value': max_bookmark_value,
+                    'activate_version': activate_version
+                })
+                last_checkpoint_time = time.time()
             i = i + 1 # Next search item record
             # End: while i <= (item_total - 1) and bookmark_dttm >= last_dttm
+        if deadline_stopped:
+            break
 
         # to_rec: to record; ending record for the batch page
         to_rec = offset + file_count
@@ -327,8 +964,44 @@ def sync_endpoint(client, #pylint: disable=too-many-branches
         page = page + 1
         # End: next_url is not None and bookmark_dttm >= last_dttm
 
-    if file_count > 0 and max_bookmark_value:
-        # End of Stream: Send Activate Version (if needed) and update State
+    if stream_charsets_changed:
+        local_store.write_json(local_store.get_cache_dir(config), charsets_name, stream_charsets)
+    if raw_index is not None:
+        raw_store.write_index(local_store.get_cache_dir(config), stream_name, raw_index)
+    if backfill_ind:
+        tarball.cleanup(config, stream_name)
+    profiler.end_stream(stream_name)
+
+    # Deadline: resumable STATE, the checkpoint is kept and the bookmark is not advanced
+    if deadline_stopped:
+        if change_detection_ind:
+            write_row_hashes(cache_dir, row_hashes_name, state, stream_name, stream_row_hashes)
+        if daily_deltas:
+            daily_deltas.write()
+        if not file_abandoned:
+            write_checkpoint(state, stream_name, {
+                'search_url': search_url,
+                'page': page,
+                'item_index': i,
+                'processed_paths': sorted(processed_paths),
+                'max_bookmark_value': max_bookmark_value,
+                'activate_version': activate_version
+            })
+        deadline.stop_stream(stream_name, {
+            'page': page,
+            'processed_files': len(processed_paths),
+            'file': file_path if file_abandoned else None
+        })
+        return total_records
+
+    # End of Stream: the bookmark replaces the checkpoint
+    delete_stream_state(state, 'checkpoints', stream_name)
+    if daily_deltas:
+        daily_deltas.write()
+    if (file_count > 0 or checkpoint) and max_bookmark_value:
+        # End of Stream: Save row hashes (if needed), Send Activate Version (if needed) and update State
+        if change_detection_ind:
+            write_row_hashes(cache_dir, row_hashes_name, state, stream_name, stream_row_hashes)
         if activate_version_ind:
             singer.write_message(activate_version_message)
         write_bookmark(state, stream_name, max_bookmark_value)
@@ -373,6 +1046,23 @@ def get_selected_fields(catalog, stream_name):
             pass
     return selected_fields
 
+
+# Fields removed by the Transformer (filter_data_by_metadata): not selected (selected = false)
+#   or unsupported, except automatic fields
+def get_dropped_fields(catalog, stream_name):
+    stream = catalog.get_stream(stream_name)
+    mdata = metadata.to_map(stream.metadata)
+    dropped_fields = set()
+    for breadcrumb, field_metadata in mdata.items():
+        if len(breadcrumb) != 2 or breadcrumb[0] != 'properties':
+            continue
+        inclusion = field_metadata.get('inclusion')
+        if inclusion == 'automatic':
+            continue
+        if field_metadata.get('selected') is False or inclusion == 'unsupported':
+            dropped_fields.add(breadcrumb[1])
+    return dropped_fields
+
 def sync(client, config, catalog, state):
     start_date = config.get('start_date')
 
@@ -388,25 +1078,112 @@ def sync(client, config, catalog, state):
     if not selected_streams:
         return
 
-    # Loop through selected_streams
-    for stream_name, endpoint_config in STREAMS.items():
-        if stream_name in selected_streams:
-            LOGGER.info('START Syncing Stream: {}'.format(stream_name))
-            update_currently_syncing(state, stream_name)
-            search_path = endpoint_config.get('search_path', stream_name)
-            bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
-            total_records = sync_endpoint(
-                client=client,
-                catalog=catalog,
-                state=state,
-                start_date=start_date,
-                stream_name=stream_name,
-                search_path=search_path,
-                endpoint_config=endpoint_config,
-                bookmark_field=bookmark_field,
-                selected_streams=selected_streams)
+    # Run deadline and stream time budgets (config max_runtime, stream_max_runtime, deadline.py)
+    deadline = get_deadline(config)
+    # Repository change probe (config repo_change_probe, repo_probe.py): pushed_at per repo, this run
+    repo_probes = {} if config.get('repo_change_probe', False) else None
 
-            update_currently_syncing(state, None)
-            LOGGER.info('FINISHED Syncing Stream: {}, total_records: {}'.format(
+    # Sharded sync: claim and sync shards of the streams from the shard directory (shards.py)
+    if config.get('shard_dir'):
+        shards.sync_shards(
+            client=client,
+            config=config,
+            catalog=catalog,
+            selected_streams=selected_streams,
+            sync_stream=sync_stream,
+            deadline=deadline,
+            repo_probes=repo_probes)
+        memory_profile.get_profiler(config).write_report()
+        return
+
+    # Stream order: rate budget plan (planner.py) or STREAMS order
+    stream_plans = {}
+    if config.get('rate_budget_scheduling', False):
+        plan = planner.get_sync_plan(client, config, state, selected_streams)
+        for stream_plan in plan['streams']:
+            stream_plans[stream_plan['stream']] = stream_plan
+        stream_names = [stream_plan['stream'] for stream_plan in plan['streams'] if stream_plan['scheduled']]
+        LOGGER.info('Sync plan, expected quota use: {}, deferred streams: {}'.format(
+            plan['expected_use'], plan['deferred']))
+    else:
+        stream_names = [stream_name for stream_name in STREAMS if stream_name in selected_streams]
+
+    # Loop through selected_streams
+    for stream_name in stream_names:
+        if deadline and deadline.is_run_over():
+            break
+        stream_plan = stream_plans.get(stream_name)
+        if stream_plan and not planner.has_core_budget(client, config, stream_plan):
+            LOGGER.warning('RATE BUDGET, Stream: {}, deferred to the next run, estimated core calls: {}, remaining: {}'.format(
                 stream_name,
-                total_records))
+                stream_plan['estimated_calls']['core'],
+                client.rate_limits['core']['remaining']))
+            continue
+        sync_stream(
+            client=client,
+            config=config,
+            catalog=catalog,
+            state=state,
+            stream_name=stream_name,
+            selected_streams=selected_streams,
+            deadline=deadline,
+            repo_probes=repo_probes)
+    if deadline:
+        deadline.log_remaining(stream_names)
+    memory_profile.get_profiler(config).write_report()
+
+
+def sync_stream(client, config, catalog, state, stream_name, selected_streams, file_partition=None,
+                deadline=None, repo_probes=None):
+    start_date = config.get('start_date')
+    endpoint_config = STREAMS[stream_name]
+    # Repository not pushed since the stream's last sync: skip the stream
+    #   (no search, commits or blob calls)
+    pushed_at = None
+    if repo_probes is not None:
+        pushed_at = repo_probe.probe_stream(client, state, endpoint_config, repo_probes)
+    if repo_probe.is_stream_unchanged(state, stream_name, endpoint_config, start_date, pushed_at):
+        LOGGER.info('SKIPPED Stream: {}, repository not pushed since the last sync, pushed_at: {}'.format(
+            stream_name, pushed_at))
+        singer.write_state(state)
+        return 0
+    LOGGER.info('START Syncing Stream: {}'.format(stream_name))
+    if deadline:
+        deadline.start_stream(stream_name)
+    update_currently_syncing(state, stream_name)
+    sync_kind = planner.get_sync_kind(stream_name, state, start_date)
+    quota_counts = dict(client.quota_counts)
+    search_path = endpoint_config.get('search_path', stream_name)
+    bookmark_field = next(iter(endpoint_config.get('replication_keys', [])), None)
+    total_records = sync_endpoint(
+        client=client,
+        catalog=catalog,
+        state=state,
+        start_date=start_date,
+        stream_name=stream_name,
+        search_path=search_path,
+        endpoint_config=endpoint_config,
+        bookmark_field=bookmark_field,
+        selected_streams=selected_streams,
+        config=config,
+        file_partition=file_partition,
+        deadline=deadline)
+
+    # Stopped at the deadline: currently_syncing and the checkpoint are kept for the next run
+    if deadline and deadline.is_stopped(stream_name):
+        LOGGER.info('STOPPED Syncing Stream: {}, total_records: {}'.format(stream_name, total_records))
+        return total_records
+
+    quota_used = {resource: count - quota_counts.get(resource, 0)
+                  for resource, count in client.quota_counts.items()}
+    # Before the STATE message of update_currently_syncing, so that the probe is kept
+    #   (file partitions: merged by shards.merge_states when all of the stream's units are done)
+    if not file_partition:
+        planner.record_stream_stats(config, stream_name, sync_kind, quota_used)
+        repo_probe.record_stream(state, stream_name, endpoint_config, pushed_at)
+    update_currently_syncing(state, None)
+    LOGGER.info('FINISHED Syncing Stream: {}, total_records: {}, quota used: {}'.format(
+        stream_name,
+        total_records,
+        quota_used))
+    return total_records
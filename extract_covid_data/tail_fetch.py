@@ -0,0 +1,118 @@
+import os
+import hashlib
+from urllib.parse import quote
+import singer
+from extract_covid_data import local_store
+
+LOGGER = singer.get_logger()
+
+# Range-request tail fetch for append-only files (config range_tail_fetch = true)
+#   The append_only state of a synced file also keeps its blob sha, byte length and the sha256 of
+#   its last TAIL_CHECK_BYTES bytes, and the file bytes are kept in the local store
+#   (<cache_dir>/tail/<stream>/<blob sha>). When the file changes, only the bytes from the old
+#   tail on are requested from the raw content URL (Range: bytes=<byte_length - TAIL_CHECK_BYTES>-):
+#   the old tail must be unchanged, and the old bytes plus the new bytes must have the blob sha of
+#   the search item (git blob sha1); otherwise the file is fetched with git/blobs (full download).
+# config.json:
+#   range_tail_fetch: Fetch the appended bytes of append-only files, default = false
+#   raw_url: Raw content URL, default = https://raw.githubusercontent.com
+DEFAULT_RAW_URL = 'https://raw.githubusercontent.com'
+TAIL_DIR = 'tail'
+TAIL_CHECK_BYTES = 4096
+CHUNK_SIZE = 1024 * 1024
+
+
+def is_enabled(config, endpoint_config):
+    if not (config or {}).get('range_tail_fetch', False):
+        return False
+    return endpoint_config.get('append_only', False)
+
+
+def get_blob_sha(content):
+    # Git blob sha: sha1 of 'blob <size>\0' and the content
+    blob_hash = hashlib.sha1('blob {}\0'.format(len(content)).encode('utf-8'))
+    blob_hash.update(content)
+    return blob_hash.hexdigest()
+
+
+def get_tail_hash(content, byte_length):
+    return hashlib.sha256(content[max(byte_length - TAIL_CHECK_BYTES, 0):byte_length]).hexdigest()
+
+
+def get_file_path(config, stream_name, git_sha):
+    return local_store.get_store_path(
+        local_store.get_cache_dir(config), '{}/{}/{}'.format(TAIL_DIR, stream_name, git_sha))
+
+
+def get_raw_url(config, owner, repository, ref, file_path):
+    raw_url = (config or {}).get('raw_url') or DEFAULT_RAW_URL
+    return '{}/{}/{}/{}/{}'.format(raw_url, owner, repository, ref, quote(file_path))
+
+
+# Blob data (raw bytes) of the file, or None to fetch it with git/blobs
+#   ref: commit of the file version (or HEAD)
+def fetch_file(client, config, stream_name, owner, repository, ref, file_path, file_sha, file_state):
+    if not file_state or not file_state.get('sha') or not file_state.get('byte_length'):
+        return None
+    local_path = get_file_path(config, stream_name, file_state['sha'])
+    if file_state['sha'] == file_sha or not os.path.exists(local_path):
+        return None
+    byte_length = file_state['byte_length']
+    tail_start = max(byte_length - TAIL_CHECK_BYTES, 0)
+    raw_url = get_raw_url(config, owner, repository, ref, file_path)
+    LOGGER.info('RANGE TAIL FETCH URL for Stream {}: {}, bytes: {}-'.format(stream_name, raw_url, tail_start))
+    try:
+        response, _, _ = client.get(
+            url=raw_url,
+            headers={'Range': 'bytes={}-'.format(tail_start)},
+            endpoint='{}_range'.format(stream_name),
+            stream=True)
+        try:
+            data = b''.join(response.iter_content(CHUNK_SIZE))
+            status_code = response.status_code
+        finally:
+            response.close()
+    except Exception as err:
+        LOGGER.warning('RANGE TAIL FETCH, Stream: {}, file: {}, request failed, full download: {}'.format(
+            stream_name, file_path, err))
+        return None
+
+    if status_code == 206:
+        tail = data[:byte_length - tail_start]
+        if len(tail) < byte_length - tail_start or \
+            hashlib.sha256(tail).hexdigest() != file_state.get('tail_hash'):
+            LOGGER.warning('RANGE TAIL FETCH, Stream: {}, file: {}, synced bytes changed, full download'.format(
+                stream_name, file_path))
+            return None
+        with open(local_path, 'rb') as file:
+            content = file.read() + data[byte_length - tail_start:]
+    else:
+        # Range not supported: the whole file
+        content = data
+    if get_blob_sha(content) != file_sha:
+        LOGGER.warning('RANGE TAIL FETCH, Stream: {}, file: {}, blob sha mismatch, full download'.format(
+            stream_name, file_path))
+        return None
+    LOGGER.info('RANGE TAIL FETCH, Stream: {}, file: {}, bytes fetched: {}, file bytes: {}'.format(
+        stream_name, file_path, len(data), len(content)))
+    return {'content': content, 'encoding': 'raw'}
+
+
+# Keep the synced file bytes (replacing the previous version); returns the state values
+def save_file(config, stream_name, file_state, file_sha, content):
+    local_path = get_file_path(config, stream_name, file_sha)
+    if not os.path.exists(local_path):
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        tmp_path = '{}.tmp'.format(local_path)
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, local_path)
+    if file_state and file_state.get('sha') and file_state['sha'] != file_sha:
+        previous_path = get_file_path(config, stream_name, file_state['sha'])
+        if os.path.exists(previous_path):
+            os.remove(previous_path)
+    return {
+        'sha': file_sha,
+        'byte_length': len(content),
+        'tail_hash': get_tail_hash(content, len(content))
+    }
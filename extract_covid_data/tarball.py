@@ -0,0 +1,137 @@
+import io
+import os
+import hashlib
+import shutil
+import tarfile
+import singer
+from extract_covid_data import local_store
+from extract_covid_data.commit_log import get_search_filters
+
+LOGGER = singer.get_logger()
+
+# Tarball bulk backfill (config tarball_backfill = true)
+#   Initial sync of a multi-file stream (bookmark = start_date): the files changed since the
+#   start_date and their last-modified dates come from one commit-log pass (commit_log.py),
+#   instead of the code search and a commits call per file, and the file contents come from one
+#   repository archive (/repos/{owner}/{repo}/tarball/{ref}), read as a stream: only the paths
+#   of the commit-log files are extracted, to <cache_dir>/tarball/<stream>/<blob sha>, and each
+#   extracted file is removed once it is processed. Files not found in the archive, or with
+#   another git blob sha (changed after the commit-log pass), are fetched with git/blobs.
+# config.json:
+#   tarball_backfill: Backfill initial syncs from the repository archive, default = false
+#   tarball_ref: Branch, tag or commit of the archive, default = None (the default branch)
+CHUNK_SIZE = 1024 * 1024
+TARBALL_DIR = 'tarball'
+
+
+def is_backfill(config, endpoint_config, last_datetime, start_date):
+    if not (config or {}).get('tarball_backfill', False):
+        return False
+    # Single-file streams: one blob, no backfill needed
+    if endpoint_config.get('activate_version', False):
+        return False
+    return last_datetime == start_date
+
+
+# File-like reader over the response chunks (tarfile stream mode reads it sequentially)
+class ChunkReader(io.RawIOBase):
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.position >= len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.position = 0
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+        size = min(len(buffer), len(self.chunk) - self.position)
+        buffer[:size] = self.chunk[self.position:self.position + size]
+        self.position = self.position + size
+        return size
+
+
+def get_tarball_dir(config, stream_name):
+    return local_store.get_store_path(
+        local_store.get_cache_dir(config), '{}/{}'.format(TARBALL_DIR, stream_name))
+
+
+# Returns {file path: extracted file} for the commit-log items found in the archive
+def extract_files(client, config, stream_name, search_path, items):
+    repo = get_search_filters(search_path).get('repo')
+    wanted_items = {item.get('path'): item for item in items}
+    tarball_dir = get_tarball_dir(config, stream_name)
+    shutil.rmtree(tarball_dir, ignore_errors=True)
+    if not wanted_items:
+        return {}
+    os.makedirs(tarball_dir, exist_ok=True)
+
+    tarball_url = '{}/repos/{}/tarball'.format(client.base_url, repo)
+    if (config or {}).get('tarball_ref'):
+        tarball_url = '{}/{}'.format(tarball_url, config['tarball_ref'])
+    LOGGER.info('TARBALL URL for Stream {}: {}, files wanted: {}'.format(
+        stream_name, tarball_url, len(wanted_items)))
+    response, _, _ = client.get(
+        url=tarball_url,
+        endpoint='{}_tarball'.format(stream_name),
+        stream=True)
+    files = {}
+    member_count = 0
+    local_path = None
+    try:
+        reader = io.BufferedReader(ChunkReader(response.iter_content(CHUNK_SIZE)), CHUNK_SIZE)
+        with tarfile.open(fileobj=reader, mode='r|gz') as archive:
+            for member in archive:
+                member_count = member_count + 1
+                if not member.isfile():
+                    continue
+                # Member names start with the archive root directory (<owner>-<repo>-<sha>/)
+                file_path = member.name.split('/', 1)[1] if '/' in member.name else member.name
+                item = wanted_items.get(file_path)
+                if item is None:
+                    continue
+                local_path = os.path.join(tarball_dir, item.get('sha'))
+                # Git blob sha: sha1 of 'blob <size>\0' and the content
+                blob_hash = hashlib.sha1('blob {}\0'.format(member.size).encode('utf-8'))
+                with archive.extractfile(member) as source, open(local_path, 'wb') as target:
+                    for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                        blob_hash.update(chunk)
+                        target.write(chunk)
+                if blob_hash.hexdigest() != item.get('sha'):
+                    LOGGER.warning('TARBALL, Stream: {}, file: {} changed after the commit log, fetched with git/blobs'.format(
+                        stream_name, file_path))
+                    os.remove(local_path)
+                    local_path = None
+                    continue
+                files[file_path] = local_path
+                local_path = None
+    except Exception as err:
+        # Dropped connection or read timeout while streaming (not retried): the files extracted
+        #   so far are used, the other files are fetched with git/blobs
+        LOGGER.warning('TARBALL, Stream: {}, archive read failed after {} members, files not extracted are fetched with git/blobs: {}'.format(
+            stream_name, member_count, err))
+        if local_path and os.path.exists(local_path):
+            os.remove(local_path)
+    finally:
+        response.close()
+    LOGGER.info('TARBALL, Stream: {}, archive members: {}, files extracted: {}, fetched with git/blobs: {}'.format(
+        stream_name, member_count, len(files), len(wanted_items) - len(files)))
+    return files
+
+
+# Blob data (raw bytes) of an extracted file; the file is removed
+def pop_file(files, file_path):
+    local_path = files.pop(file_path)
+    with open(local_path, 'rb') as file:
+        content = file.read()
+    os.remove(local_path)
+    return {'content': content, 'encoding': 'raw'}
+
+
+def cleanup(config, stream_name):
+    shutil.rmtree(get_tarball_dir(config, stream_name), ignore_errors=True)
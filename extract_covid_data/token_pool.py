@@ -0,0 +1,146 @@
+import time
+import collections
+import singer
+
+LOGGER = singer.get_logger()
+
+# API token pool for GitClient
+#   Each request is sent with the token that has the most remaining quota for the request's
+#   resource (core or search), from the X-RateLimit-* headers of that token's last response.
+#   Tokens without headers yet are used first. A token is rotated out on 401 Unauthorized
+#   (for the rest of the run) or when its quota for a resource is exhausted (until the reset).
+# config.json:
+#   api_token: Token (required)
+#   api_tokens: Additional tokens, e.g. ["<token_2>", "<token_3>"], default = []
+# Rate Limiting: https://developer.github.com/v3/#rate-limiting
+#   Client-side limit per token (as utils.ratelimit): 5000 requests per hour
+RATE_LIMIT = 5000
+RATE_LIMIT_EVERY = 3600
+RESOURCES = ('core', 'search')
+
+
+# Last 4 characters only, for logs
+def mask_token(token):
+    return '...{}'.format(token[-4:]) if token else None
+
+
+class TokenPool(object):
+    def __init__(self, tokens):
+        self.tokens = [token for token in tokens if token]
+        if not self.tokens:
+            raise Exception('Error: Missing api_token in config.json.')
+        self.quotas = {}
+        for token in self.tokens:
+            self.quotas[token] = {
+                'remaining': {},
+                'limit': {},
+                'reset': {},
+                'requests': {resource: 0 for resource in RESOURCES},
+                'times': collections.deque(),
+                'disabled': None
+            }
+
+    def get_active_tokens(self):
+        return [token for token in self.tokens if not self.quotas[token]['disabled']]
+
+    def get_remaining(self, token, resource):
+        quota = self.quotas[token]
+        remaining = quota['remaining'].get(resource)
+        # Quota is restored after the reset time
+        if remaining is not None and quota['reset'].get(resource, 0) <= time.time():
+            return None
+        return remaining
+
+    # Token with the most remaining quota for the resource; unknown quota first (None sorts
+    #   as unlimited); exhausted tokens only if all tokens are exhausted (earliest reset first)
+    def get_token(self, resource):
+        active_tokens = self.get_active_tokens()
+        if not active_tokens:
+            raise Exception('Error: No valid api_token, all tokens were rejected (401 Unauthorized).')
+        available_tokens = [token for token in active_tokens
+                            if self.get_remaining(token, resource) != 0]
+        if not available_tokens:
+            token = min(active_tokens, key=lambda token: self.quotas[token]['reset'].get(resource, 0))
+            LOGGER.warning('RATE LIMIT, all tokens exhausted for resource: {}, using token: {}, reset: {}'.format(
+                resource, mask_token(token), self.quotas[token]['reset'].get(resource)))
+            return token
+        return max(available_tokens, key=lambda token: (
+            self.get_remaining(token, resource) is None,
+            self.get_remaining(token, resource) or 0))
+
+    # Sliding window of request times per token (same as singer utils.ratelimit)
+    def wait(self, token):
+        times = self.quotas[token]['times']
+        if len(times) >= RATE_LIMIT:
+            sleep_time = RATE_LIMIT_EVERY - (time.time() - times.pop())
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+        times.appendleft(time.time())
+
+    # Update the token quota from the response; returns True if the request should be
+    #   retried with another token (401, or quota exhausted, and another token is available)
+    def update(self, token, resource, response):
+        quota = self.quotas[token]
+        headers = response.headers
+        if headers.get('X-RateLimit-Resource'):
+            resource = headers.get('X-RateLimit-Resource')
+        if headers.get('X-RateLimit-Remaining') is not None:
+            remaining = int(headers.get('X-RateLimit-Remaining'))
+            reset = int(headers.get('X-RateLimit-Reset', 0))
+            # Concurrent responses (e.g. hedged requests) may complete out of order: within the
+            #   same reset window, the remaining quota only decreases
+            if quota['reset'].get(resource) == reset and quota['remaining'].get(resource) is not None:
+                remaining = min(remaining, quota['remaining'][resource])
+            quota['remaining'][resource] = remaining
+            quota['limit'][resource] = int(headers.get('X-RateLimit-Limit', 0))
+            quota['reset'][resource] = reset
+        if not getattr(response, 'from_cache', False):
+            quota['requests'][resource] = quota['requests'].get(resource, 0) + 1
+
+        if response.status_code == 401:
+            self.disable(token, 'unauthorized')
+            return len(self.get_active_tokens()) > 0
+        if response.status_code == 403 and quota['remaining'].get(resource) == 0:
+            LOGGER.warning('RATE LIMIT, token: {} exhausted for resource: {}, reset: {}'.format(
+                mask_token(token), resource, quota['reset'].get(resource)))
+            return any(self.get_remaining(other_token, resource) != 0
+                       for other_token in self.get_active_tokens())
+        return False
+
+    def disable(self, token, reason):
+        LOGGER.warning('Token: {} rotated out of the pool: {}'.format(mask_token(token), reason))
+        self.quotas[token]['disabled'] = reason
+
+    def set_rate_limit(self, token, resource, limit, remaining, reset):
+        quota = self.quotas[token]
+        quota['limit'][resource] = limit
+        quota['remaining'][resource] = remaining
+        quota['reset'][resource] = reset
+
+    # Pool quota for a resource: sum over the active tokens with known quota
+    def get_rate_limit(self, resource):
+        tokens = [token for token in self.get_active_tokens()
+                  if self.quotas[token]['remaining'].get(resource) is not None]
+        if not tokens:
+            return None
+        return {
+            'limit': sum(self.quotas[token]['limit'].get(resource) or 0 for token in tokens),
+            'remaining': sum(self.get_remaining(token, resource)
+                             if self.get_remaining(token, resource) is not None
+                             else self.quotas[token]['limit'].get(resource) or 0
+                             for token in tokens),
+            'reset': min(self.quotas[token]['reset'].get(resource) or 0 for token in tokens)
+        }
+
+    def get_usage(self):
+        return [{
+            'token': mask_token(token),
+            'requests': dict(self.quotas[token]['requests']),
+            'remaining': dict(self.quotas[token]['remaining']),
+            'disabled': self.quotas[token]['disabled']
+        } for token in self.tokens]
+
+    def log_usage(self):
+        for usage in self.get_usage():
+            LOGGER.info('Token: {}, requests: {}, remaining: {}, rotated out: {}'.format(
+                usage['token'], usage['requests'], usage['remaining'], usage['disabled']))
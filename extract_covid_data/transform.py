@@ -812,6 +812,60 @@ def transform_neherlab_icu_capacity(record):
     return new_record
 
 
+# Column projection pushdown: output field names of a source csv column, for streams where
+#   each output field comes from one source column. Other streams (jh_csse_daily, eu_*, italy_*,
+#   neherlab reference files) combine or rename columns in their transform and keep all columns.
+def get_projection_field(stream_name, column):
+    if stream_name[:7] == 'c19_trk':
+        return camel_to_snake_case(column)
+    elif stream_name in ('nytimes_us_states', 'nytimes_us_counties'):
+        return column
+    elif stream_name == 'neherlab_case_counts':
+        if column == 'ICU':
+            return 'icu'
+        return column
+    elif stream_name == 'neherlab_country_codes':
+        return column.replace('-', '_')
+    return None
+
+
+# Source columns always kept: used by the transform for other (derived) fields
+PROJECTION_REQUIRED_COLUMNS = {
+    'nytimes_us_states': ('date', 'state'),
+    'nytimes_us_counties': ('date', 'state'),
+    'neherlab_case_counts': ('time', 'location')
+}
+
+
+# Returns a function (column name -> keep column) for the csv reader,
+#   or None if all columns are kept
+def get_column_projection(stream_name, dropped_fields):
+    if not dropped_fields or get_projection_field(stream_name, 'date') is None:
+        return None
+    required_columns = PROJECTION_REQUIRED_COLUMNS.get(stream_name, ())
+
+    def keep_column(column):
+        if column in required_columns:
+            return True
+        return get_projection_field(stream_name, column) not in dropped_fields
+    return keep_column
+
+
+# Row date window (config row_date_filters): the record date (transformed, YYYY-MM-DD...)
+#   is compared to the window dates as strings
+def in_row_date_window(record, row_date_filter):
+    date_field, min_date, max_date = row_date_filter
+    row_date = record.get(date_field)
+    if row_date is None:
+        return True
+    row_date = str(row_date)[:10]
+    if min_date and row_date < min_date:
+        return False
+    if max_date and row_date > max_date:
+        return False
+    return True
+
+
 def transform_record(stream_name, record):
     if stream_name == 'jh_csse_daily':
         new_record = transform_jh_csse_daily(record)
@@ -0,0 +1,180 @@
+import json
+import requests
+from requests.adapters import HTTPAdapter
+import singer
+
+LOGGER = singer.get_logger()
+
+# HTTP transports for GitClient
+# config.json:
+#   transport: requests (default, HTTP/1.1) or http2 (httpx, requires: pip install extract_covid_data[http2])
+#   pool_size: Maximum connections kept in the pool, default = 10
+#   keep_alive: Reuse connections between requests, default = true
+#   connect_timeout: Seconds to wait for a connection, default = None (no timeout)
+#   read_timeout: Seconds to wait for response data, default = None (no timeout)
+#       (GitClient requests use the timeouts by endpoint type of request_policy.py)
+DEFAULT_POOL_SIZE = 10
+
+
+class TransportResponse(object):
+    # Response interface used by GitClient and raise_for_error (same as requests.Response)
+    def __init__(self, status_code, headers, content, reason, url=None, from_cache=False, stream=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.reason = reason
+        self.url = url
+        # Served from the local HTTP cache (http_cache.py), not counted against the rate limit
+        self.from_cache = from_cache
+        # Streamed response (request with stream=True): content is read with iter_content
+        self.stream = stream
+
+    def iter_content(self, chunk_size=1024 * 1024):
+        if self.stream is not None:
+            for chunk in self.stream.iter_bytes(chunk_size):
+                yield chunk
+            return
+        for position in range(0, len(self.content or b''), chunk_size):
+            yield self.content[position:position + chunk_size]
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError('{} Error: {} for url: {}'.format(
+                self.status_code, self.reason, self.url), response=self)
+
+
+class RequestsTransport(object):
+    # HTTP/1.1 connection pool (requests.Session with a sized HTTPAdapter)
+    def __init__(self,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 keep_alive=True,
+                 connect_timeout=None,
+                 read_timeout=None):
+        self.keep_alive = keep_alive
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, headers=None, json=None, timeout=None, **kwargs):
+        headers = dict(headers or {})
+        if not self.keep_alive:
+            headers['Connection'] = 'close'
+        return self.session.request(
+            method=method,
+            url=url,
+            headers=headers,
+            json=json,
+            timeout=timeout or self.timeout,
+            **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class Http2Transport(object):
+    # HTTP/2 client (httpx): many requests are multiplexed over one TLS connection per host
+    def __init__(self,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 keep_alive=True,
+                 connect_timeout=None,
+                 read_timeout=None):
+        try:
+            import httpx
+        except ImportError:
+            raise Exception('Error: transport http2 requires httpx, pip install extract_covid_data[http2]')
+        self.httpx = httpx
+        self.timeout = (connect_timeout, read_timeout)
+        limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size if keep_alive else 0)
+        self.client = httpx.Client(
+            http2=True,
+            limits=limits,
+            timeout=self.get_timeout(self.timeout))
+
+    def get_timeout(self, timeout):
+        connect_timeout, read_timeout = timeout
+        return self.httpx.Timeout(None, connect=connect_timeout, read=read_timeout)
+
+    # Translate httpx responses and errors to the requests interface,
+    #   so that GitClient backoff and error handling are unchanged
+    #   Redirects are followed (as with requests)
+    #   stream=True (e.g. tarball downloads): the content is not read
+    def request(self, method, url, headers=None, json=None, timeout=None, stream=False, **kwargs):
+        httpx = self.httpx
+        if timeout:
+            kwargs['timeout'] = self.get_timeout(timeout)
+        try:
+            if stream:
+                response = self.client.send(
+                    self.client.build_request(method=method, url=url, headers=headers, json=json, **kwargs),
+                    stream=True,
+                    follow_redirects=True)
+                if response.status_code != 200:
+                    response.read()
+                    response.close()
+                else:
+                    return TransportResponse(
+                        status_code=response.status_code,
+                        headers=response.headers,
+                        content=None,
+                        reason=response.reason_phrase,
+                        url=str(response.url),
+                        stream=response)
+            else:
+                response = self.client.request(
+                    method=method,
+                    url=url,
+                    headers=headers,
+                    json=json,
+                    follow_redirects=True,
+                    **kwargs)
+        except httpx.ConnectTimeout as err:
+            raise requests.exceptions.ConnectTimeout(err)
+        except httpx.TimeoutException as err:
+            raise requests.exceptions.ReadTimeout(err)
+        except httpx.TransportError as err:
+            raise requests.exceptions.ConnectionError(err)
+        return TransportResponse(
+            status_code=response.status_code,
+            headers=response.headers,
+            content=response.content,
+            reason=response.reason_phrase,
+            url=str(response.url))
+
+    def close(self):
+        self.client.close()
+
+
+TRANSPORTS = {
+    'requests': RequestsTransport,
+    'http2': Http2Transport
+}
+
+
+def get_transport(config):
+    config = config or {}
+    transport_name = config.get('transport', 'requests')
+    transport_class = TRANSPORTS.get(transport_name)
+    if transport_class is None:
+        raise Exception('Error: Unknown transport in config.json: {}'.format(transport_name))
+    LOGGER.info('Transport: {}, pool_size: {}'.format(
+        transport_name, config.get('pool_size', DEFAULT_POOL_SIZE)))
+    return transport_class(
+        pool_size=config.get('pool_size', DEFAULT_POOL_SIZE),
+        keep_alive=config.get('keep_alive', True),
+        connect_timeout=config.get('connect_timeout'),
+        read_timeout=config.get('read_timeout'))
@@ -13,9 +13,16 @@ setup(name='extract_covid_data',
           'requests==2.23.0',
           'singer-python==5.9.0'
       ],
+      extras_require={
+          'http2': [
+              'httpx[http2]'
+          ]
+      },
       entry_points='''
           [console_scripts]
           extract_covid_data=extract_covid_data:main
+          extract_covid_data_coordinator=extract_covid_data:coordinator_main
+          extract_covid_data_cache=extract_covid_data.http_cache:main
       ''',
       packages=find_packages(),
       package_data={
@@ -0,0 +1,100 @@
+import re
+import base64
+import unittest
+from extract_covid_data import blob_batch
+from extract_covid_data.tail_fetch import get_blob_sha
+
+# Batched GraphQL blob fetch against a fake client: the batched blob data must decode to the
+#   same bytes (and git blob sha) as the per-blob REST (git/blobs) data
+FILES = {
+    'dataset/daily/at.csv': 'country,date,cases\nAT,2020-05-01,15402\n'.encode('utf-8'),
+    'dataset/daily/it.csv': 'country,region,cases\nIT,Valle d\'Aosta/Vallée d\'Aoste,1143\n'.encode('utf-8'),
+    'dataset/daily/large.csv': ('country,cases\n' + 'DE,1\n' * 200).encode('utf-8'),
+    'dataset/daily/latin_1.csv': 'country,region,cases\nIT,Forlì-Cesena,1\n'.encode('latin_1'),
+    'dataset/daily/missing.csv': b'country,cases\nFR,1\n'
+}
+BLOBS = {get_blob_sha(content): content for content in FILES.values()}
+MISSING_SHA = get_blob_sha(FILES['dataset/daily/missing.csv'])
+LARGE_SHA = get_blob_sha(FILES['dataset/daily/large.csv'])
+
+
+class FakeClient(object):
+    base_url = 'https://api.github.com'
+
+    def __init__(self, graphql_error=None):
+        self.graphql_error = graphql_error
+        self.posts = 0
+
+    # GraphQL: the blob objects of the query, as GitHub returns them
+    def post(self, url, json, endpoint=None):
+        self.posts = self.posts + 1
+        if self.graphql_error:
+            raise self.graphql_error
+        repository = {}
+        for alias, blob_sha in re.findall(r'(b\d+): object\(oid: "([0-9a-f]+)"\)', json['query']):
+            content = BLOBS.get(blob_sha)
+            if content is None or blob_sha == MISSING_SHA:
+                repository[alias] = None
+                continue
+            repository[alias] = {
+                'text': content.decode('utf-8', errors='replace'),
+                'byteSize': len(content),
+                'isBinary': False,
+                'isTruncated': False
+            }
+        return {'data': {'repository': repository}}, None, None
+
+    # REST: git/blobs/<sha>
+    def get(self, url, endpoint=None):
+        blob_sha = url.rsplit('/', 1)[1]
+        content = BLOBS[blob_sha]
+        return {
+            'sha': blob_sha,
+            'size': len(content),
+            'content': base64.b64encode(content).decode('ascii'),
+            'encoding': 'base64'
+        }, None, None
+
+
+# File bytes as sync_endpoint decodes them
+def get_content(file_data):
+    if file_data.get('encoding') == 'utf-8':
+        return file_data['content'].encode('utf-8')
+    return base64.b64decode(file_data['content'])
+
+
+class TestBlobBatch(unittest.TestCase):
+
+    def fetch_rest(self, client, blob_sha):
+        file_data, _, _ = client.get('{}/repos/owner/repo/git/blobs/{}'.format(client.base_url, blob_sha))
+        return file_data
+
+    def test_batch_matches_rest(self):
+        client = FakeClient()
+        config = {'graphql_max_blob_bytes': 1000}
+        blob_shas = list(BLOBS)
+        blobs = blob_batch.fetch_blob_texts(client, config, 'eu_daily', 'owner', 'repo', blob_shas)
+        self.assertEqual(client.posts, 1)
+        # Oversized, missing and not valid UTF-8 blobs fall back to REST
+        self.assertEqual(
+            set(blobs),
+            set(blob_shas) - {LARGE_SHA, MISSING_SHA, get_blob_sha(FILES['dataset/daily/latin_1.csv'])})
+        for blob_sha in blob_shas:
+            file_data = blobs.get(blob_sha) or self.fetch_rest(client, blob_sha)
+            content = get_content(file_data)
+            self.assertEqual(content, get_content(self.fetch_rest(client, blob_sha)))
+            self.assertEqual(get_blob_sha(content), blob_sha)
+
+    def test_large_blob_within_limit(self):
+        client = FakeClient()
+        blobs = blob_batch.fetch_blob_texts(client, {}, 'eu_daily', 'owner', 'repo', [LARGE_SHA])
+        self.assertEqual(get_blob_sha(get_content(blobs[LARGE_SHA])), LARGE_SHA)
+
+    def test_query_failure_falls_back_to_rest(self):
+        client = FakeClient(graphql_error=Exception('502 Bad Gateway'))
+        blobs = blob_batch.fetch_blob_texts(client, {}, 'eu_daily', 'owner', 'repo', list(BLOBS))
+        self.assertEqual(blobs, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
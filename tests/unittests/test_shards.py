@@ -0,0 +1,137 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from extract_covid_data import shards, repo_probe
+from extract_covid_data.streams import STREAMS
+
+# Sharded sync with several local processes (nodes) sharing a shard directory, with a fake
+#   sync_stream: no GitClient, no network calls
+STREAM_NAMES = ['eu_daily', 'jh_csse_daily']
+PLAN_STATE = {
+    'bookmarks': {'eu_daily': '2020-05-01T00:00:00Z', 'jh_csse_daily': '2020-05-01T00:00:00Z'}
+}
+PUSHED_AT = '2020-05-10T00:00:00Z'
+
+
+# Fake sync_stream: logs the unit, sets the stream's bookmark, per-file state and repository probe
+def fake_sync_stream(client, config, catalog, state, stream_name, selected_streams, file_partition=None,
+                     deadline=None, repo_probes=None):
+    unit = '{}:{}'.format(stream_name, file_partition[0] if file_partition else None)
+    with open(os.path.join(config['shard_dir'], 'synced.log'), 'a') as file:
+        file.write('{}\n'.format(unit))
+    time.sleep(0.01)
+    partition = file_partition[0] if file_partition else 0
+    state['bookmarks'][stream_name] = '2020-05-0{}T00:00:00Z'.format(partition + 2)
+    state.setdefault('append_only', {}).setdefault(stream_name, {})['file-{}.csv'.format(partition)] = {
+        'row_count': partition + 1
+    }
+    repo = repo_probe.get_stream_repo(STREAMS[stream_name]['search_path'])
+    repo_probes[repo] = PUSHED_AT
+    state.setdefault('repo_probes', {})[repo] = {
+        'pushed_at': PUSHED_AT,
+        'last_modified': '2020-05-10T00:00:00Z',
+        'probed_at': '2020-05-11T00:00:00Z'
+    }
+    return 1
+
+
+def run_node(shard_dir, node_id):
+    config = {
+        'shard_dir': shard_dir,
+        'shard_node_id': node_id,
+        'shard_file_partitions': {'jh_csse_daily': 4}
+    }
+    shards.sync_shards(
+        client=None,
+        config=config,
+        catalog=None,
+        selected_streams=STREAM_NAMES,
+        sync_stream=fake_sync_stream,
+        repo_probes={})
+
+
+class TestShards(unittest.TestCase):
+
+    def setUp(self):
+        self.shard_dir = tempfile.mkdtemp()
+        config = {'shard_file_partitions': {'jh_csse_daily': 4}}
+        self.units = shards.get_units(STREAM_NAMES, config)
+        shards.create_plan(self.shard_dir, self.units, PLAN_STATE)
+
+    def tearDown(self):
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
+
+    def get_synced_units(self):
+        with open(os.path.join(self.shard_dir, 'synced.log')) as file:
+            return file.read().split()
+
+    def test_units_claimed_once(self):
+        context = multiprocessing.get_context('fork')
+        nodes = [context.Process(target=run_node, args=(self.shard_dir, 'node-{}'.format(index)))
+                 for index in range(4)]
+        for node in nodes:
+            node.start()
+        for node in nodes:
+            node.join()
+            self.assertEqual(node.exitcode, 0)
+
+        synced_units = self.get_synced_units()
+        self.assertEqual(len(synced_units), len(self.units))
+        self.assertEqual(len(set(synced_units)), len(self.units))
+        self.assertTrue(all(status['done'] for status in shards.get_status(self.shard_dir)))
+
+        state, incomplete_streams = shards.merge_states(self.shard_dir)
+        self.assertEqual(incomplete_streams, [])
+        self.assertEqual(state['bookmarks']['jh_csse_daily'], '2020-05-05T00:00:00Z')
+        self.assertEqual(state['bookmarks']['eu_daily'], '2020-05-02T00:00:00Z')
+        self.assertEqual(len(state['append_only']['jh_csse_daily']), 4)
+
+    def test_stale_lock_reclaimed(self):
+        unit_id = self.units[0]['unit_id']
+        self.assertTrue(shards.claim_unit(self.shard_dir, unit_id, 'node-0'))
+        self.assertFalse(shards.claim_unit(self.shard_dir, unit_id, 'node-1'))
+        self.assertFalse(shards.claim_unit(self.shard_dir, unit_id, 'node-1', lock_timeout=60))
+        lock_path = os.path.join(self.shard_dir, 'locks', unit_id)
+        stale_time = time.time() - 120
+        os.utime(lock_path, (stale_time, stale_time))
+        self.assertTrue(shards.claim_unit(self.shard_dir, unit_id, 'node-1', lock_timeout=60))
+        self.assertEqual(shards.get_status(self.shard_dir)[0]['node_id'], 'node-1')
+
+    def test_merge_keeps_bookmark_with_missing_unit(self):
+        # node-0 syncs all units, then one unit of jh_csse_daily is lost
+        run_node(self.shard_dir, 'node-0')
+        node_state_name = 'states/node-0.json'
+        node_state = shards.local_store.read_json(self.shard_dir, node_state_name)
+        del node_state['units']['jh_csse_daily.2-of-4']
+        shards.local_store.write_json(self.shard_dir, node_state_name, node_state)
+
+        state, incomplete_streams = shards.merge_states(self.shard_dir)
+        self.assertEqual(incomplete_streams, ['jh_csse_daily'])
+        self.assertEqual(state['bookmarks']['jh_csse_daily'], PLAN_STATE['bookmarks']['jh_csse_daily'])
+        self.assertEqual(state['bookmarks']['eu_daily'], '2020-05-02T00:00:00Z')
+
+    def test_merge_repo_probes(self):
+        # state['repo_probes'] is keyed by repository, not stream: kept per unit and merged
+        run_node(self.shard_dir, 'node-0')
+        state, _ = shards.merge_states(self.shard_dir)
+        for stream_name in STREAM_NAMES:
+            repo = repo_probe.get_stream_repo(STREAMS[stream_name]['search_path'])
+            self.assertEqual(state['repo_probes'][repo]['pushed_at'], PUSHED_AT)
+            self.assertEqual(state['repo_probes'][repo]['streams'][stream_name], PUSHED_AT)
+
+    def test_merge_repo_probes_with_missing_unit(self):
+        run_node(self.shard_dir, 'node-0')
+        node_state_name = 'states/node-0.json'
+        node_state = shards.local_store.read_json(self.shard_dir, node_state_name)
+        del node_state['units']['jh_csse_daily.2-of-4']
+        shards.local_store.write_json(self.shard_dir, node_state_name, node_state)
+        state, _ = shards.merge_states(self.shard_dir)
+        repo = repo_probe.get_stream_repo(STREAMS['jh_csse_daily']['search_path'])
+        self.assertNotIn('jh_csse_daily', state['repo_probes'][repo].get('streams', {}))
+
+
+if __name__ == '__main__':
+    unittest.main()